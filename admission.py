@@ -0,0 +1,304 @@
+import os
+import math
+import time
+import asyncio
+import threading
+from collections import deque
+from contextlib import contextmanager
+from typing import Callable, Iterator, Optional, Tuple
+
+from solver_metrics import ADMISSION_REJECTED, ADMISSION_REQUESTS, ADMISSION_WAIT_SECONDS
+
+# 准入控制配置，可通过环境变量覆盖；ADMISSION_MAX_IN_FLIGHT=0 关闭准入控制
+ADMISSION_MAX_IN_FLIGHT = int(os.environ.get('ADMISSION_MAX_IN_FLIGHT', '4'))
+ADMISSION_MAX_QUEUE = int(os.environ.get('ADMISSION_MAX_QUEUE', '16'))
+# 预计等待超过该秒数的请求直接拒绝，0表示只按队列长度拒绝
+ADMISSION_MAX_WAIT = float(os.environ.get('ADMISSION_MAX_WAIT', '120'))
+# 还没有请求完成时，按该值估计单个请求的处理时间（秒）
+ADMISSION_INITIAL_SERVICE_SECONDS = float(os.environ.get('ADMISSION_INITIAL_SERVICE_SECONDS', '10'))
+# 排队期间刷新排队位置的间隔（秒）
+ADMISSION_POLL_INTERVAL = float(os.environ.get('ADMISSION_POLL_INTERVAL', '1'))
+# Gradio并发上限在准入容量之外多留的名额：超出容量的请求必须能进入处理函数，
+# 才会被准入控制立即拒绝，而不是在Gradio自己的队列里无限等待
+ADMISSION_GRADIO_HEADROOM = int(os.environ.get('ADMISSION_GRADIO_HEADROOM', '8'))
+# 处理时间滑动平均的权重
+SERVICE_TIME_ALPHA = 0.2
+
+
+class ServerBusy(Exception):
+    """排队已满或预计等待过长，请求被拒绝"""
+
+    def __init__(self, retry_after: int):
+        self.retry_after = retry_after
+        super().__init__(f"服务繁忙，请 {retry_after} 秒后重试")
+
+
+class Ticket:
+    """一个请求的准入凭证"""
+
+    def __init__(self):
+        self.admitted = False
+        self.released = False
+        self.enqueued_at = time.time()
+        self.admitted_at = None
+        # 异步等待者在准入时被唤醒
+        self.waker: Optional[Callable[[], None]] = None
+
+
+class AdmissionController:
+    """解题请求的准入控制：限制同时处理的请求数，超出的按先来先服务排队
+
+    队列已满，或者按处理时间的滑动平均估计排到时已超过 max_wait 秒时，enter() 立即抛出
+    ServerBusy，附带建议的重试秒数，不接收注定超时的请求。排队中的请求可以通过
+    wait_turn() 逐秒拿到自己的排队位置和预计等待时间，用于在界面上显示。
+
+    用法::
+
+        ticket = controller.enter()         # 可能抛出ServerBusy
+        try:
+            for position, wait_seconds in controller.wait_turn(ticket):
+                ...                          # 显示排队位置
+            ...                              # 处理请求
+        finally:
+            controller.release(ticket)
+    """
+
+    def __init__(self, max_in_flight: int = ADMISSION_MAX_IN_FLIGHT, max_queue: int = ADMISSION_MAX_QUEUE,
+                 max_wait: float = ADMISSION_MAX_WAIT,
+                 initial_service_seconds: float = ADMISSION_INITIAL_SERVICE_SECONDS):
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.service_seconds = initial_service_seconds
+        self._waiting = deque()
+        self._in_flight = 0
+        self._condition = threading.Condition()
+        self.stats = {'admitted': 0, 'queued': 0, 'rejected': 0, 'abandoned': 0}
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_in_flight > 0
+
+    def estimate_wait(self, position: int) -> float:
+        """排在第position位的请求预计还要等待的秒数"""
+        if position <= 0 or not self.enabled:
+            return 0.0
+        return math.ceil(position / self.max_in_flight) * self.service_seconds
+
+    def enter(self) -> Ticket:
+        """申请准入：有空闲槽位时立即准入，否则排队；排不上时抛出ServerBusy"""
+        ticket = Ticket()
+        with self._condition:
+            if not self.enabled or (self._in_flight < self.max_in_flight and not self._waiting):
+                self._admit(ticket)
+                return ticket
+
+            position = len(self._waiting) + 1
+            reason = None
+            if len(self._waiting) >= self.max_queue:
+                reason = 'queue_full'
+            elif self.max_wait > 0 and self.estimate_wait(position) > self.max_wait:
+                reason = 'wait_too_long'
+            if reason is not None:
+                self.stats['rejected'] += 1
+                retry_after = self._retry_after()
+            else:
+                self._waiting.append(ticket)
+                self.stats['queued'] += 1
+        if reason is not None:
+            ADMISSION_REJECTED.inc(reason=reason)
+            print(f"🚦 请求被拒绝（{reason}）：{self.max_in_flight} 个处理中，{position - 1} 个排队，"
+                  f"建议 {retry_after} 秒后重试")
+            raise ServerBusy(retry_after)
+        ADMISSION_REQUESTS.inc(state='queued')
+        return ticket
+
+    def _retry_after(self) -> int:
+        """队列腾出一个位置并且等待时间回到上限以内所需的秒数"""
+        excess = len(self._waiting) + 1 - self.max_queue
+        if self.max_wait > 0:
+            # 预计等待不超过max_wait时最多能排的位置数
+            allowed = int(self.max_wait / max(self.service_seconds, 1e-3)) * self.max_in_flight
+            excess = max(excess, len(self._waiting) + 1 - allowed)
+        return max(1, math.ceil(self.estimate_wait(excess)))
+
+    def _admit(self, ticket: Ticket):
+        ticket.admitted = True
+        ticket.admitted_at = time.time()
+        self._in_flight += 1
+        self.stats['admitted'] += 1
+        ADMISSION_REQUESTS.inc(state='running')
+        ADMISSION_WAIT_SECONDS.observe(ticket.admitted_at - ticket.enqueued_at)
+        if ticket.waker is not None:
+            ticket.waker()
+
+    def _promote(self):
+        """有空闲槽位时按到达顺序准入排队的请求"""
+        promoted = 0
+        while self._waiting and self._in_flight < self.max_in_flight:
+            self._admit(self._waiting.popleft())
+            promoted += 1
+        if promoted:
+            ADMISSION_REQUESTS.dec(promoted, state='queued')
+            self._condition.notify_all()
+
+    def position(self, ticket: Ticket) -> int:
+        """当前排队位置（从1开始），已准入时为0"""
+        with self._condition:
+            return self._position(ticket)
+
+    def _position(self, ticket: Ticket) -> int:
+        if ticket.admitted:
+            return 0
+        for index, waiting in enumerate(self._waiting):
+            if waiting is ticket:
+                return index + 1
+        return 0
+
+    def wait_turn(self, ticket: Ticket, interval: float = ADMISSION_POLL_INTERVAL) -> Iterator[Tuple[int, float]]:
+        """等待准入，排队位置或预计等待时间变化时产出 (排队位置, 预计等待秒数)，每interval秒检查一次"""
+        last = None
+        with self._condition:
+            while not ticket.admitted:
+                position = self._position(ticket)
+                update = (position, self.estimate_wait(position))
+                if update != last:
+                    last = update
+                    # 产出时不持有锁，调用方可能花时间刷新界面
+                    self._condition.release()
+                    try:
+                        yield update
+                    finally:
+                        self._condition.acquire()
+                    continue
+                self._condition.wait(interval)
+
+    def wait(self, ticket: Ticket):
+        """阻塞直到准入"""
+        for _ in self.wait_turn(ticket):
+            pass
+
+    async def await_turn(self, ticket: Ticket, interval: float = ADMISSION_POLL_INTERVAL):
+        """wait_turn的异步版本，等待期间不占用线程"""
+        loop = asyncio.get_running_loop()
+        admitted = loop.create_future()
+
+        def wake():
+            loop.call_soon_threadsafe(lambda: admitted.done() or admitted.set_result(None))
+
+        with self._condition:
+            ticket.waker = wake
+        last = None
+        while True:
+            with self._condition:
+                if ticket.admitted:
+                    return
+                position = self._position(ticket)
+                update = (position, self.estimate_wait(position))
+            if update != last:
+                last = update
+                yield update
+            await asyncio.wait([admitted], timeout=interval)
+
+    def release(self, ticket: Ticket):
+        """请求结束（完成、出错或中途取消）时调用，排队中的请求直接出队"""
+        with self._condition:
+            if ticket.released:
+                return
+            ticket.released = True
+            if ticket.admitted:
+                self._in_flight -= 1
+                ADMISSION_REQUESTS.dec(state='running')
+                service = time.time() - ticket.admitted_at
+                self.service_seconds += SERVICE_TIME_ALPHA * (service - self.service_seconds)
+            else:
+                self._waiting.remove(ticket)
+                self.stats['abandoned'] += 1
+                ADMISSION_REQUESTS.dec(state='queued')
+            self._promote()
+
+    @contextmanager
+    def admit(self):
+        """阻塞式准入，适合不需要显示排队位置的调用方
+
+        用法::
+
+            with controller.admit():
+                ...
+        """
+        ticket = self.enter()
+        try:
+            self.wait(ticket)
+            yield ticket
+        finally:
+            self.release(ticket)
+
+    def report(self) -> str:
+        with self._condition:
+            return (f"准入控制: 处理中 {self._in_flight}/{self.max_in_flight}，排队 {len(self._waiting)}/{self.max_queue}，"
+                    f"已准入 {self.stats['admitted']}，拒绝 {self.stats['rejected']}，"
+                    f"排队中放弃 {self.stats['abandoned']}，平均处理 {self.service_seconds:.1f}s")
+
+
+def queue_message(position: int, wait_seconds: float) -> str:
+    """排队位置的提示文本"""
+    return f"⏳ 排队中：前面还有 {position - 1} 个请求，预计等待约 {math.ceil(wait_seconds)} 秒"
+
+
+def run_admitted(steps: Callable[[], Iterator], queued: Callable[[str], object], busy: Callable[[str], object],
+                 controller: Optional[AdmissionController] = None) -> Iterator:
+    """在准入控制下执行流式处理
+
+    排队期间产出 queued(排队提示)，被拒绝时产出 busy(繁忙提示) 后结束，准入后依次产出steps()的输出。
+    调用方中途关闭生成器（用户取消、关闭页面）时释放槽位或退出队列。
+    """
+    controller = controller or get_admission_controller()
+    try:
+        ticket = controller.enter()
+    except ServerBusy as e:
+        yield busy(f"🚦 {e}")
+        return
+    try:
+        for position, wait_seconds in controller.wait_turn(ticket):
+            yield queued(queue_message(position, wait_seconds))
+        yield from steps()
+    finally:
+        controller.release(ticket)
+
+
+def gradio_concurrency_limit(controller: Optional[AdmissionController] = None) -> Optional[int]:
+    """Gradio事件的并发上限
+
+    取准入容量（处理中 + 排队）再加 ADMISSION_GRADIO_HEADROOM。上限恰好等于容量时，
+    第容量+1个请求停在Gradio的队列里，到不了enter()，快速拒绝永远不会触发；
+    多出的名额只被立即拒绝的请求短暂占用。
+    """
+    controller = controller or get_admission_controller()
+    if not controller.enabled:
+        return None
+    return controller.max_in_flight + controller.max_queue + max(ADMISSION_GRADIO_HEADROOM, 1)
+
+
+def gradio_queue_size(controller: Optional[AdmissionController] = None) -> Optional[int]:
+    """Gradio队列（queue的max_size）的长度上限
+
+    并发名额全部被占满时Gradio才会排队，此时准入控制本来也会拒绝，
+    只留少量位置给即将被拒绝的请求，其余由Gradio直接返回队列已满。
+    """
+    controller = controller or get_admission_controller()
+    if not controller.enabled:
+        return None
+    return max(ADMISSION_GRADIO_HEADROOM, 1)
+
+
+_default_controller = None
+_default_controller_lock = threading.Lock()
+
+
+def get_admission_controller() -> AdmissionController:
+    """获取进程内共享的准入控制器，所有入口共用同一组槽位"""
+    global _default_controller
+    with _default_controller_lock:
+        if _default_controller is None:
+            _default_controller = AdmissionController()
+        return _default_controller
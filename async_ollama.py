@@ -0,0 +1,97 @@
+import os
+import asyncio
+import weakref
+from typing import Dict, Optional
+
+import httpx
+import ollama
+
+from backend_pool import get_backend_pool
+from cancellation import call_timeout
+from concurrency_limit import get_limiter
+from resilience import aretry_call, stage_timeout
+from solver_metrics import observe_ollama_response
+
+# 连接池配置，可通过环境变量覆盖
+OLLAMA_HOST = os.environ.get('OLLAMA_HOST')
+ASYNC_POOL_SIZE = int(os.environ.get('OLLAMA_ASYNC_POOL_SIZE', '16'))
+ASYNC_CONNECT_TIMEOUT = float(os.environ.get('OLLAMA_CONNECT_TIMEOUT', '5'))
+# httpx层的读取超时上限（秒）；单次调用的超时按阶段设置，见 resilience.STAGE_TIMEOUTS
+ASYNC_CALL_TIMEOUT = float(os.environ.get('OLLAMA_CALL_TIMEOUT', '120'))
+
+# httpx连接与事件循环绑定，每个事件循环为每个后端各用一个共享客户端
+_clients: 'weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Dict]' = weakref.WeakKeyDictionary()
+
+
+def create_async_client(host: Optional[str] = OLLAMA_HOST, pool_size: int = ASYNC_POOL_SIZE) -> ollama.AsyncClient:
+    """创建带keep-alive连接池的ollama异步客户端"""
+    return ollama.AsyncClient(
+        host=host,
+        timeout=httpx.Timeout(ASYNC_CALL_TIMEOUT, connect=ASYNC_CONNECT_TIMEOUT),
+        limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size),
+    )
+
+
+def _loop_state() -> Dict:
+    """当前事件循环共享的客户端（按后端地址）和并发信号量"""
+    loop = asyncio.get_running_loop()
+    state = _clients.get(loop)
+    if state is None:
+        state = {
+            'clients': {},
+            # 并发调用数不超过连接池大小，多余的请求在这里排队而不是占用线程
+            'semaphore': asyncio.Semaphore(ASYNC_POOL_SIZE),
+        }
+        _clients[loop] = state
+    return state
+
+
+def get_async_client(host: Optional[str] = OLLAMA_HOST) -> ollama.AsyncClient:
+    """获取当前事件循环连接某个后端的共享ollama异步客户端，默认为OLLAMA_HOST"""
+    clients = _loop_state()['clients']
+    client = clients.get(host)
+    if client is None:
+        client = clients[host] = create_async_client(host)
+    return client
+
+
+async def achat(timeout: Optional[float] = None, stage: str = 'math', **kwargs):
+    """通过共享连接池异步调用ollama.chat
+
+    超时、连接失败和5xx按带抖动的退避重试，每次重试重新选择主机。
+
+    Args:
+        timeout: 单次调用的超时秒数，默认为该阶段的超时（stage_timeout），不超过当前请求的截止时间
+        stage: 调用所属的阶段（vision/math），决定默认超时和重试计数的标签
+        **kwargs: 传给AsyncClient.chat的参数（model、messages、options等）
+
+    Raises:
+        asyncio.TimeoutError: 重试后仍然超时
+    """
+    state = _loop_state()
+    model = kwargs.get('model', '')
+
+    async def call():
+        async with state['semaphore']:
+            # 由后端池选择主机，再经过该主机上该模型的自适应限流，排队和prefill变慢时自动减少并发
+            with get_backend_pool().lease(model) as backend:
+                async with get_limiter(model, backend.name).aacquire() as permit:
+                    response = await asyncio.wait_for(
+                        get_async_client(backend.url).chat(**kwargs),
+                        timeout=call_timeout(timeout or stage_timeout(stage)),
+                    )
+                    permit.record_response(response)
+        return response
+
+    response = await aretry_call(call, stage)
+    observe_ollama_response(kwargs.get('model', ''), response)
+    return response
+
+
+async def close_async_client():
+    """关闭当前事件循环的共享客户端"""
+    loop = asyncio.get_running_loop()
+    state = _clients.pop(loop, None)
+    if state is not None:
+        for client in state['clients'].values():
+            await client.close()
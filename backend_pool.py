@@ -0,0 +1,530 @@
+import os
+import time
+import socket
+import argparse
+import threading
+import contextvars
+from contextlib import contextmanager
+from typing import Iterator, List, Optional, Set
+
+import httpcore
+import httpx
+import ollama
+
+from resilience import CircuitBreaker
+from solver_metrics import (BACKEND_CIRCUIT_OPEN, BACKEND_DRAINING, BACKEND_HEALTHY, BACKEND_OUTSTANDING,
+                            BACKEND_REQUESTS)
+
+# 多个ollama地址用逗号分隔，地址后可以用 = 指定该主机提供的模型（多个用 | 分隔），例如
+#   OLLAMA_BACKENDS="http://10.0.0.2:11434=granite3.2-vision|qwen2:latest,http://10.0.0.3:11434=qwen2:latest"
+# 未指定模型时按 /api/tags 的结果判断；未设置OLLAMA_BACKENDS时只使用OLLAMA_HOST（或ollama客户端的默认地址）
+OLLAMA_BACKENDS = os.environ.get('OLLAMA_BACKENDS', '')
+# 健康检查（/api/ps）的间隔和超时（秒）
+OLLAMA_HEALTH_INTERVAL = float(os.environ.get('OLLAMA_HEALTH_INTERVAL', '10'))
+OLLAMA_HEALTH_TIMEOUT = float(os.environ.get('OLLAMA_HEALTH_TIMEOUT', '3'))
+# 连续多少次健康检查失败后摘除后端；调用时连接失败则立即摘除
+OLLAMA_UNHEALTHY_AFTER = int(os.environ.get('OLLAMA_UNHEALTHY_AFTER', '2'))
+# 每行一个地址，列在其中的后端不再接收新请求，在途请求照常完成（排空）；删掉该行即恢复
+OLLAMA_DRAIN_FILE = os.environ.get('OLLAMA_DRAIN_FILE', '')
+# 指标和日志中单主机模式的后端名
+DEFAULT_BACKEND = os.environ.get('OLLAMA_HOST') or 'default'
+
+# 这些异常说明主机不可达，而不是这次请求本身出错
+CONNECTION_ERRORS = (ConnectionError, httpx.ConnectError)
+
+
+# 当前这次请求的超时，由HostClient在发出HTTP请求时交给httpx；
+# 不在 with_timeout 中调用时为USE_CLIENT_DEFAULT，沿用客户端构造时的超时
+_request_timeout = contextvars.ContextVar('ollama_request_timeout', default=httpx.USE_CLIENT_DEFAULT)
+
+
+# 当前这次请求的句柄（LiveCall），由连接的读写记录请求所用的socket
+_live_call = contextvars.ContextVar('ollama_live_call', default=None)
+
+
+class CallAborted(Exception):
+    """请求被调用方主动中止（如对冲请求中落后的一方）"""
+
+    def __init__(self):
+        super().__init__('请求已中止')
+
+
+class LiveCall:
+    """一次进行中的HTTP请求，可以从其他线程中止
+
+    读取线程可能正阻塞在等待响应头（模型预填充）或两块之间的停顿上，关闭生成器或检查标志都要等到
+    下一块到达。abort() 直接对这次请求所用的socket执行shutdown：阻塞的读取立即返回，
+    ollama检测到连接断开随即停止生成；读取线程收到的是 abort(error) 指定的异常。
+    请求结束后连接归还连接池，这时 abort() 不再做任何事，不会影响复用该连接的其他请求。
+    """
+
+    def __init__(self):
+        self.error: Optional[BaseException] = None
+        self._stream = None
+        self._finished = False
+        self._lock = threading.Lock()
+
+    @property
+    def aborted(self) -> bool:
+        return self.error is not None
+
+    def abort(self, error: Optional[BaseException] = None):
+        """中止请求，读取线程随后抛出error（默认为CallAborted）；重复中止不做任何事"""
+        with self._lock:
+            if self._finished or self.error is not None:
+                return
+            self.error = error or CallAborted()
+            if self._stream is not None:
+                _shutdown(self._stream)
+
+    def _attach(self, stream):
+        """连接每次读写前调用，记录本次请求所用的连接；已中止时不再发出"""
+        with self._lock:
+            self._stream = stream
+            if self.error is not None:
+                raise httpcore.ReadError('请求已中止')
+
+    def _finish(self):
+        with self._lock:
+            self._finished = True
+            self._stream = None
+
+    def _reraise(self, error: BaseException):
+        """中止引起的连接错误换成abort指定的异常"""
+        if self.error is not None:
+            raise self.error from error
+
+
+def _shutdown(stream):
+    sock = stream.get_extra_info('socket')
+    if sock is None:
+        return
+    try:
+        # 用socket.socket的shutdown：SSLSocket的shutdown会先清掉SSL状态，读取线程随之出错的方式不可控
+        socket.socket.shutdown(sock, socket.SHUT_RDWR)
+    except OSError:
+        pass
+
+
+class _TrackedStream(httpcore.NetworkStream):
+    """在每次读写前把连接登记到当前请求的LiveCall上"""
+
+    def __init__(self, stream: httpcore.NetworkStream):
+        self._stream = stream
+
+    def _track(self):
+        call = _live_call.get()
+        if call is not None:
+            call._attach(self)
+
+    def read(self, max_bytes: int, timeout: Optional[float] = None) -> bytes:
+        self._track()
+        return self._stream.read(max_bytes, timeout)
+
+    def write(self, buffer: bytes, timeout: Optional[float] = None) -> None:
+        self._track()
+        self._stream.write(buffer, timeout)
+
+    def close(self) -> None:
+        self._stream.close()
+
+    def start_tls(self, ssl_context, server_hostname: Optional[str] = None,
+                  timeout: Optional[float] = None) -> httpcore.NetworkStream:
+        return _TrackedStream(self._stream.start_tls(ssl_context, server_hostname, timeout))
+
+    def get_extra_info(self, info: str):
+        return self._stream.get_extra_info(info)
+
+
+class _TrackingBackend(httpcore.NetworkBackend):
+    def __init__(self, backend: httpcore.NetworkBackend):
+        self._backend = backend
+
+    def connect_tcp(self, *args, **kwargs) -> httpcore.NetworkStream:
+        return _TrackedStream(self._backend.connect_tcp(*args, **kwargs))
+
+    def connect_unix_socket(self, *args, **kwargs) -> httpcore.NetworkStream:
+        return _TrackedStream(self._backend.connect_unix_socket(*args, **kwargs))
+
+    def sleep(self, seconds: float) -> None:
+        self._backend.sleep(seconds)
+
+
+class _AbortableTransport(httpx.HTTPTransport):
+    """连接都经过_TrackingBackend的httpx传输层，使LiveCall能找到请求所用的socket"""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        # httpx不能直接指定httpcore的网络后端，这里包装连接池已有的后端，之后新建的连接都经过它
+        self._pool._network_backend = _TrackingBackend(self._pool._network_backend)
+
+
+class HostClient(ollama.Client):
+    """每次请求单独指定超时、可以从其他线程中止的ollama客户端
+
+    ollama.Client只能在构造时设置超时，而截止时间裁剪后几乎每次调用的超时都不同；
+    按超时缓存客户端会无限增长，也用不上连接复用。这里一台主机只用一个客户端（一个httpx连接池），
+    超时作为httpx的单次请求参数传入。with_timeout 传入LiveCall时，可以用它中止这次请求（见 LiveCall）。
+    """
+
+    def __init__(self, host: Optional[str] = None, **kwargs):
+        kwargs.setdefault('transport', _AbortableTransport())
+        super().__init__(host, **kwargs)
+
+    def _request_raw(self, *args, **kwargs):
+        _set_timeout(kwargs)
+        return super()._request_raw(*args, **kwargs)
+
+    def _request(self, cls, *args, stream: bool = False, **kwargs):
+        # 流式请求在返回的生成器里才发出，这里先把超时和请求句柄固定下来
+        _set_timeout(kwargs)
+        call = _live_call.get()
+        response = super()._request(cls, *args, stream=stream, **kwargs)
+        return _bound_stream(response, call) if stream and call is not None else response
+
+    def with_timeout(self, timeout, method: str, call: Optional[LiveCall] = None, **kwargs):
+        """以指定的超时（秒，None为不限，USE_CLIENT_DEFAULT为客户端默认超时）调用chat、embed等方法
+
+        call为LiveCall时可以从其他线程中止这次请求；流式调用在迭代结束时才释放它。
+        """
+        token = _request_timeout.set(timeout)
+        call_token = _live_call.set(call)
+        streaming = bool(kwargs.get('stream'))
+        try:
+            return getattr(self, method)(**kwargs)
+        except Exception as e:
+            if call is not None:
+                call._reraise(e)
+            raise
+        finally:
+            _live_call.reset(call_token)
+            _request_timeout.reset(token)
+            if call is not None and not streaming:
+                call._finish()
+
+
+def _bound_stream(chunks: Iterator, call: LiveCall) -> Iterator:
+    """在登记了call的上下文中逐块推进流式响应"""
+    context = contextvars.copy_context()
+    context.run(_live_call.set, call)
+    try:
+        while True:
+            try:
+                chunk = context.run(next, chunks)
+            except StopIteration:
+                return
+            except Exception as e:
+                call._reraise(e)
+                raise
+            yield chunk
+    finally:
+        context.run(chunks.close)
+        call._finish()
+
+
+def _set_timeout(kwargs):
+    """只有在 with_timeout 中才把超时交给httpx，否则不传，由httpx使用客户端的默认超时"""
+    timeout = _request_timeout.get()
+    if timeout is not httpx.USE_CLIENT_DEFAULT:
+        kwargs.setdefault('timeout', timeout)
+
+
+class NoBackendAvailable(RuntimeError):
+    """没有健康、未在排空并且提供该模型的后端"""
+
+
+def model_key(model: str) -> str:
+    """ollama的模型名省略标签时即为latest"""
+    return model if ':' in model else f'{model}:latest'
+
+
+def _model_names(response) -> Set[str]:
+    return {model_key(item.get('model') or item.get('name') or '') for item in response['models']}
+
+
+class Backend:
+    """一个ollama主机"""
+
+    def __init__(self, url: Optional[str], models: Optional[List[str]] = None):
+        self.url = url
+        self.name = url or DEFAULT_BACKEND
+        # 配置中指定的模型，None表示按 /api/tags 判断
+        self.models: Optional[Set[str]] = {model_key(model) for model in models} if models else None
+        # url为None时ollama客户端读取OLLAMA_HOST，与原有行为一致
+        self.client = HostClient(host=url)
+        self.breaker = CircuitBreaker(self.name)
+        self.healthy = True
+        self.draining = False
+        self.available: Optional[Set[str]] = None
+        self.resident: Set[str] = set()
+        self.outstanding = 0
+        self.failures = 0
+        self.checked = False
+        self.last_leased = 0.0
+        self.last_error: Optional[str] = None
+        self.requests = 0
+
+    def chat(self, timeout=httpx.USE_CLIENT_DEFAULT, call: Optional[LiveCall] = None, **kwargs):
+        """在该主机上调用ollama.chat，timeout为读取超时（秒），流式调用时为相邻两块之间的最长间隔；
+        不指定时使用客户端的默认超时，None为不限。call为LiveCall时可以从其他线程中止这次调用"""
+        return self.client.with_timeout(timeout, 'chat', call=call, **kwargs)
+
+    def embed(self, timeout=httpx.USE_CLIENT_DEFAULT, **kwargs):
+        """在该主机上调用ollama.embed，timeout为整个响应的超时（秒）；不指定时使用客户端的默认超时"""
+        return self.client.with_timeout(timeout, 'embed', **kwargs)
+
+    def serves(self, model: str) -> bool:
+        key = model_key(model)
+        if self.models is not None:
+            return key in self.models
+        return self.available is None or key in self.available
+
+    def is_resident(self, model: str) -> bool:
+        return model_key(model) in self.resident
+
+    def status(self) -> str:
+        if self.draining:
+            return '排空中' if self.outstanding else '已排空'
+        if not self.healthy:
+            return '不可用'
+        return '熔断' if self.breaker.state == 'open' else '健康'
+
+
+class BackendPool:
+    """多台ollama主机组成的后端池
+
+    每次vision或数学调用通过 lease(model) 选择主机：在健康、未排空并且提供该模型的主机中，
+    优先选模型已驻留内存（/api/ps）的，再选在途请求最少的（least outstanding requests），
+    避免把请求发到需要冷加载模型的主机。后台线程每 OLLAMA_HEALTH_INTERVAL 秒对每台主机
+    请求 /api/ps（并刷新 /api/tags），连续失败 OLLAMA_UNHEALTHY_AFTER 次即摘除，恢复后自动加回；
+    调用时连接失败的主机立即摘除。每台主机还有一个熔断器（见 resilience.CircuitBreaker），
+    连续超时或5xx的主机在冷却期内不再被选中。drain() 让主机不再接收新请求，在途请求完成后即可下线。
+
+    用法::
+
+        with get_backend_pool().lease(model) as backend:
+            response = backend.chat(model=model, messages=messages)
+    """
+
+    def __init__(self, backends: List[Backend], health_interval: float = OLLAMA_HEALTH_INTERVAL,
+                 drain_file: str = OLLAMA_DRAIN_FILE):
+        if not backends:
+            raise ValueError('后端池至少需要一个ollama地址')
+        self.backends = backends
+        self.drain_file = drain_file
+        self._condition = threading.Condition()
+        self._stopped = threading.Event()
+        for backend in backends:
+            self._export(backend)
+        # 单主机时没有可选的，不做健康检查
+        if len(backends) > 1 and health_interval > 0:
+            self.check_all()
+            threading.Thread(target=self._health_loop, args=(health_interval,), name='ollama-health',
+                             daemon=True).start()
+
+    def get(self, name: str) -> Backend:
+        for backend in self.backends:
+            if name in (backend.name, backend.url):
+                return backend
+        raise KeyError(f'后端池中没有 {name}')
+
+    def choose(self, model: str, exclude=()) -> Backend:
+        """选择处理该模型的主机并计入在途请求，调用结束后必须调用release
+
+        exclude中的主机不参与选择，对冲请求用它避开第一次请求所在的主机。
+        """
+        with self._condition:
+            candidates = [backend for backend in self.backends
+                          if backend.healthy and not backend.draining and backend.serves(model)
+                          and backend.breaker.available() and backend not in exclude]
+            if not candidates:
+                raise NoBackendAvailable(f"没有可用的ollama后端提供 {model}：{self.report()}")
+            resident = [backend for backend in candidates if backend.is_resident(model)]
+            # 在途请求数相同时选最久没用过的，空闲时请求轮流分到各主机
+            backend = min(resident or candidates, key=lambda b: (b.outstanding, b.last_leased))
+            backend.outstanding += 1
+            backend.requests += 1
+            backend.last_leased = time.monotonic()
+            backend.breaker.on_lease()
+        BACKEND_REQUESTS.inc(backend=backend.name, model=model)
+        self._export(backend)
+        return backend
+
+    def release(self, backend: Backend, model: str, error: Optional[BaseException] = None):
+        with self._condition:
+            backend.outstanding -= 1
+            if error is None:
+                # 调用成功后模型一定已加载，不必等下一次 /api/ps
+                backend.resident.add(model_key(model))
+            self._condition.notify_all()
+        if isinstance(error, CONNECTION_ERRORS):
+            self._mark_unhealthy(backend, str(error))
+        state = backend.breaker.record(error)
+        if state == 'open':
+            print(f"⛔ 后端 {backend.name} 连续失败，熔断 {backend.breaker.cooldown:.0f} 秒: {error}")
+        elif state == 'closed':
+            print(f"🔌 后端 {backend.name} 试探请求成功，熔断解除")
+        self._export(backend)
+        if backend.draining and backend.outstanding == 0:
+            print(f"✅ 后端 {backend.name} 已排空，可以下线")
+
+    @contextmanager
+    def lease(self, model: str, exclude=()) -> Iterator[Backend]:
+        """为一次模型调用选择主机，调用结束（包括出错、提前关闭流）时归还"""
+        backend = self.choose(model, exclude)
+        error = None
+        try:
+            yield backend
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            self.release(backend, model, error if isinstance(error, Exception) else None)
+
+    def check(self, backend: Backend):
+        """对一台主机做一次健康检查，刷新驻留模型和可用模型"""
+        client = ollama.Client(host=backend.url, timeout=OLLAMA_HEALTH_TIMEOUT)
+        try:
+            resident = _model_names(client.ps())
+            available = _model_names(client.list()) if backend.models is None else None
+        except Exception as e:
+            with self._condition:
+                backend.failures += 1
+                backend.last_error = str(e)
+                # 启动时就连不上的主机不等多次失败，直接摘除
+                unhealthy = not backend.checked or backend.failures >= OLLAMA_UNHEALTHY_AFTER
+                backend.checked = True
+            if unhealthy:
+                self._mark_unhealthy(backend, str(e))
+            return
+        with self._condition:
+            recovered = not backend.healthy
+            backend.checked = True
+            backend.healthy = True
+            backend.failures = 0
+            backend.last_error = None
+            backend.resident = resident
+            if available is not None:
+                backend.available = available
+        self._export(backend)
+        if recovered:
+            print(f"💚 后端 {backend.name} 已恢复，驻留模型: {', '.join(sorted(resident)) or '无'}")
+
+    def check_all(self):
+        self._apply_drain_file()
+        for backend in self.backends:
+            self.check(backend)
+
+    def _health_loop(self, interval: float):
+        while not self._stopped.wait(interval):
+            self.check_all()
+
+    def _mark_unhealthy(self, backend: Backend, error: str):
+        with self._condition:
+            was_healthy = backend.healthy
+            backend.healthy = False
+            backend.last_error = error
+        self._export(backend)
+        if was_healthy:
+            print(f"💔 后端 {backend.name} 不可用，暂时摘除: {error}")
+
+    def _apply_drain_file(self):
+        if not self.drain_file:
+            return
+        try:
+            with open(self.drain_file, 'r', encoding='utf-8') as f:
+                names = {line.strip() for line in f if line.strip() and not line.startswith('#')}
+        except FileNotFoundError:
+            names = set()
+        for backend in self.backends:
+            draining = backend.name in names or backend.url in names
+            if draining and not backend.draining:
+                self.drain(backend.name)
+            elif not draining and backend.draining:
+                self.undrain(backend.name)
+
+    def drain(self, name: str):
+        """主机不再接收新请求，在途请求照常完成"""
+        backend = self.get(name)
+        with self._condition:
+            backend.draining = True
+        self._export(backend)
+        print(f"🚰 开始排空后端 {backend.name}，在途请求 {backend.outstanding} 个")
+
+    def undrain(self, name: str):
+        backend = self.get(name)
+        with self._condition:
+            backend.draining = False
+        self._export(backend)
+        print(f"↩️ 后端 {backend.name} 重新接收请求")
+
+    def wait_drained(self, name: str, timeout: Optional[float] = None) -> bool:
+        """等待排空中的主机完成在途请求，超时返回False"""
+        backend = self.get(name)
+        with self._condition:
+            return self._condition.wait_for(lambda: backend.outstanding == 0, timeout)
+
+    def close(self):
+        self._stopped.set()
+
+    def _export(self, backend: Backend):
+        BACKEND_HEALTHY.set(1 if backend.healthy else 0, backend=backend.name)
+        BACKEND_DRAINING.set(1 if backend.draining else 0, backend=backend.name)
+        BACKEND_OUTSTANDING.set(backend.outstanding, backend=backend.name)
+        BACKEND_CIRCUIT_OPEN.set(1 if backend.breaker.state == 'open' else 0, backend=backend.name)
+
+    def report(self) -> str:
+        return '；'.join(
+            f"{backend.name} {backend.status()} 在途 {backend.outstanding} "
+            f"驻留 [{', '.join(sorted(backend.resident))}]"
+            for backend in self.backends
+        )
+
+
+def parse_backends(spec: str) -> List[Backend]:
+    """解析OLLAMA_BACKENDS格式的配置"""
+    backends = []
+    for entry in spec.split(','):
+        entry = entry.strip()
+        if not entry:
+            continue
+        url, _, models = entry.partition('=')
+        backends.append(Backend(url.strip(), [model.strip() for model in models.split('|') if model.strip()]))
+    return backends
+
+
+_default_pool = None
+_default_pool_lock = threading.Lock()
+
+
+def get_backend_pool() -> BackendPool:
+    """获取进程内共享的后端池"""
+    global _default_pool
+    with _default_pool_lock:
+        if _default_pool is None:
+            backends = parse_backends(OLLAMA_BACKENDS) or [Backend(os.environ.get('OLLAMA_HOST'))]
+            _default_pool = BackendPool(backends)
+            if len(backends) > 1:
+                print(f"🖧 ollama后端池: {_default_pool.report()}")
+        return _default_pool
+
+
+def main():
+    parser = argparse.ArgumentParser(description='检查ollama后端池中各主机的健康状态和驻留模型')
+    parser.add_argument('backends', nargs='?', default=OLLAMA_BACKENDS, help='格式同OLLAMA_BACKENDS')
+    args = parser.parse_args()
+
+    backends = parse_backends(args.backends)
+    if not backends:
+        parser.error('请提供后端地址或设置OLLAMA_BACKENDS')
+    pool = BackendPool(backends, health_interval=0)
+    pool.check_all()
+    for backend in pool.backends:
+        models = backend.models if backend.models is not None else backend.available
+        print(f"{backend.name}: {backend.status()} | 可用模型: {', '.join(sorted(models or [])) or '-'} | "
+              f"驻留: {', '.join(sorted(backend.resident)) or '-'}"
+              + (f" | 错误: {backend.last_error}" if backend.last_error else ''))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,208 @@
+import os
+import json
+import time
+import argparse
+import threading
+from concurrent.futures import Future
+from typing import Callable, Dict, Iterator, List, Set
+
+from solution_cache import normalize_problem_text
+from solver_core import fast_path_fraction, recognize_image_detailed, solve_problem
+from solver_metrics import start_metrics_server
+from staged_pipeline import StagedPipeline
+from worksheet_layout import recognize_worksheet
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.webp')
+
+
+def iter_tasks(source: str) -> Iterator[Dict]:
+    """从目录或JSONL清单读取待处理图片
+
+    清单每行一个JSON对象，必须包含image字段，可选id字段（默认取图片路径）。
+    """
+    if os.path.isdir(source):
+        for root, _, files in os.walk(source):
+            for name in sorted(files):
+                if name.lower().endswith(IMAGE_EXTENSIONS):
+                    path = os.path.join(root, name)
+                    yield {'id': path, 'image': path}
+        return
+
+    base_dir = os.path.dirname(os.path.abspath(source))
+    with open(source, 'r', encoding='utf-8') as f:
+        for line_no, line in enumerate(f, start=1):
+            line = line.strip()
+            if not line:
+                continue
+            entry = json.loads(line)
+            if 'image' not in entry:
+                raise ValueError(f"清单第{line_no}行缺少image字段")
+            image = entry['image']
+            if not os.path.isabs(image):
+                image = os.path.join(base_dir, image)
+            yield dict(entry, id=entry.get('id', entry['image']), image=image)
+
+
+def load_completed(output_path: str) -> Set[str]:
+    """读取已成功完成的任务id，用于断点续跑"""
+    completed = set()
+    if not os.path.exists(output_path):
+        return completed
+    with open(output_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # 上次中断时可能留下半行
+                continue
+            if record.get('status') == 'ok':
+                completed.add(record['id'])
+    return completed
+
+
+def build_record(task: Dict, future: Future) -> Dict:
+    """把流水线的结果整理为一条输出记录"""
+    record = {'id': task['id'], 'image': task['image']}
+    error = future.exception()
+    if error is not None:
+        record['status'] = 'error'
+        record['error'] = str(error)
+        return record
+
+    result = future.result()
+    recognition = result['recognition']
+    if 'regions' in recognition:
+        record['regions'] = [
+            {'index': region['index'], 'box': list(region['box']), 'text': region['text'],
+             'handoff': region.get('handoff')}
+            for region in recognition['regions']
+        ]
+    else:
+        record['tier'] = recognition['tier']
+        record['recognition_source'] = recognition['source']
+        record['handoff'] = recognition.get('handoff')
+    record['recognized_text'] = result['recognized_text']
+    record['answer'] = result['answer']
+    for key in ('vision_seconds', 'math_seconds', 'vision_queue_wait_seconds',
+                'math_queue_wait_seconds', 'total_seconds'):
+        record[key] = result.get(key)
+    record['status'] = 'ok'
+    return record
+
+
+class BatchDeduplicator:
+    """同一批次中规范化后相同的题目只解一次
+
+    第一个遇到某道题的解题线程调用模型，之后的相同题目等待并复用它的结果；
+    出错时不保留结果，下一个相同题目会重新尝试。
+    """
+
+    def __init__(self, solve: Callable[[str], str] = solve_problem):
+        self._solve = solve
+        self._results: Dict[str, Future] = {}
+        self._lock = threading.Lock()
+        self.duplicates = 0
+
+    def __call__(self, problem_text: str) -> str:
+        key = normalize_problem_text(problem_text)
+        with self._lock:
+            future = self._results.get(key)
+            owner = future is None
+            if owner:
+                future = self._results[key] = Future()
+            else:
+                self.duplicates += 1
+        if not owner:
+            return future.result()
+
+        try:
+            answer = self._solve(problem_text)
+        except Exception as e:
+            with self._lock:
+                del self._results[key]
+            future.set_exception(e)
+            raise
+        future.set_result(answer)
+        return answer
+
+
+def run_batch(source: str, output_path: str, concurrency: int = 4, math_workers: int = 2,
+              worksheet: bool = False) -> Dict:
+    """批量解题，结果逐条追加写入JSONL，已完成的图片在重跑时跳过
+
+    识别和解题通过StagedPipeline流水线执行：concurrency为识别阶段的线程数，
+    math_workers为解题阶段的线程数。批次内规范化后相同的题目只调用一次数学模型。
+    """
+    completed = load_completed(output_path)
+    tasks: List[Dict] = [task for task in iter_tasks(source) if task['id'] not in completed]
+    print(f"📚 共 {len(tasks) + len(completed)} 张图片，已完成 {len(completed)} 张，本次处理 {len(tasks)} 张")
+
+    deduplicator = BatchDeduplicator()
+    pipeline = StagedPipeline(
+        vision_workers=concurrency,
+        math_workers=math_workers,
+        queue_size=concurrency * 2,
+        vision_fn=recognize_worksheet if worksheet else recognize_image_detailed,
+        math_fn=deduplicator,
+    )
+    write_lock = threading.Lock()
+    # 回调在Future完成后才执行，必须等所有结果写盘后再关闭文件
+    all_written = threading.Event()
+    stats = {'ok': 0, 'error': 0}
+    started = time.time()
+
+    output_dir = os.path.dirname(os.path.abspath(output_path))
+    os.makedirs(output_dir, exist_ok=True)
+    with open(output_path, 'a', encoding='utf-8') as out:
+        def on_done(task, future):
+            record = build_record(task, future)
+            with write_lock:
+                out.write(json.dumps(record, ensure_ascii=False) + '\n')
+                out.flush()
+                # 每条结果落盘即为检查点，中断后从这里续跑
+                os.fsync(out.fileno())
+                stats[record['status']] += 1
+                done = stats['ok'] + stats['error']
+                if done == len(tasks):
+                    all_written.set()
+            print(f"[{done}/{len(tasks)}] {'✅' if record['status'] == 'ok' else '❌'} {record['id']} "
+                  f"| {pipeline.format_stats()}")
+
+        for task in tasks:
+            # 识别队列满时这里会阻塞，避免一次性把所有图片读进内存
+            future = pipeline.submit(task['image'])
+            future.add_done_callback(lambda f, task=task: on_done(task, f))
+        if tasks:
+            all_written.wait()
+    pipeline.shutdown()
+
+    elapsed = time.time() - started
+    stats['elapsed_seconds'] = round(elapsed, 3)
+    stats['images_per_minute'] = round((stats['ok'] + stats['error']) / elapsed * 60, 2) if elapsed > 0 else 0.0
+    stats['duplicate_problems'] = deduplicator.duplicates
+    stats['fast_path_fraction'] = round(fast_path_fraction(), 4)
+    print(f"🏁 完成 {stats['ok']} 张，失败 {stats['error']} 张，耗时 {elapsed:.1f}s，"
+          f"吞吐 {stats['images_per_minute']} 张/分钟，重复题目 {deduplicator.duplicates} 道，"
+          f"SymPy本地求解占比 {stats['fast_path_fraction']:.1%}")
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description='批量识别并解答数学题目图片')
+    parser.add_argument('source', help='图片目录或JSONL清单（每行包含image字段）')
+    parser.add_argument('-o', '--output', default='batch_results.jsonl', help='结果JSONL文件，同时作为断点续跑的检查点')
+    parser.add_argument('-c', '--concurrency', type=int, default=4, help='识别阶段并发处理的图片数')
+    parser.add_argument('-m', '--math-workers', type=int, default=2, help='解题阶段的并发数')
+    parser.add_argument('--worksheet', action='store_true', help='按整页习题切分题目区域后识别')
+    parser.add_argument('--metrics-port', type=int, default=0, help='在该端口暴露Prometheus指标（/metrics）')
+    args = parser.parse_args()
+
+    if args.metrics_port:
+        start_metrics_server(args.metrics_port)
+
+    run_batch(args.source, args.output, concurrency=args.concurrency, math_workers=args.math_workers,
+              worksheet=args.worksheet)
+
+
+if __name__ == "__main__":
+    main()
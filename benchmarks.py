@@ -0,0 +1,347 @@
+import os
+import sys
+import copy
+import json
+import time
+import platform
+import argparse
+import importlib
+import importlib.util
+import statistics
+import subprocess
+import tracemalloc
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+SAMPLE_IMAGES = ['first.png', 'second.png', 'third.png', 'example.png']
+# 合成大图：手机拍摄的整页作业常见尺寸
+LARGE_IMAGE_SIZE = (3024, 4032)
+
+_BENCHMARKS: List[Dict] = []
+
+
+def benchmark(name: str, requires: tuple = ()):
+    """登记一个基准测试：被装饰的函数做准备工作，返回待计时的无参函数"""
+    def register(setup: Callable):
+        _BENCHMARKS.append({'name': name, 'setup': setup, 'requires': requires})
+        return setup
+    return register
+
+
+def _missing(modules: tuple) -> Optional[str]:
+    for module in modules:
+        if importlib.util.find_spec(module) is None:
+            return module
+    return None
+
+
+def synthetic_large_image() -> Image.Image:
+    """固定随机种子生成带噪点和公式文字的大图，保证每次运行的输入相同"""
+    rng = np.random.default_rng(2024)
+    width, height = LARGE_IMAGE_SIZE
+    noise = rng.normal(235, 12, size=(height, width, 3)).clip(0, 255).astype(np.uint8)
+    image = Image.fromarray(noise, 'RGB')
+    draw = ImageDraw.Draw(image)
+    for row in range(40):
+        draw.text((200, 150 + row * 95), f'{row + 1}. 2x + {row}y = {row * 3 + 7},  x - y = {row % 5}', fill=(20, 20, 20))
+    return image
+
+
+def sample_image_path() -> str:
+    return next(path for path in SAMPLE_IMAGES if os.path.exists(path))
+
+
+def _load_module(name: str, path: str):
+    """按文件路径导入模块（qwen-agent-sample.py这类文件名不能直接import）"""
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def _dict_messages(image: str, turns: int = 6) -> List[Dict]:
+    """模拟WebUI的多轮对话消息，最后一条带图片"""
+    messages = []
+    for index in range(turns):
+        messages.append({'role': 'user', 'content': [{'text': f'第{index}题：请解方程 x + {index} = {index * 2}'}]})
+        messages.append({'role': 'assistant', 'content': '解：' + '步骤。' * 200})
+    messages.append({'role': 'user', 'content': [{'text': '请识别图片中的数学题'}, {'image': image}]})
+    return messages
+
+
+def _qwen_messages(image: str, turns: int = 6):
+    from qwen_agent.llm.schema import ContentItem, Message
+    messages = []
+    for message in _dict_messages(image, turns):
+        content = message['content']
+        if isinstance(content, list):
+            content = [ContentItem(**item) for item in content]
+        messages.append(Message(role=message['role'], content=content))
+    return messages
+
+
+def _base64_image() -> str:
+    from solver_core import encode_pil_image
+    return 'data:image/png;base64,' + encode_pil_image(Image.open(sample_image_path()))
+
+
+# ---- 图像编码 ----
+
+@benchmark('encode_pil_image[sample]')
+def _():
+    from solver_core import encode_pil_image
+    image = Image.open(sample_image_path())
+    image.load()
+    return lambda: encode_pil_image(image)
+
+
+@benchmark('encode_pil_image[large]')
+def _():
+    from solver_core import encode_pil_image
+    image = synthetic_large_image()
+    return lambda: encode_pil_image(image)
+
+
+@benchmark('encode_image_as_base64[sample]', requires=('qwen_agent',))
+def _():
+    from qwen_agent.utils.utils import encode_image_as_base64
+    path = sample_image_path()
+    return lambda: encode_image_as_base64(path)
+
+
+@benchmark('wire_payload[sample]')
+def _():
+    from image_transport import wire_payload
+    path = sample_image_path()
+    return lambda: wire_payload(path)
+
+
+@benchmark('encode_smallest[large]')
+def _():
+    from image_transport import encode_smallest
+    image = synthetic_large_image()
+    return lambda: encode_smallest(image)
+
+
+@benchmark('prepare_for_vision[large,low]')
+def _():
+    from image_preprocess import RESOLUTION_TIERS, prepare_for_vision
+    image = synthetic_large_image()
+    return lambda: prepare_for_vision(image, RESOLUTION_TIERS[0][1])
+
+
+@benchmark('image_fingerprint[large]')
+def _():
+    from solver_core import image_fingerprint
+    image = synthetic_large_image()
+    return lambda: image_fingerprint(image, image)
+
+
+# ---- 消息转换与复制 ----
+
+@benchmark('OllamaLLM._to_ollama_messages', requires=('qwen_agent',))
+def _():
+    module = _load_module('qwen_agent_sample', 'qwen-agent-sample.py')
+    llm = module.OllamaLLM(module.llm_config)
+    messages = _qwen_messages(sample_image_path())
+    return lambda: llm._to_ollama_messages(messages)
+
+
+@benchmark('OllamaVisionLLM._build_request', requires=('qwen_agent',))
+def _():
+    from math_solver_agent import VISION_MODEL_CONFIG, OllamaVisionLLM
+    llm = OllamaVisionLLM(VISION_MODEL_CONFIG)
+    messages = _qwen_messages(sample_image_path())
+    return lambda: llm._build_request(messages)
+
+
+@benchmark('deepcopy(messages)[path]')
+def _():
+    messages = _dict_messages(sample_image_path())
+    return lambda: copy.deepcopy(messages)
+
+
+@benchmark('deepcopy(messages)[base64]')
+def _():
+    messages = _dict_messages(_base64_image())
+    return lambda: copy.deepcopy(messages)
+
+
+@benchmark('deepcopy(qwen Message)[base64]', requires=('qwen_agent',))
+def _():
+    messages = _qwen_messages(_base64_image())
+    return lambda: copy.deepcopy(messages)
+
+
+# ---- 调用封装的开销（对接不计延迟的模拟ollama，只剩Python侧开销） ----
+
+def _instant_mock_host() -> str:
+    from mock_ollama import load_profile, start_mock_server
+    profile = load_profile()
+    profile['num_parallel'] = 8
+    profile['models'].setdefault('qwen:latest', {'response': profile['models']['qwen2:latest']['response']})
+    for model in profile['models'].values():
+        model.update(prefill_tokens_per_second=1e12, decode_tokens_per_second=1e12, cold_load_seconds=0)
+    server, _ = start_mock_server(0, profile=profile)
+    return f'http://127.0.0.1:{server.server_address[1]}'
+
+
+_mock_host = None
+
+
+def _mock_client():
+    global _mock_host
+    import ollama
+    if _mock_host is None:
+        _mock_host = _instant_mock_host()
+    return ollama.Client(host=_mock_host)
+
+
+@benchmark('ollama.chat[direct]')
+def _():
+    client = _mock_client()
+    messages = [{'role': 'user', 'content': '请详细解答以下数学问题：x + 1 = 2'}]
+    return lambda: client.chat(model='qwen2:latest', messages=messages)
+
+
+@benchmark('Assistant.run[OllamaLLM]', requires=('qwen_agent',))
+def _():
+    from qwen_agent.agents import Assistant
+    from qwen_agent.llm.schema import Message
+    module = _load_module('qwen_agent_sample', 'qwen-agent-sample.py')
+    # OllamaLLM和ChatStream经过后端池，单主机模式的客户端按OLLAMA_HOST连接，这里指向模拟服务
+    _mock_client()
+    os.environ['OLLAMA_HOST'] = _mock_host
+    assistant = Assistant(llm=module.OllamaLLM(module.llm_config_2))
+    messages = [Message(role='user', content='请详细解答以下数学问题：x + 1 = 2')]
+    return lambda: list(assistant.run(messages))
+
+
+def measure(fn: Callable, repeat: int, min_seconds: float) -> Dict:
+    """计时并统计分配：先预热一次，至少运行repeat次或min_seconds秒；再单独在tracemalloc下运行一次"""
+    fn()
+    timings = []
+    started = time.perf_counter()
+    while len(timings) < repeat or time.perf_counter() - started < min_seconds:
+        begin = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - begin)
+        if len(timings) >= repeat * 100:
+            break
+
+    # tracemalloc开销大，与计时分开运行
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    blocks_before = sys.getallocatedblocks()
+    baseline = tracemalloc.get_traced_memory()[0]
+    result = fn()
+    current, peak = tracemalloc.get_traced_memory()
+    blocks_after = sys.getallocatedblocks()
+    tracemalloc.stop()
+    del result
+
+    return {
+        'runs': len(timings),
+        'min_ms': round(min(timings) * 1e3, 4),
+        'median_ms': round(statistics.median(timings) * 1e3, 4),
+        'mean_ms': round(statistics.fmean(timings) * 1e3, 4),
+        'stdev_ms': round(statistics.stdev(timings) * 1e3, 4) if len(timings) > 1 else 0.0,
+        'peak_bytes': peak - baseline,
+        'retained_bytes': current - baseline,
+        'retained_blocks': blocks_after - blocks_before,
+    }
+
+
+def _git_revision() -> Optional[str]:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except Exception:
+        return None
+
+
+def run_benchmarks(pattern: str = '', repeat: int = 20, min_seconds: float = 0.5, label: str = '') -> Dict:
+    results = {}
+    for entry in _BENCHMARKS:
+        name = entry['name']
+        if pattern and pattern not in name:
+            continue
+        missing = _missing(entry['requires'])
+        if missing:
+            results[name] = {'skipped': f'未安装 {missing}'}
+            print(f"⏭️  {name}: 跳过（未安装 {missing}）")
+            continue
+        try:
+            results[name] = measure(entry['setup'](), repeat, min_seconds)
+        except Exception as e:
+            results[name] = {'error': str(e)}
+            print(f"❌ {name}: {e}")
+            continue
+        result = results[name]
+        print(f"⏱️  {name}: 中位数 {result['median_ms']}ms，峰值内存 {result['peak_bytes'] / 1024:.1f}KB "
+              f"（{result['runs']} 次）")
+    return {
+        'meta': {
+            'label': label,
+            'git_revision': _git_revision(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        },
+        'results': results,
+    }
+
+
+def compare(paths: List[str]) -> str:
+    """并排对比多个结果文件的中位耗时和峰值内存"""
+    runs = []
+    for path in paths:
+        with open(path, 'r', encoding='utf-8') as f:
+            runs.append(json.load(f))
+    names = []
+    for run in runs:
+        names.extend(name for name in run['results'] if name not in names)
+    labels = [run['meta'].get('label') or os.path.basename(path) for run, path in zip(runs, paths)]
+    lines = [f"{'':<36}" + ''.join(f"{label[:24]:>26}" for label in labels)]
+    for name in names:
+        row = f"{name[:36]:<36}"
+        for run in runs:
+            result = run['results'].get(name, {})
+            if 'median_ms' in result:
+                cell = f"{result['median_ms']}ms/{result['peak_bytes'] / 1024:.0f}KB"
+            else:
+                cell = '-'
+            row += f"{cell:>26}"
+        lines.append(row)
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Python侧热点路径的微基准测试')
+    parser.add_argument('-k', '--filter', default='', help='只运行名称包含该字符串的测试')
+    parser.add_argument('-n', '--repeat', type=int, default=20, help='每项至少运行的次数')
+    parser.add_argument('--min-seconds', type=float, default=0.5, help='每项至少运行的秒数')
+    parser.add_argument('--label', default='', help='本次结果的标签，例如求解器变体名称')
+    parser.add_argument('-o', '--output', default='benchmark_results.json', help='结果JSON文件')
+    parser.add_argument('--compare', nargs='+', metavar='RESULT', help='对比多个结果文件后退出')
+    parser.add_argument('--list', action='store_true', help='列出所有测试')
+    args = parser.parse_args()
+
+    if args.compare:
+        print(compare(args.compare))
+        return
+    if args.list:
+        for entry in _BENCHMARKS:
+            print(entry['name'])
+        return
+
+    report = run_benchmarks(args.filter, args.repeat, args.min_seconds, args.label)
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"💾 结果已保存到 {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,218 @@
+import os
+import time
+import threading
+import contextvars
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, Optional, Set, Tuple
+
+from solver_metrics import CANCELLED_GENERATIONS, CANCEL_SAVED_SECONDS
+
+# 每个界面请求从提交到完成（包括排队）的截止时间（秒），0表示不限
+REQUEST_DEADLINE = float(os.environ.get('REQUEST_DEADLINE', '300'))
+# 估计被取消的生成还要多久时，完整生成耗时滑动平均的权重
+GENERATION_TIME_ALPHA = 0.2
+
+_current = contextvars.ContextVar('cancel_token', default=None)
+
+
+class Cancelled(Exception):
+    """请求已被取消或超过截止时间"""
+
+    def __init__(self, reason: str = 'cancelled'):
+        self.reason = reason
+        super().__init__('请求已取消' if reason == 'cancelled' else '请求超过截止时间')
+
+
+class CancelToken:
+    """一个请求的取消令牌：截止时间加上可以从任意线程触发的取消
+
+    进行中的模型调用通过 abort_on_cancel 在取消时立即中止HTTP请求（包括等待首token和两块之间的停顿），
+    ollama随即停止生成；等待中的调用方（请求合并的订阅者等）通过 on_cancel 注册的回调被唤醒。
+    截止时间到达时在下一次检查时取消，不单独起定时线程；单次调用的超时不超过截止时间，阻塞的调用届时超时。
+    """
+
+    def __init__(self, deadline: Optional[float] = None):
+        self.deadline = time.monotonic() + deadline if deadline else None
+        self.reason: Optional[str] = None
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    @property
+    def cancelled(self) -> bool:
+        if self.reason is None and self.deadline is not None and time.monotonic() >= self.deadline:
+            self.cancel('deadline')
+        return self.reason is not None
+
+    def remaining(self) -> Optional[float]:
+        """距截止时间的秒数，没有截止时间时为None"""
+        if self.deadline is None:
+            return None
+        return max(self.deadline - time.monotonic(), 0.0)
+
+    def timeout(self, timeout: float) -> float:
+        """把单次调用的超时限制在截止时间以内，已取消时抛出Cancelled"""
+        self.check()
+        remaining = self.remaining()
+        return timeout if remaining is None else min(timeout, max(remaining, 1e-3))
+
+    def check(self):
+        if self.cancelled:
+            raise Cancelled(self.reason)
+
+    def cancel(self, reason: str = 'cancelled'):
+        """取消请求，注册的回调各执行一次；重复取消不做任何事"""
+        with self._lock:
+            if self.reason is not None:
+                return
+            self.reason = reason
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback()
+
+    def on_cancel(self, callback: Callable[[], None]) -> Callable[[], None]:
+        """注册取消时的回调，已取消时立即执行；返回注销回调的函数"""
+        with self._lock:
+            if self.reason is None:
+                self._callbacks.append(callback)
+                return lambda: self._remove(callback)
+        callback()
+        return lambda: None
+
+    def _remove(self, callback: Callable[[], None]):
+        with self._lock:
+            if callback in self._callbacks:
+                self._callbacks.remove(callback)
+
+
+def current_token() -> Optional[CancelToken]:
+    """当前请求的取消令牌，不在请求作用域内时为None"""
+    return _current.get()
+
+
+@contextmanager
+def use_token(token: Optional[CancelToken]):
+    """在当前上下文中使用指定的取消令牌"""
+    reset = _current.set(token)
+    try:
+        yield token
+    finally:
+        _current.reset(reset)
+
+
+def call_timeout(timeout: float) -> float:
+    """按当前请求的截止时间限制单次调用的超时，已取消时抛出Cancelled"""
+    token = _current.get()
+    return timeout if token is None else token.timeout(timeout)
+
+
+@contextmanager
+def abort_on_cancel(call, token: Optional[CancelToken]):
+    """作用域内token被取消时中止call（backend_pool.LiveCall），阻塞在这次请求上的线程随即抛出Cancelled"""
+    if token is None or call is None:
+        yield call
+        return
+    unregister = token.on_cancel(lambda: call.abort(Cancelled(token.reason)))
+    try:
+        yield call
+    finally:
+        unregister()
+
+
+def check_cancelled():
+    """当前请求已取消或超过截止时间时抛出Cancelled"""
+    token = _current.get()
+    if token is not None:
+        token.check()
+
+
+_sessions: Dict[str, Set[CancelToken]] = {}
+_sessions_lock = threading.Lock()
+
+
+def cancellable_iter(iterator: Iterator, session: Optional[str] = None,
+                     token: Optional[CancelToken] = None) -> Iterator:
+    """在取消令牌的作用域内推进流式处理（Gradio生成器等）
+
+    内部生成器的每一步都在设置了令牌的上下文中执行，模型调用据此在取消时关闭连接；
+    每一步之前检查令牌，取消后抛出Cancelled。session为界面会话标识时，cancel_session(session)
+    取消该会话的所有请求；取消时如果生成器正挂起（界面已停止读取），直接关闭它，
+    逐层释放准入槽位、退出请求合并并关闭HTTP连接，不等垃圾回收。
+    """
+    token = token or CancelToken(REQUEST_DEADLINE)
+    steps = _cancellable_steps(iterator, session, token)
+    token.on_cancel(lambda: _close_quietly(steps))
+    return steps
+
+
+def _cancellable_steps(iterator: Iterator, session: Optional[str], token: CancelToken) -> Iterator:
+    context = contextvars.copy_context()
+    context.run(_current.set, token)
+    if session:
+        with _sessions_lock:
+            _sessions.setdefault(session, set()).add(token)
+    try:
+        while True:
+            token.check()
+            try:
+                item = context.run(next, iterator)
+            except StopIteration:
+                return
+            yield item
+    finally:
+        if session:
+            with _sessions_lock:
+                tokens = _sessions.get(session, set())
+                tokens.discard(token)
+                if not tokens:
+                    _sessions.pop(session, None)
+        if hasattr(iterator, 'close'):
+            context.run(iterator.close)
+
+
+def _close_quietly(generator):
+    try:
+        generator.close()
+    except ValueError:
+        # 生成器正在其他线程中执行：其中的模型调用已由 abort_on_cancel 中止，它随即以Cancelled结束
+        pass
+
+
+def cancel_session(session: Optional[str], reason: str = 'cancelled') -> int:
+    """取消某个界面会话中所有进行中的请求，返回取消的请求数"""
+    if not session:
+        return 0
+    with _sessions_lock:
+        tokens = list(_sessions.get(session, ()))
+    for token in tokens:
+        token.cancel(reason)
+    if tokens:
+        print(f"🛑 已取消会话 {session[:8]} 的 {len(tokens)} 个请求")
+    return len(tokens)
+
+
+_generation_seconds: Dict[Tuple[str, str], float] = {}
+_generation_lock = threading.Lock()
+
+
+def record_generation(stage: str, model: str, seconds: float):
+    """记录一次完整生成的耗时，用于估计取消节省的模型时间"""
+    key = (stage, model)
+    with _generation_lock:
+        previous = _generation_seconds.get(key)
+        _generation_seconds[key] = seconds if previous is None else (
+            previous + GENERATION_TIME_ALPHA * (seconds - previous))
+
+
+def record_cancellation(stage: str, model: str, reason: str, elapsed: float) -> Optional[float]:
+    """记录一次被取消的生成，返回估计节省的模型时间（完整生成的平均耗时减去已用时间）
+
+    还没有完整生成的样本时无法估计，返回None。
+    """
+    CANCELLED_GENERATIONS.inc(stage=stage, reason=reason)
+    with _generation_lock:
+        expected = _generation_seconds.get((stage, model))
+    if expected is None:
+        return None
+    saved = max(expected - elapsed, 0.0)
+    CANCEL_SAVED_SECONDS.inc(saved, stage=stage)
+    return saved
@@ -0,0 +1,308 @@
+import os
+import math
+import time
+import asyncio
+import threading
+from collections import deque
+from contextlib import asynccontextmanager, contextmanager
+from typing import Dict, Iterator, Optional, Tuple
+
+from backend_pool import DEFAULT_BACKEND, LiveCall, get_backend_pool
+from cancellation import abort_on_cancel, call_timeout, check_cancelled, current_token
+from resilience import retry_call, stage_timeout
+from solver_metrics import MODEL_CONCURRENCY_LIMIT, MODEL_IN_FLIGHT, MODEL_RTT_SECONDS
+
+# 自适应并发配置，可通过环境变量覆盖；ADAPTIVE_CONCURRENCY=0 关闭，模型调用不再限流
+ADAPTIVE_CONCURRENCY = os.environ.get('ADAPTIVE_CONCURRENCY', '1') != '0'
+ADAPTIVE_INITIAL_LIMIT = int(os.environ.get('ADAPTIVE_INITIAL_LIMIT', '4'))
+ADAPTIVE_MIN_LIMIT = int(os.environ.get('ADAPTIVE_MIN_LIMIT', '1'))
+ADAPTIVE_MAX_LIMIT = int(os.environ.get('ADAPTIVE_MAX_LIMIT', '32'))
+# 短期延迟超过无排队基线的该倍数时开始收缩，容忍prefill长短不一带来的抖动
+ADAPTIVE_RTT_TOLERANCE = float(os.environ.get('ADAPTIVE_RTT_TOLERANCE', '2.0'))
+# 每个样本对上限的调整幅度
+ADAPTIVE_SMOOTHING = 0.2
+# 无排队基线取最近BASELINE_WINDOW个样本的BASELINE_PERCENTILE分位数（比最小值稳定，不受个别极快样本影响），
+# 短期延迟是最近SHORT_WINDOW个样本的均值
+BASELINE_WINDOW = 100
+BASELINE_PERCENTILE = 0.1
+SHORT_WINDOW = 5
+# 调用出错（ollama排队已满、超时、连接失败）时上限乘以该系数
+DROP_BACKOFF = 0.9
+
+
+def queueing_rtt(wall_seconds: float, response) -> float:
+    """从一次非流式调用的墙钟时间中扣除生成和模型加载耗时
+
+    剩下的是排队和prefill时间，不随回答长短变化，ollama开始排队时会明显上升。
+    """
+    if response is None:
+        return wall_seconds
+    excluded = ((response.get('eval_duration') or 0) + (response.get('load_duration') or 0)) / 1e9
+    return max(wall_seconds - excluded, 0.0)
+
+
+class Permit:
+    """一次模型调用占用的并发槽位，调用方在结束前记录延迟样本"""
+
+    def __init__(self, in_flight: int):
+        self.started = time.time()
+        # 占用槽位时的在途调用数，用于判断上限是否被用满
+        self.in_flight = in_flight
+        self.rtt: Optional[float] = None
+        self.failed = False
+
+    def record(self, rtt: float):
+        self.rtt = rtt
+
+    def record_response(self, response):
+        """按非流式响应记录延迟样本"""
+        self.rtt = queueing_rtt(time.time() - self.started, response)
+
+
+class AdaptiveLimiter:
+    """单个后端上单个模型的自适应并发上限（梯度算法，参考Netflix concurrency-limits的Gradient2）
+
+    每次调用结束时记录一个延迟样本（排队 + prefill，见 queueing_rtt），维护短期均值和无排队基线
+    （最近一段样本的低分位数；不用滑动平均，持续排队时平均值会跟着上涨，上限就收不回来）：
+
+    - gradient = clamp(tolerance * 基线 / 短期延迟, 0.5, 1)
+    - 新上限 = 上限 * gradient + (gradient为1时) sqrt(上限)，再按smoothing平滑
+
+    延迟平稳时gradient为1，上限逐步放宽；ollama开始排队、延迟上升时gradient小于1，上限收缩，
+    最终停在延迟曲线的拐点附近。只有在途调用数达到上限一半以上时才允许放宽，
+    空闲时的低延迟不说明更高的并发也能承受。调用出错时上限按DROP_BACKOFF收缩。
+
+    用法::
+
+        with get_limiter(model).acquire() as permit:
+            response = ollama.chat(...)
+            permit.record_response(response)
+    """
+
+    def __init__(self, backend: str, model: str, initial_limit: int = ADAPTIVE_INITIAL_LIMIT,
+                 min_limit: int = ADAPTIVE_MIN_LIMIT, max_limit: int = ADAPTIVE_MAX_LIMIT,
+                 tolerance: float = ADAPTIVE_RTT_TOLERANCE, smoothing: float = ADAPTIVE_SMOOTHING,
+                 enabled: bool = ADAPTIVE_CONCURRENCY):
+        self.backend = backend
+        self.model = model
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.tolerance = tolerance
+        self.smoothing = smoothing
+        self.enabled = enabled
+        self.limit = float(min(max(initial_limit, min_limit), max_limit))
+        self._short = deque(maxlen=SHORT_WINDOW)
+        self._baseline = deque(maxlen=BASELINE_WINDOW)
+        self._in_flight = 0
+        self._condition = threading.Condition()
+        # 异步调用方等待槽位时挂在这里，释放时全部唤醒后重新竞争
+        self._async_waiters = deque()
+        self.stats = {'samples': 0, 'drops': 0, 'peak_in_flight': 0}
+        self._export()
+
+    @property
+    def short_rtt(self) -> Optional[float]:
+        return sum(self._short) / len(self._short) if self._short else None
+
+    @property
+    def baseline_rtt(self) -> Optional[float]:
+        if not self._baseline:
+            return None
+        ordered = sorted(self._baseline)
+        return ordered[int(len(ordered) * BASELINE_PERCENTILE)]
+
+    @property
+    def in_flight(self) -> int:
+        return self._in_flight
+
+    def _try_take(self) -> Optional[Permit]:
+        if self.enabled and self._in_flight >= int(self.limit):
+            return None
+        self._in_flight += 1
+        self.stats['peak_in_flight'] = max(self.stats['peak_in_flight'], self._in_flight)
+        return Permit(self._in_flight)
+
+    @contextmanager
+    def acquire(self, timeout: Optional[float] = None) -> Iterator[Permit]:
+        """占用一个槽位，上限已满时阻塞等待
+
+        最多等待timeout秒，并且不超过当前请求的截止时间：超时抛出TimeoutError，
+        请求被取消或到达截止时间时抛出Cancelled。
+        """
+        give_up_at = None if timeout is None else time.monotonic() + timeout
+        token = current_token()
+        # 等待中的请求被取消时立即唤醒，不等到有槽位释放
+        unregister = token.on_cancel(self._notify_waiters) if token is not None else None
+        try:
+            with self._condition:
+                permit = self._try_take()
+                while permit is None:
+                    self._condition.wait(_remaining_wait(give_up_at))
+                    permit = self._try_take()
+        finally:
+            if unregister is not None:
+                unregister()
+        self._export()
+        try:
+            yield permit
+        except Exception:
+            permit.failed = True
+            raise
+        finally:
+            self._release(permit)
+
+    @asynccontextmanager
+    async def aacquire(self, timeout: Optional[float] = None):
+        """acquire的异步版本，等待槽位时不占用线程"""
+        give_up_at = None if timeout is None else time.monotonic() + timeout
+        loop = asyncio.get_running_loop()
+        token = current_token()
+        unregister = token.on_cancel(self._notify_waiters) if token is not None else None
+        try:
+            while True:
+                with self._condition:
+                    permit = self._try_take()
+                    if permit is not None:
+                        break
+                    waiter = loop.create_future()
+                    self._async_waiters.append((loop, waiter))
+                try:
+                    await asyncio.wait([waiter], timeout=_remaining_wait(give_up_at))
+                finally:
+                    with self._condition:
+                        if (loop, waiter) in self._async_waiters:
+                            self._async_waiters.remove((loop, waiter))
+        finally:
+            if unregister is not None:
+                unregister()
+        self._export()
+        try:
+            yield permit
+        except Exception:
+            permit.failed = True
+            raise
+        finally:
+            self._release(permit)
+
+    def _notify_waiters(self):
+        with self._condition:
+            self._condition.notify_all()
+            waiters = list(self._async_waiters)
+        for loop, waiter in waiters:
+            loop.call_soon_threadsafe(_wake, waiter)
+
+    def _release(self, permit: Permit):
+        with self._condition:
+            self._in_flight -= 1
+            previous = int(self.limit)
+            if permit.failed:
+                self._on_drop()
+            elif permit.rtt is not None:
+                self._on_sample(permit.rtt, permit.in_flight)
+            changed = int(self.limit) != previous
+            self._condition.notify_all()
+            waiters = list(self._async_waiters)
+            self._async_waiters.clear()
+        for loop, waiter in waiters:
+            loop.call_soon_threadsafe(_wake, waiter)
+        self._export()
+        if changed:
+            print(f"📶 {self.report()}")
+
+    def _on_sample(self, rtt: float, in_flight: int):
+        self.stats['samples'] += 1
+        self._short.append(rtt)
+        self._baseline.append(rtt)
+        short_rtt = self.short_rtt
+        if not self.enabled or short_rtt <= 0:
+            return
+        gradient = max(0.5, min(1.0, self.tolerance * self.baseline_rtt / short_rtt))
+        # 只在延迟平稳且上限被用到一半以上时放宽
+        headroom = math.sqrt(self.limit) if gradient >= 1.0 and in_flight * 2 >= self.limit else 0.0
+        target = self.limit * gradient + headroom
+        self._set_limit(self.limit * (1 - self.smoothing) + target * self.smoothing)
+
+    def _on_drop(self):
+        self.stats['drops'] += 1
+        if self.enabled:
+            self._set_limit(self.limit * DROP_BACKOFF)
+
+    def _set_limit(self, limit: float):
+        self.limit = min(max(limit, float(self.min_limit)), float(self.max_limit))
+
+    def _export(self):
+        labels = {'backend': self.backend, 'model': self.model}
+        MODEL_CONCURRENCY_LIMIT.set(int(self.limit), **labels)
+        MODEL_IN_FLIGHT.set(self._in_flight, **labels)
+        if self._short:
+            MODEL_RTT_SECONDS.set(round(self.short_rtt, 4), window='short', **labels)
+            MODEL_RTT_SECONDS.set(round(self.baseline_rtt, 4), window='baseline', **labels)
+
+    def report(self) -> str:
+        if not self._short:
+            return f"{self.model}@{self.backend} 并发上限 {int(self.limit)}（处理中 {self._in_flight}），尚无延迟样本"
+        return (f"{self.model}@{self.backend} 并发上限 {int(self.limit)}（处理中 {self._in_flight}），"
+                f"RTT 短期 {self.short_rtt:.3f}s / 基线 {self.baseline_rtt:.3f}s")
+
+
+def _remaining_wait(give_up_at: Optional[float]) -> Optional[float]:
+    """还能等待槽位的秒数（None为不限），取调用方超时和当前请求截止时间中较早的一个
+
+    请求已取消或到达截止时间时抛出Cancelled，调用方超时抛出TimeoutError。
+    """
+    check_cancelled()
+    remaining = None if give_up_at is None else give_up_at - time.monotonic()
+    token = current_token()
+    if token is not None and token.deadline is not None:
+        deadline_remaining = token.deadline - time.monotonic()
+        remaining = deadline_remaining if remaining is None else min(remaining, deadline_remaining)
+    if remaining is not None and remaining <= 0:
+        check_cancelled()
+        raise TimeoutError('等待模型并发槽位超时')
+    return remaining
+
+
+def _wake(waiter: asyncio.Future):
+    if not waiter.done():
+        waiter.set_result(None)
+
+
+_limiters: Dict[Tuple[str, str], AdaptiveLimiter] = {}
+_limiters_lock = threading.Lock()
+
+
+def get_limiter(model: str, backend: str = DEFAULT_BACKEND) -> AdaptiveLimiter:
+    """获取某个后端上某个模型共享的自适应限流器"""
+    key = (backend, model)
+    with _limiters_lock:
+        limiter = _limiters.get(key)
+        if limiter is None:
+            limiter = _limiters[key] = AdaptiveLimiter(backend, model)
+        return limiter
+
+
+def limiters_report() -> str:
+    with _limiters_lock:
+        limiters = list(_limiters.values())
+    return '\n'.join(limiter.report() for limiter in limiters)
+
+
+def limited_chat(stage: str = 'math', **kwargs):
+    """非流式ollama.chat，其余参数与ollama.chat相同
+
+    由后端池选择主机，再经过该主机上该模型的自适应并发限制；单次调用超过该阶段的超时
+    （stage_timeout，不超过当前请求的截止时间）即放弃，超时、连接失败和5xx按带抖动的退避重试，
+    每次重试重新选择主机。请求被取消时立即中止进行中的调用并抛出Cancelled。
+    """
+    model = kwargs.get('model', '')
+
+    def call():
+        with get_backend_pool().lease(model) as backend:
+            with get_limiter(model, backend.name).acquire() as permit:
+                # 请求被取消时立即中止调用，不等模型生成完整的响应
+                with abort_on_cancel(LiveCall(), current_token()) as call:
+                    response = backend.chat(timeout=call_timeout(stage_timeout(stage)), call=call, **kwargs)
+                permit.record_response(response)
+        return response
+
+    return retry_call(call, stage)
@@ -1,55 +1,72 @@
 import os
-import ollama
 import gradio as gr
-import base64
-from io import BytesIO
 from PIL import Image
-import time
+from admission import gradio_concurrency_limit, gradio_queue_size, run_admitted
+from cancellation import Cancelled, cancel_session, cancellable_iter
+from ollama_stream import UpdateThrottle
+from solver_core import stream_recognition, stream_solution
+from solver_metrics import ERRORS, track_solve
+from solver_trace import traced_iter
 
-def encode_pil_image(pil_image):
-    """将PIL图像编码为base64字符串"""
-    buffered = BytesIO()
-    pil_image.save(buffered, format="PNG")
-    return base64.b64encode(buffered.getvalue()).decode('utf-8')
+def solve_math_from_image(image, request: gr.Request):
+    """数学解题函数
 
-def solve_math_from_image(image):
-    """数学解题函数"""
+    识别文本流式显示在处理状态框，解答逐块显示在详细解答框，界面刷新经过节流。
+    请求先经过准入控制，排队时在处理状态框显示排队位置，排队已满时立即提示稍后重试。
+    点击清空或关闭页面时取消该会话的请求，进行中的模型调用随即关闭连接、停止生成；
+    请求超过截止时间（REQUEST_DEADLINE）时同样中止。
+    """
     if image is None:
-        return "请上传包含数学题目的图片"
+        yield "请上传包含数学题目的图片", ""
+        return
     
+    steps = run_admitted(lambda: _tracked_steps(image), queued=lambda message: (message, ""),
+                         busy=lambda message: (message, ""))
     try:
-        # 步骤1：图像识别
+        yield from cancellable_iter(steps, session=request.session_hash)
+    except Cancelled as e:
+        yield f"🛑 {e}", ""
+
+def cancel_request(request: gr.Request):
+    """清空或关闭页面时取消该会话进行中的解题请求"""
+    cancel_session(request.session_hash)
+
+def _tracked_steps(image):
+    with track_solve('enhanced_gradio'):
+        yield from traced_iter('enhanced_gradio', _solve_steps(image))
+
+def _solve_steps(image):
+    """识别并解答，逐步产出 (处理状态, 详细解答)"""
+    try:
+        # 步骤1：图像识别（命中识别缓存时直接得到结果）
         yield "🔍 正在识别图片中的数学内容...", ""
-        time.sleep(0.5)
         
-        base64_image = encode_pil_image(image)
+        throttle = UpdateThrottle()
+        recognition = None
+        for partial_text, recognition in stream_recognition(image):
+            if recognition is None and throttle.ready(partial_text):
+                yield f"🔍 正在识别：\n{partial_text}", ""
         
-        vision_response = ollama.chat(
-            model='granite3.2-vision',
-            messages=[{
-                'role': 'user',
-                'content': '请识别图片中的数学方程式或题目，并转换为清晰的文本格式',
-                'images': [base64_image]
-            }]
-        )
+        recognized_text = recognition['text']
+        status = f"✅ 识别完成：\n{recognized_text}\n\n🧮 正在解答数学问题..."
+        handoff = recognition.get('handoff')
+        if handoff and handoff['saved_seconds']:
+            status += f"（题目识别完整后提前开始解题，节省约 {handoff['saved_seconds']}s）"
+        yield status, ""
         
-        recognized_text = vision_response['message']['content']
-        yield f"✅ 识别完成：\n{recognized_text}\n\n🧮 正在解答数学问题...", ""
-        time.sleep(0.5)
+        # 步骤2：数学解题，解答边生成边显示
+        throttle = UpdateThrottle()
+        final_answer = ""
+        for final_answer in stream_solution(recognized_text):
+            if throttle.ready(final_answer):
+                yield status, final_answer
         
-        # 步骤2：数学解题
-        math_response = ollama.chat(
-            model='qwen2:latest',
-            messages=[{
-                'role': 'user',
-                'content': f"请详细解答以下数学问题：\n{recognized_text}\n\n请提供完整的解题步骤和最终答案。"
-            }]
-        )
-        
-        final_answer = math_response['message']['content']
         yield "✅ 解答完成！", final_answer
         
+    except Cancelled:
+        raise
     except Exception as e:
+        ERRORS.inc(stage='enhanced_gradio')
         yield f"❌ 解题过程中出现错误", f"错误信息：{str(e)}"
 
 # 创建更美观的Gradio界面
@@ -98,17 +115,26 @@ with gr.Blocks(theme=gr.themes.Soft(), title="数学解题智能体") as app:
             )
     
     # 绑定事件
-    solve_btn.click(
+    solve_event = solve_btn.click(
         solve_math_from_image,
         inputs=[image_input],
         outputs=[status_output, result_output]
     )
     
+    # 清空时停止界面更新并取消进行中的请求，模型不再继续生成
+    def clear(request: gr.Request):
+        cancel_request(request)
+        return None, "等待上传图片...", ""
+    
     clear_btn.click(
-        lambda: (None, "等待上传图片...", ""),
-        outputs=[image_input, status_output, result_output]
+        clear,
+        outputs=[image_input, status_output, result_output],
+        cancels=[solve_event]
     )
     
+    # 关闭或刷新页面时同样取消
+    app.unload(cancel_request)
+    
     # 示例功能
     def load_example():
         return gr.Image("example.png"), "📸 已加载示例图片，点击开始解题按钮"
@@ -119,6 +145,8 @@ with gr.Blocks(theme=gr.themes.Soft(), title="数学解题智能体") as app:
     )
 
 if __name__ == "__main__":
+    # Gradio只做转发，排队和拒绝由准入控制负责
+    app.queue(default_concurrency_limit=gradio_concurrency_limit(), max_size=gradio_queue_size())
     app.launch(
         server_name="0.0.0.0",
         server_port=7862,
@@ -1,52 +1,36 @@
 import os
-import ollama
 import gradio as gr
-import base64
-from io import BytesIO
-from PIL import Image
-
-def encode_pil_image(pil_image):
-    """将PIL图像编码为base64字符串"""
-    buffered = BytesIO()
-    pil_image.save(buffered, format="PNG")
-    return base64.b64encode(buffered.getvalue()).decode('utf-8')
+from admission import ServerBusy, get_admission_controller, gradio_concurrency_limit, gradio_queue_size, queue_message, run_admitted
+from solver_core import asolve_problem
+from solver_metrics import track_solve
+from solver_trace import trace_request
+from staged_pipeline import get_pipeline
+from worksheet_layout import arecognize_worksheet
 
 def solve_math_from_image(image):
-    """数学解题函数"""
+    """数学解题函数
+
+    请求先经过准入控制：排队期间在结果框显示排队位置，排队已满时立即提示稍后重试。
+    """
     if image is None:
-        return "请上传图片"
+        yield "请上传图片"
+        return
     
+    yield from run_admitted(lambda: iter([_solve(image)]), queued=lambda message: message,
+                            busy=lambda message: message)
+
+def _solve(image):
     try:
         print("🔍 步骤1: 识别图片中的数学内容...")
         
-        # 将PIL图像编码为base64
-        base64_image = encode_pil_image(image)
-        
-        # 步骤1: 图像识别
-        vision_response = ollama.chat(
-            model='granite3.2-vision',
-            messages=[{
-                'role': 'user',
-                'content': '请识别图片中的数学方程式或题目，并转换为清晰的文本格式',
-                'images': [base64_image]
-            }]
-        )
-        
-        recognized_text = vision_response['message']['content']
-        print(f"✅ 识别结果: {recognized_text}")
-        
-        print("🧮 步骤2: 解答数学问题...")
+        # 提交到共享的两阶段流水线：识别（整页习题切分、识别缓存）和解题分别由独立的工作线程执行，
+        # 多个用户同时提交时，上一张图片解题的同时下一张图片已经在识别
+        pipeline = get_pipeline()
+        result = pipeline.solve(image)
+        print(f"✅ 识别结果: {result['recognized_text']}")
+        print(f"📊 流水线状态: {pipeline.format_stats()}")
         
-        # 步骤2: 数学解题
-        math_response = ollama.chat(
-            model='qwen2:latest',
-            messages=[{
-                'role': 'user',
-                'content': f"请详细解答以下数学问题：\n{recognized_text}\n\n请提供完整的解题步骤和最终答案。"
-            }]
-        )
-        
-        final_answer = math_response['message']['content']
+        final_answer = result['answer']
         return final_answer
         
     except Exception as e:
@@ -54,9 +38,51 @@ def solve_math_from_image(image):
         print(error_msg)
         return error_msg
 
+async def solve_math_from_image_async(image):
+    """数学解题函数（异步版本）
+
+    通过共享的ollama.AsyncClient连接池调用模型，等待模型时不占用工作线程，
+    适合单进程承载大量并发请求。设置环境变量 OLLAMA_ASYNC=1 启用。
+    与同步版本共用准入控制，排队期间同样显示排队位置。
+    """
+    if image is None:
+        yield "请上传图片"
+        return
+    
+    controller = get_admission_controller()
+    try:
+        ticket = controller.enter()
+    except ServerBusy as e:
+        yield f"🚦 {e}"
+        return
+    try:
+        async for position, wait_seconds in controller.await_turn(ticket):
+            yield queue_message(position, wait_seconds)
+        yield await _asolve(image)
+    finally:
+        controller.release(ticket)
+
+async def _asolve(image):
+    try:
+        with track_solve('gradio_async'), trace_request('gradio_async'):
+            print("🔍 步骤1: 识别图片中的数学内容...")
+            recognition = await arecognize_worksheet(image)
+            recognized_text = recognition['text']
+            print(f"✅ 识别结果: {recognized_text}")
+            
+            print("🧮 步骤2: 解答数学问题...")
+            return await asolve_problem(recognized_text)
+        
+    except Exception as e:
+        error_msg = f"解题过程中出现错误: {str(e)}"
+        print(error_msg)
+        return error_msg
+
+USE_ASYNC_BACKEND = os.environ.get('OLLAMA_ASYNC', '0') == '1'
+
 # 创建Gradio界面
 interface = gr.Interface(
-    fn=solve_math_from_image,
+    fn=solve_math_from_image_async if USE_ASYNC_BACKEND else solve_math_from_image,
     inputs=gr.Image(type="pil", label="上传数学题目图片"),
     outputs=gr.Textbox(label="解题结果", lines=15),
     title="数学解题智能体",
@@ -66,7 +92,8 @@ interface = gr.Interface(
 )
 
 if __name__ == "__main__":
-    # 启动Gradio界面
+    # 启动Gradio界面；Gradio只做转发，排队和拒绝由准入控制负责
+    interface.queue(default_concurrency_limit=gradio_concurrency_limit(), max_size=gradio_queue_size())
     interface.launch(
         server_name="0.0.0.0",
         server_port=7862,
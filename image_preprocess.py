@@ -0,0 +1,96 @@
+import re
+import math
+from typing import Optional
+
+import numpy as np
+from PIL import Image
+
+# vision编码器按384x384切片，每片约729个图像token
+TILE_SIZE = 384
+TOKENS_PER_TILE = 729
+
+# 分辨率档位：按图像token预算从低到高逐级升级，None表示原图
+RESOLUTION_TIERS = [
+    ('low', TOKENS_PER_TILE * 2),
+    ('medium', TOKENS_PER_TILE * 6),
+    ('full', None),
+]
+
+# 与背景灰度相差超过该值的像素视为笔迹
+INK_TOLERANCE = 48
+TRIM_PADDING = 16
+
+MATH_PATTERN = re.compile(r'[0-9=+\-*/×÷^√∫∑π<>≤≥≠()\[\]{}]|\\frac|\\sqrt|方程|求|解|计算')
+BRACKET_PAIRS = {')': '(', ']': '[', '}': '{', '）': '（', '】': '【'}
+
+
+def estimate_image_tokens(width: int, height: int) -> int:
+    """估算一张图片占用的图像token数"""
+    return math.ceil(width / TILE_SIZE) * math.ceil(height / TILE_SIZE) * TOKENS_PER_TILE
+
+
+def trim_margins(gray: Image.Image, tolerance: int = INK_TOLERANCE,
+                 padding: int = TRIM_PADDING) -> Image.Image:
+    """裁掉四周的空白边距（以边框像素中位数作为背景色，兼容深色背景），页面全空白时返回原图"""
+    pixels = np.asarray(gray).astype(np.int16)
+    border = np.concatenate([pixels[0], pixels[-1], pixels[:, 0], pixels[:, -1]])
+    background = np.median(border)
+    ink = np.abs(pixels - background) > tolerance
+    rows = np.flatnonzero(ink.any(axis=1))
+    cols = np.flatnonzero(ink.any(axis=0))
+    if rows.size == 0 or cols.size == 0:
+        return gray
+    top = max(0, rows[0] - padding)
+    bottom = min(pixels.shape[0], rows[-1] + padding + 1)
+    left = max(0, cols[0] - padding)
+    right = min(pixels.shape[1], cols[-1] + padding + 1)
+    return gray.crop((int(left), int(top), int(right), int(bottom)))
+
+
+def fit_token_budget(image: Image.Image, token_budget: int) -> Image.Image:
+    """等比缩小图片，使估算的图像token数不超过预算（不放大）"""
+    width, height = image.size
+    if estimate_image_tokens(width, height) <= token_budget:
+        return image
+    tiles = token_budget // TOKENS_PER_TILE
+    scale = math.sqrt(tiles * TILE_SIZE * TILE_SIZE / (width * height))
+    while scale > 0.05:
+        new_size = (max(1, int(width * scale)), max(1, int(height * scale)))
+        if estimate_image_tokens(*new_size) <= token_budget:
+            return image.resize(new_size, Image.LANCZOS)
+        scale *= 0.9
+    return image.resize((TILE_SIZE, TILE_SIZE), Image.LANCZOS)
+
+
+def prepare_for_vision(pil_image: Image.Image, token_budget: Optional[int]) -> Image.Image:
+    """预处理：灰度化、裁边、缩放到token预算；预算为None时原样返回"""
+    if token_budget is None:
+        return pil_image
+    if pil_image.mode in ('RGBA', 'LA', 'P'):
+        # 透明背景直接转灰度会变黑，先铺白底
+        rgba = pil_image.convert('RGBA')
+        background = Image.new('RGBA', rgba.size, (255, 255, 255, 255))
+        pil_image = Image.alpha_composite(background, rgba)
+    gray = trim_margins(pil_image.convert('L'))
+    return fit_token_budget(gray, token_budget)
+
+
+def brackets_balanced(text: str) -> bool:
+    """检查括号是否配对"""
+    stack = []
+    for char in text:
+        if char in '([{（【':
+            stack.append(char)
+        elif char in BRACKET_PAIRS:
+            if not stack or stack.pop() != BRACKET_PAIRS[char]:
+                return False
+    return not stack
+
+
+def looks_like_math(text: str) -> bool:
+    """低成本的识别结果检查：非空、含数学符号、括号配对"""
+    if not text or not text.strip():
+        return False
+    if not MATH_PATTERN.search(text):
+        return False
+    return brackets_balanced(text)
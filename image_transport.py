@@ -0,0 +1,134 @@
+import os
+import base64
+import tracemalloc
+import contextvars
+from io import BytesIO
+from contextlib import contextmanager
+from typing import Optional, Tuple
+
+from PIL import Image, features
+
+# 有损格式的最低质量，保证公式笔画清晰
+LOSSY_QUALITY = int(os.environ.get('WIRE_LOSSY_QUALITY', '85'))
+LOSSY_FORMAT = 'WEBP' if features.check('webp') else 'JPEG'
+# 开启后用tracemalloc统计每个请求的峰值内存（有一定开销，且并发请求会互相计入）
+TRACE_MEMORY = os.environ.get('TRANSPORT_TRACE_MEMORY', '0') == '1'
+
+# 当前请求的传输字节计数；用contextvars同时隔离线程和asyncio任务
+_wire_bytes = contextvars.ContextVar('wire_bytes', default=None)
+
+
+def sniff_format(data: bytes) -> Optional[str]:
+    """根据文件头判断ollama可直接接收的图片格式"""
+    if data.startswith(b'\x89PNG\r\n\x1a\n'):
+        return 'PNG'
+    if data.startswith(b'\xff\xd8\xff'):
+        return 'JPEG'
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'WEBP'
+    return None
+
+
+def original_bytes(image) -> Optional[bytes]:
+    """取出上传图片的原始字节，无法取得或格式不受支持时返回None"""
+    data = None
+    if isinstance(image, Image.Image):
+        # 从文件打开且未被修改的PIL图像可以直接转发原文件
+        filename = getattr(image, 'filename', '')
+        if filename and os.path.exists(filename):
+            with open(filename, 'rb') as f:
+                data = f.read()
+    elif isinstance(image, (bytes, bytearray)):
+        data = bytes(image)
+    else:
+        value = str(image)
+        if value.startswith('file://'):
+            value = value.replace('file://', '')
+        if os.path.exists(value):
+            with open(value, 'rb') as f:
+                data = f.read()
+        else:
+            if value.startswith('data:image/'):
+                value = value.split(',', 1)[1]
+            try:
+                data = base64.b64decode(value, validate=True)
+            except Exception:
+                return None
+    if data is None or sniff_format(data) is None:
+        return None
+    return data
+
+
+def _encode(pil_image: Image.Image, fmt: str) -> bytes:
+    buffered = BytesIO()
+    if fmt == 'PNG':
+        pil_image.save(buffered, format='PNG')
+    else:
+        if pil_image.mode not in ('L', 'RGB'):
+            pil_image = pil_image.convert('RGB')
+        pil_image.save(buffered, format=fmt, quality=LOSSY_QUALITY)
+    return buffered.getvalue()
+
+
+def encode_smallest(pil_image: Image.Image) -> Tuple[bytes, str]:
+    """分别编码为无损PNG和限定质量的有损格式，返回体积较小的一个"""
+    candidates = [(_encode(pil_image, 'PNG'), 'PNG'), (_encode(pil_image, LOSSY_FORMAT), LOSSY_FORMAT)]
+    return min(candidates, key=lambda pair: len(pair[0]))
+
+
+def wire_payload(image, pil_image: Optional[Image.Image] = None) -> bytes:
+    """生成发送给ollama的图片字节
+
+    不需要变换时直接转发原始上传字节；否则编码为PNG/有损格式中较小的一种。
+    返回原始字节而非base64字符串，由ollama客户端在HTTP请求边界编码一次。
+    """
+    data = original_bytes(image)
+    if data is None:
+        if pil_image is None:
+            raise ValueError('无法获取图片数据')
+        data, _ = encode_smallest(pil_image)
+    record_wire_bytes(len(data))
+    return data
+
+
+def record_wire_bytes(size: int):
+    """累计当前请求发送的图片字节数"""
+    counter = _wire_bytes.get()
+    if counter is not None:
+        counter[0] += size
+
+
+@contextmanager
+def track_request():
+    """统计一个请求的图片传输字节数和峰值内存
+
+    用法::
+
+        with track_request() as usage:
+            ...
+        usage['wire_bytes'], usage['base64_bytes'], usage['peak_memory']
+    """
+    usage = {'wire_bytes': 0, 'base64_bytes': 0, 'peak_memory': None}
+    counter = [0]
+    token = _wire_bytes.set(counter)
+    if TRACE_MEMORY:
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+        tracemalloc.reset_peak()
+    try:
+        yield usage
+    finally:
+        _wire_bytes.reset(token)
+        usage['wire_bytes'] = counter[0]
+        # base64后的体积才是HTTP请求体中的实际大小
+        usage['base64_bytes'] = (usage['wire_bytes'] + 2) // 3 * 4
+        if TRACE_MEMORY:
+            usage['peak_memory'] = tracemalloc.get_traced_memory()[1]
+
+
+def format_usage(usage) -> str:
+    """格式化传输统计"""
+    text = f"图像传输 {usage['wire_bytes'] / 1024:.1f}KB (base64后 {usage['base64_bytes'] / 1024:.1f}KB)"
+    if usage['peak_memory'] is not None:
+        text += f", 峰值内存 {usage['peak_memory'] / 1024 / 1024:.1f}MB"
+    return text
@@ -0,0 +1,339 @@
+import os
+import json
+import math
+import time
+import random
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.webp')
+# 仓库自带的示例图片
+DEFAULT_CORPUS = ['first.png', 'second.png', 'third.png', 'example.png']
+REPORT_PERCENTILES = (50, 90, 95, 99, 99.9)
+
+
+class LatencyHistogram:
+    """对数分桶的延迟直方图（HDR风格），相对误差不超过precision
+
+    只保存各桶的计数，记录任意多的样本内存也是常数级；序列化后可以在不同运行之间对比或合并。
+    """
+
+    def __init__(self, precision: float = 0.01, counts: Optional[Dict[int, int]] = None):
+        self.precision = precision
+        self._log_base = math.log1p(precision)
+        self.counts: Dict[int, int] = dict(counts or {})
+        self.total = sum(self.counts.values())
+        self.max = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, seconds: float):
+        # 以微秒为单位分桶，小于1微秒的样本记入第0桶
+        index = int(math.log(max(seconds * 1e6, 1.0)) / self._log_base)
+        with self._lock:
+            self.counts[index] = self.counts.get(index, 0) + 1
+            self.total += 1
+            self.max = max(self.max, seconds)
+
+    def _bucket_value(self, index: int) -> float:
+        """桶的上界（秒）"""
+        return math.exp((index + 1) * self._log_base) / 1e6
+
+    def percentile(self, percent: float) -> Optional[float]:
+        if not self.total:
+            return None
+        target = max(1, math.ceil(self.total * percent / 100))
+        seen = 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen >= target:
+                return min(self._bucket_value(index), self.max) if self.max else self._bucket_value(index)
+        return self.max
+
+    def distribution(self) -> List[Dict]:
+        """HdrHistogram风格的百分位分布表"""
+        rows = []
+        seen = 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            rows.append({'value': round(self._bucket_value(index), 6), 'percentile': round(seen / self.total, 6),
+                         'total_count': seen})
+        return rows
+
+    def summary(self) -> Dict:
+        return {f'p{percent:g}': _round(self.percentile(percent)) for percent in REPORT_PERCENTILES}
+
+    def to_dict(self) -> Dict:
+        return {'precision': self.precision, 'unit': 'microsecond_log_buckets', 'max': round(self.max, 6),
+                'counts': {str(index): count for index, count in sorted(self.counts.items())},
+                'distribution': self.distribution()}
+
+    @classmethod
+    def from_dict(cls, data: Dict) -> 'LatencyHistogram':
+        histogram = cls(data['precision'], {int(index): count for index, count in data['counts'].items()})
+        histogram.max = data.get('max', 0.0)
+        return histogram
+
+
+def _round(value: Optional[float]) -> Optional[float]:
+    return round(value, 4) if value is not None else None
+
+
+def load_corpus(paths: List[str]) -> List[str]:
+    """展开图片文件和目录，默认使用仓库自带的示例图片"""
+    images = []
+    for path in paths or DEFAULT_CORPUS:
+        if os.path.isdir(path):
+            for root, _, files in os.walk(path):
+                images.extend(os.path.join(root, name) for name in sorted(files)
+                              if name.lower().endswith(IMAGE_EXTENSIONS))
+        elif os.path.exists(path):
+            images.append(path)
+    if not images:
+        raise ValueError('没有找到可用的测试图片')
+    return images
+
+
+# ---- 压测目标：接收图片路径，返回 (首token耗时, 总耗时)，出错时抛出异常 ----
+
+def core_stream_target() -> Callable[[str], tuple]:
+    """进程内调用流式识别和解题（与enhanced_math_solver.py相同的路径），首token为解答的第一个片段"""
+    from solver_core import stream_recognition, stream_solution
+
+    def run(image_path: str):
+        started = time.perf_counter()
+        recognition = None
+        for _, recognition in stream_recognition(image_path):
+            pass
+        first_token = None
+        for _ in stream_solution(recognition['text']):
+            if first_token is None:
+                first_token = time.perf_counter() - started
+        total = time.perf_counter() - started
+        return first_token if first_token is not None else total, total
+    return run
+
+
+def pipeline_target() -> Callable[[str], tuple]:
+    """进程内提交到两阶段流水线（与fixed_gradio_solver.py和批量模式相同的路径），非流式，首token即总耗时"""
+    from staged_pipeline import get_pipeline
+
+    def run(image_path: str):
+        started = time.perf_counter()
+        get_pipeline().solve(image_path)
+        total = time.perf_counter() - started
+        return total, total
+    return run
+
+
+def gradio_target(url: str, api_name: str) -> Callable[[str], tuple]:
+    """通过gradio_client调用正在运行的Gradio应用，首token为解答输出框第一次出现内容的时间"""
+    from gradio_client import Client, handle_file
+
+    local = threading.local()
+
+    def run(image_path: str):
+        # gradio_client的Client不是线程安全的，每个线程各自建立连接
+        if not hasattr(local, 'client'):
+            local.client = Client(url, verbose=False)
+        started = time.perf_counter()
+        job = local.client.submit(handle_file(image_path), api_name=api_name)
+        first_token = None
+        for output in job:
+            answer = output[-1] if isinstance(output, (list, tuple)) else output
+            if first_token is None and answer:
+                first_token = time.perf_counter() - started
+        job.result()
+        total = time.perf_counter() - started
+        return first_token if first_token is not None else total, total
+    return run
+
+
+class LoadRun:
+    """一次压测的统计"""
+
+    def __init__(self):
+        self.ttft = LatencyHistogram()
+        self.total = LatencyHistogram()
+        self.ok = 0
+        self.errors = 0
+        self.error_samples: List[str] = []
+        self._lock = threading.Lock()
+
+    def measure(self, target: Callable, image_path: str, scheduled: Optional[float] = None):
+        """执行一次请求；开环模式下从计划发出的时间开始计时，排队等待也算进延迟"""
+        delay = time.perf_counter() - scheduled if scheduled is not None else 0.0
+        try:
+            first_token, total = target(image_path)
+        except Exception as e:
+            with self._lock:
+                self.errors += 1
+                if len(self.error_samples) < 10:
+                    self.error_samples.append(f'{image_path}: {e}')
+            return
+        self.ttft.record(first_token + delay)
+        self.total.record(total + delay)
+        with self._lock:
+            self.ok += 1
+
+
+def run_closed_loop(target: Callable, images: List[str], users: int, duration: float,
+                    max_requests: Optional[int]) -> LoadRun:
+    """闭环：N个虚拟用户各自串行发请求，上一个完成后立即发下一个"""
+    run = LoadRun()
+    deadline = time.perf_counter() + duration
+    issued = [0]
+    lock = threading.Lock()
+
+    def user(index: int):
+        rng = random.Random(index)
+        while time.perf_counter() < deadline:
+            with lock:
+                if max_requests is not None and issued[0] >= max_requests:
+                    return
+                issued[0] += 1
+            run.measure(target, rng.choice(images))
+
+    threads = [threading.Thread(target=user, args=(index,), daemon=True) for index in range(users)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return run
+
+
+def run_open_loop(target: Callable, images: List[str], rate: float, duration: float,
+                  max_requests: Optional[int], max_in_flight: int) -> LoadRun:
+    """开环：按固定到达率发请求，不等待前面的请求完成，能暴露排队带来的延迟"""
+    run = LoadRun()
+    total = int(rate * duration)
+    if max_requests is not None:
+        total = min(total, max_requests)
+    rng = random.Random(0)
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+        for index in range(total):
+            scheduled = started + index / rate
+            wait = scheduled - time.perf_counter()
+            if wait > 0:
+                time.sleep(wait)
+            executor.submit(run.measure, target, rng.choice(images), scheduled)
+    return run
+
+
+def build_report(run: LoadRun, elapsed: float, config: Dict) -> Dict:
+    finished = run.ok + run.errors
+    return {
+        'config': config,
+        'elapsed_seconds': round(elapsed, 3),
+        'requests': finished,
+        'ok': run.ok,
+        'errors': run.errors,
+        'error_rate': round(run.errors / finished, 4) if finished else 0.0,
+        'throughput_per_second': round(run.ok / elapsed, 4) if elapsed > 0 else 0.0,
+        'ttft': run.ttft.summary(),
+        'total': run.total.summary(),
+        'error_samples': run.error_samples,
+        'histograms': {'ttft': run.ttft.to_dict(), 'total': run.total.to_dict()},
+    }
+
+
+def format_report(report: Dict) -> str:
+    lines = [
+        f"📈 请求 {report['requests']}（成功 {report['ok']}，失败 {report['errors']}，"
+        f"错误率 {report['error_rate']:.2%}），耗时 {report['elapsed_seconds']}s，"
+        f"吞吐 {report['throughput_per_second']} 个/秒",
+    ]
+    for name, label in (('ttft', '首token'), ('total', '总延迟')):
+        values = ', '.join(f"{key} {value}s" for key, value in report[name].items())
+        lines.append(f"   {label}: {values}")
+    for sample in report['error_samples']:
+        lines.append(f"   ❌ {sample}")
+    return '\n'.join(lines)
+
+
+def compare_reports(paths: List[str]) -> str:
+    """并排对比多次压测的百分位"""
+    reports = []
+    for path in paths:
+        with open(path, 'r', encoding='utf-8') as f:
+            reports.append(json.load(f))
+    header = f"{'':<14}" + ''.join(f"{os.path.basename(path):>22}" for path in paths)
+    lines = [header]
+    for metric in ('ttft', 'total'):
+        for percent in REPORT_PERCENTILES:
+            key = f'p{percent:g}'
+            row = f"{metric + ' ' + key:<14}"
+            for report in reports:
+                value = report[metric].get(key)
+                row += f"{(str(value) + 's') if value is not None else '-':>22}"
+            lines.append(row)
+    for key in ('throughput_per_second', 'error_rate'):
+        lines.append(f"{key[:14]:<14}" + ''.join(f"{report[key]:>22}" for report in reports))
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='端到端压测：开环/闭环发请求，统计首token与总延迟分布')
+    parser.add_argument('corpus', nargs='*', help='图片或目录，默认使用仓库自带的示例图片')
+    parser.add_argument('--target', choices=('core', 'pipeline', 'gradio'), default='core',
+                        help='core: 进程内流式解题；pipeline: 进程内两阶段流水线；gradio: 正在运行的Gradio应用')
+    parser.add_argument('--url', default='http://127.0.0.1:7862', help='Gradio应用地址')
+    parser.add_argument('--api-name', default='/predict',
+                        help='Gradio接口名，fixed_gradio_solver.py为/predict，enhanced_math_solver.py为/solve_math_from_image')
+    parser.add_argument('--users', type=int, help='闭环模式的虚拟用户数')
+    parser.add_argument('--rate', type=float, help='开环模式的到达率（请求/秒）')
+    parser.add_argument('--duration', type=float, default=60.0, help='压测时长（秒）')
+    parser.add_argument('--requests', type=int, help='最多发出的请求数')
+    parser.add_argument('--max-in-flight', type=int, default=256, help='开环模式同时在途的请求上限')
+    parser.add_argument('--disable-cache', action='store_true', help='关闭进程内目标的识别缓存、解答缓存、请求合并和SymPy快速通道，每次都调用模型')
+    parser.add_argument('-o', '--output', default='load_test_result.json', help='结果JSON（含直方图）')
+    parser.add_argument('--compare', nargs='+', metavar='RESULT', help='对比多个结果文件后退出')
+    args = parser.parse_args()
+
+    if args.compare:
+        print(compare_reports(args.compare))
+        return
+    if (args.users is None) == (args.rate is None):
+        parser.error('需要且只能指定 --users（闭环）或 --rate（开环）之一')
+    if args.disable_cache:
+        # 在导入solver_core之前设置，使共享的识别缓存不保存任何结果；
+        # 并发的相同请求也不合并、简单方程不走本地求解，测出的是模型的真实负载
+        os.environ['RECOGNITION_CACHE_SIZE'] = '0'
+        os.environ['RECOGNITION_CACHE_DIR'] = ''
+        os.environ['NEAR_DUPLICATE_DISTANCE'] = '-1'
+        os.environ['SOLUTION_CACHE_SIZE'] = '0'
+        os.environ['SOLUTION_CACHE_DIR'] = ''
+        os.environ['SEMANTIC_CACHE'] = '0'
+        os.environ['SINGLEFLIGHT'] = '0'
+        os.environ['SYMBOLIC_FAST_PATH'] = '0'
+
+    images = load_corpus(args.corpus)
+    if args.target == 'core':
+        target = core_stream_target()
+    elif args.target == 'pipeline':
+        target = pipeline_target()
+    else:
+        target = gradio_target(args.url, args.api_name)
+
+    config = {key: value for key, value in vars(args).items() if key != 'compare'}
+    config['images'] = len(images)
+    mode = f"闭环 {args.users} 个用户" if args.users else f"开环 {args.rate} 个/秒"
+    print(f"🚦 压测 {args.target}，{mode}，时长 {args.duration}s，图片 {len(images)} 张")
+
+    started = time.perf_counter()
+    if args.users:
+        run = run_closed_loop(target, images, args.users, args.duration, args.requests)
+    else:
+        run = run_open_loop(target, images, args.rate, args.duration, args.requests, args.max_in_flight)
+    report = build_report(run, time.perf_counter() - started, config)
+
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(format_report(report))
+    print(f"💾 结果已保存到 {args.output}，可用 --compare 与其他结果对比")
+
+
+if __name__ == "__main__":
+    main()
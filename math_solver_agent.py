@@ -1,13 +1,23 @@
-import os
 import copy
-import ollama
+import json
+import time
+import hashlib
 from typing import Dict, Iterator, List, Optional, Union
 from qwen_agent import Agent
 from qwen_agent.agents import Assistant
 from qwen_agent.llm import BaseChatModel
 from qwen_agent.llm.schema import Message, ContentItem
 from qwen_agent.gui import WebUI
-from qwen_agent.utils.utils import encode_image_as_base64
+from async_ollama import achat
+from concurrency_limit import limited_chat
+from admission import gradio_concurrency_limit, run_admitted
+from cancellation import Cancelled, cancellable_iter
+from ollama_stream import ChatStream
+from singleflight import SingleFlight
+from solution_cache import normalize_problem_text
+from solver_core import arecognize_image, content_digest, recognize_image
+from solver_metrics import observe_ollama_response, track_solve
+from solver_trace import record_model_spans, traced_iter
 
 # 配置本地ollama服务的模型
 VISION_MODEL_CONFIG = {
@@ -30,6 +40,8 @@ class OllamaVisionLLM(BaseChatModel):
         self.model_name = model_config['model']
         self.temperature = model_config.get('temperature', 0.1)
         self.max_tokens = model_config.get('max_tokens', 2048)
+        # 最近一次流式调用的首token时间和生成速度
+        self.last_stream_stats = None
     
     def _chat(self, messages: List[Message], **kwargs) -> List[Message]:
         """非流式聊天接口"""
@@ -40,74 +52,142 @@ class OllamaVisionLLM(BaseChatModel):
         return self._process_messages(messages)
     
     def _chat_stream(self, messages: List[Message], **kwargs) -> Iterator[List[Message]]:
-        """流式聊天接口"""
-        result = self._process_messages(messages)
-        yield result
+        """流式聊天接口
+
+        纯文本请求使用ollama的流式输出，边生成边产出；delta_stream为True时每次只产出
+        新增片段，否则产出累计的完整文本。图片识别请求经过识别缓存和自适应分辨率，
+        需要完整文本做检查，因此一次性产出。
+        """
+        if not messages:
+            yield [Message(role='assistant', content='没有收到消息')]
+            return
+        
+        ollama_messages, image_data, options = self._build_request(messages)
+        if image_data:
+            yield self._process_messages(messages)
+            return
+        
+        delta_stream = kwargs.get('delta_stream', False)
+        started = time.time()
+        stream = ChatStream(self.model_name, ollama_messages, options)
+        try:
+            for delta in stream:
+                yield [Message(role='assistant', content=delta if delta_stream else stream.text)]
+        except Cancelled:
+            raise
+        except Exception as e:
+            yield [Message(role='assistant', content=f"调用ollama服务出错: {str(e)}")]
+        finally:
+            # 调用方提前停止迭代时也要关闭连接，让ollama停止生成
+            stream.close()
+            self.last_stream_stats = stream.stats
+            # 纯文本请求即解题阶段
+            record_model_spans('math', self.model_name, started, time.time(), stream.final_chunk, stream.stats['ttft'])
+            print(f"⏱️ {stream.format_stats()}")
     
     def _chat_with_functions(self, messages: List[Message], functions, **kwargs) -> List[Message]:
         """带函数调用的聊天接口"""
         # 简化实现，直接调用普通聊天
         return self._chat_no_stream(messages, **kwargs)
     
+    def _build_request(self, messages: List[Message]):
+        """从qwen-agent消息中提取文本和图片，构造ollama请求
+
+        Returns:
+            tuple: (ollama消息列表, 图片数据或None, 推理参数)
+        """
+        # 提取最后一条消息的内容
+        last_message = messages[-1]
+        content = last_message.content
+        
+        # 处理多模态内容
+        text_content = ""
+        image_data = None
+        
+        if isinstance(content, list):
+            for item in content:
+                if isinstance(item, ContentItem):
+                    if item.text:
+                        text_content = item.text
+                    if item.image:
+                        image_data = item.image
+                elif isinstance(item, dict):
+                    if 'text' in item:
+                        text_content = item['text']
+                    if 'image' in item:
+                        image_data = item['image']
+        elif isinstance(content, str):
+            text_content = content
+        
+        # 构建ollama消息
+        ollama_messages = [{
+            'role': 'user',
+            'content': text_content or "请识别图片中的数学内容"
+        }]
+        options = {
+            'temperature': self.temperature,
+            'max_tokens': self.max_tokens
+        }
+        
+        if image_data:
+            # 路径、data URL和base64都交给传输层，只读取一次原始字节
+            image_data = str(image_data).replace('file://', '')
+        return ollama_messages, image_data, options
+    
     def _process_messages(self, messages: List[Message]) -> List[Message]:
         """处理消息并调用ollama"""
         try:
-            # 提取最后一条消息的内容
             if not messages:
                 return [Message(role='assistant', content='没有收到消息')]
             
-            last_message = messages[-1]
-            content = last_message.content
+            ollama_messages, image_data, options = self._build_request(messages)
+            
+            if image_data:
+                # 图像识别走识别缓存，相同图片不重复调用vision模型
+                result = recognize_image(
+                    image_data,
+                    prompt=ollama_messages[0]['content'],
+                    model=self.model_name,
+                    options=options
+                )
+                return [Message(role='assistant', content=result)]
+            
+            # 调用ollama，经过该模型的自适应限流
+            response = limited_chat(
+                model=self.model_name,
+                messages=ollama_messages,
+                options=options
+            )
             
-            # 处理多模态内容
-            text_content = ""
-            image_data = None
+            observe_ollama_response(self.model_name, response)
+            result = response['message']['content']
+            return [Message(role='assistant', content=result)]
             
-            if isinstance(content, list):
-                for item in content:
-                    if isinstance(item, ContentItem):
-                        if item.text:
-                            text_content = item.text
-                        if item.image:
-                            image_data = item.image
-                    elif isinstance(item, dict):
-                        if 'text' in item:
-                            text_content = item['text']
-                        if 'image' in item:
-                            image_data = item['image']
-            elif isinstance(content, str):
-                text_content = content
+        except Exception as e:
+            error_msg = f"调用ollama服务出错: {str(e)}"
+            return [Message(role='assistant', content=error_msg)]
+    
+    async def _aprocess_messages(self, messages: List[Message]) -> List[Message]:
+        """_process_messages的异步版本，供async def处理函数通过共享连接池调用ollama"""
+        try:
+            if not messages:
+                return [Message(role='assistant', content='没有收到消息')]
             
-            # 构建ollama消息
-            ollama_messages = []
-            ollama_msg = {
-                'role': 'user',
-                'content': text_content or "请识别图片中的数学内容"
-            }
+            ollama_messages, image_data, options = self._build_request(messages)
             
-            # 添加图像数据
             if image_data:
-                if image_data.startswith('data:image/'):
-                    # base64格式
-                    ollama_msg['images'] = [image_data]
-                elif os.path.exists(image_data):
-                    # 文件路径，转换为base64
-                    base64_image = encode_image_as_base64(image_data)
-                    ollama_msg['images'] = [base64_image]
-                else:
-                    # 直接作为图像数据
-                    ollama_msg['images'] = [str(image_data)]
-            
-            ollama_messages.append(ollama_msg)
+                result = await arecognize_image(
+                    image_data,
+                    prompt=ollama_messages[0]['content'],
+                    model=self.model_name,
+                    options=options
+                )
+                return [Message(role='assistant', content=result)]
             
-            # 调用ollama
-            response = ollama.chat(
+            response = await achat(
                 model=self.model_name,
                 messages=ollama_messages,
-                options={
-                    'temperature': self.temperature,
-                    'max_tokens': self.max_tokens
-                }
+                options=options
             )
             
             result = response['message']['content']
@@ -116,6 +196,36 @@ class OllamaVisionLLM(BaseChatModel):
         except Exception as e:
             error_msg = f"调用ollama服务出错: {str(e)}"
             return [Message(role='assistant', content=error_msg)]
+    
+    async def async_chat(self, messages: List[Message]) -> List[Message]:
+        """异步聊天接口"""
+        return await self._aprocess_messages(messages)
+
+# 多个用户同时上传同一张图片时，WebUI的识别和解题各只执行一次
+VISION_AGENT_FLIGHTS = SingleFlight('webui_vision', 'WebUI识别')
+MATH_AGENT_FLIGHTS = SingleFlight('webui_math', 'WebUI解题')
+
+
+def conversation_key(messages: List[Message]) -> str:
+    """请求合并用的对话摘要，图片按内容计算摘要，与上传后的临时文件名无关"""
+    parts = []
+    for message in messages:
+        role = message.get('role') if isinstance(message, dict) else message.role
+        content = message.get('content') if isinstance(message, dict) else message.content
+        if isinstance(content, list):
+            items = []
+            for item in content:
+                if isinstance(item, ContentItem):
+                    item = {'text': item.text, 'image': item.image}
+                if item.get('image'):
+                    items.append(['image', content_digest(item['image'])])
+                elif item.get('text'):
+                    items.append(['text', item['text']])
+            content = items
+        parts.append([role, content])
+    material = json.dumps(parts, ensure_ascii=False, default=str)
+    return hashlib.sha256(material.encode('utf-8')).hexdigest()
+
 
 class MathSolverAgent(Agent):
     """数学解题智能体"""
@@ -161,14 +271,32 @@ class MathSolverAgent(Agent):
             yield [Message(role='assistant', content='请上传包含数学题目的图片')]
             return
         
+        # 先经过准入控制，排队时以助手消息显示排队位置
+        def reply(text: str) -> List[Message]:
+            return [Message(role='assistant', content=text)]
+        
+        # WebUI停止生成时会关闭这个生成器：逐层退出请求合并，所有用户都离开后模型调用关闭连接、停止生成；
+        # 超过截止时间（REQUEST_DEADLINE）时同样中止
+        steps = run_admitted(lambda: self._tracked_steps(messages), queued=reply, busy=reply)
+        try:
+            yield from cancellable_iter(steps)
+        except Cancelled as e:
+            yield reply(f"🛑 {e}")
+    
+    def _tracked_steps(self, messages: List[Message]) -> Iterator[List[Message]]:
+        with track_solve('webui'):
+            yield from traced_iter('webui', self._solve_steps(messages))
+    
+    def _solve_steps(self, messages: List[Message]) -> Iterator[List[Message]]:
+        """先识别图片再解题，逐步产出两个agent的响应"""
         # 步骤1: 使用vision agent识别图片内容
         print("步骤1: 开始识别图片中的数学内容...")
         
-        # 创建识别请求
-        vision_messages = copy.deepcopy(messages)
+        # 创建识别请求，同一对话（同一张图片）正在识别时直接订阅它的输出
         vision_result = None
         
-        for response in self.vision_agent.run(vision_messages):
+        for response in VISION_AGENT_FLIGHTS.stream(conversation_key(messages),
+                                                    lambda: self.vision_agent.run(copy.deepcopy(messages))):
             vision_result = response
             yield response
         
@@ -190,8 +318,10 @@ class MathSolverAgent(Agent):
         )
         
         math_messages = messages[:-1] + [math_message]
+        math_key = conversation_key(
+            messages[:-1] + [{'role': 'user', 'content': normalize_problem_text(recognition_text)}])
         
-        for math_response in self.math_agent.run(math_messages):
+        for math_response in MATH_AGENT_FLIGHTS.stream(math_key, lambda: self.math_agent.run(math_messages)):
             yield math_response
 
 def launch_app():
@@ -201,6 +331,8 @@ def launch_app():
     WebUI(agent).run(
         server_name="0.0.0.0",
         server_port=7862,
+        # 排队和拒绝由准入控制负责，Gradio的并发上限高于准入容量，超出的请求才能被立即拒绝
+        concurrency_limit=gradio_concurrency_limit(),
         title="数学解题智能体",
         description="上传数学题目图片，AI将识别并解答"
     )
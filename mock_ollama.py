@@ -0,0 +1,371 @@
+import json
+import time
+import base64
+import random
+import argparse
+import threading
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+from typing import Dict, List, Optional
+
+from PIL import Image
+
+from image_preprocess import estimate_image_tokens
+
+# 模拟vision模型：先输出题目，再继续描述图片，和granite3.2-vision的习惯一致
+VISION_RESPONSE = (
+    "解方程组：\n2x + 3y = 12\nx - y = 1\n\n"
+    "这张图片是黑色背景上的白色手写字迹，两个方程上下排列，字迹清晰，没有其他图形或标注。"
+)
+MATH_RESPONSE = (
+    "解：由第二个方程得 x = y + 1。\n代入第一个方程：2(y + 1) + 3y = 12，即 5y = 10，所以 y = 2。\n"
+    "再代回得 x = 3。\n\n最终答案：x = 3，y = 2。"
+)
+
+DEFAULT_MODEL_PROFILE = {
+    # prefill速度（token/秒），决定首token时间
+    'prefill_tokens_per_second': 1500.0,
+    # 生成速度（token/秒）
+    'decode_tokens_per_second': 40.0,
+    # 模型未加载时的加载耗时（秒）
+    'cold_load_seconds': 3.0,
+    # 空闲多久后卸载模型，之后的请求重新冷启动
+    'keep_alive_seconds': 300.0,
+    'response': '好的。',
+}
+
+DEFAULT_PROFILE = {
+    # 同时处理的请求数，对应OLLAMA_NUM_PARALLEL
+    'num_parallel': 1,
+    # 排队请求上限，对应OLLAMA_MAX_QUEUE，超出时返回503
+    'max_queue': 512,
+    # 多个请求并行时每多一个，生成速度下降的比例
+    'parallel_slowdown': 0.3,
+    # 故障注入：返回500的比例、卡住不响应的比例和卡住的秒数
+    'error_rate': 0.0,
+    'timeout_rate': 0.0,
+    'timeout_seconds': 600.0,
+    'seed': None,
+    # 只提供这些模型（模拟多台主机各自拉取了不同模型），其他模型返回404；None表示都提供
+    'serve_only': None,
+    'models': {
+        'granite3.2-vision': {'decode_tokens_per_second': 35.0, 'response': VISION_RESPONSE},
+        'qwen2:latest': {'decode_tokens_per_second': 45.0, 'response': MATH_RESPONSE},
+    },
+}
+
+
+def load_profile(path: Optional[str] = None, **overrides) -> Dict:
+    """读取JSON配置并与默认配置合并，models下的每个模型再与默认模型配置合并"""
+    profile = json.loads(json.dumps(DEFAULT_PROFILE))
+    if path:
+        with open(path, 'r', encoding='utf-8') as f:
+            custom = json.load(f)
+        models = custom.pop('models', {})
+        profile.update(custom)
+        for name, model_profile in models.items():
+            profile['models'].setdefault(name, {}).update(model_profile)
+    profile.update({key: value for key, value in overrides.items() if value is not None})
+    return profile
+
+
+def split_tokens(text: str) -> List[str]:
+    """把回复切成近似token的片段（中文约每两个字符一个token）"""
+    return [text[i:i + 2] for i in range(0, len(text), 2)] or ['']
+
+
+class MockOllama:
+    """模拟ollama的调度：并发槽位、排队上限、模型加载与卸载、故障注入"""
+
+    def __init__(self, profile: Dict):
+        self.profile = profile
+        self._slots = threading.Semaphore(profile['num_parallel'])
+        self._lock = threading.Lock()
+        self._waiting = 0
+        self._active = 0
+        # 模型名 -> 最近一次使用时间；加载锁保证并发的冷请求只加载一次
+        self._loaded: Dict[str, float] = {}
+        self._load_locks: Dict[str, threading.Lock] = {}
+        self._random = random.Random(profile.get('seed'))
+        self.stats = {'requests': 0, 'rejected': 0, 'errors': 0, 'timeouts': 0, 'cold_loads': 0, 'cancelled': 0}
+
+    def serves(self, model: str) -> bool:
+        serve_only = self.profile['serve_only']
+        return serve_only is None or model in serve_only
+
+    def model_profile(self, model: str) -> Dict:
+        profile = dict(DEFAULT_MODEL_PROFILE)
+        profile.update(self.profile['models'].get(model, {}))
+        return profile
+
+    def acquire(self) -> bool:
+        """占用一个并发槽位，排队已满时返回False"""
+        with self._lock:
+            if self._waiting >= self.profile['max_queue']:
+                self.stats['rejected'] += 1
+                return False
+            self._waiting += 1
+        self._slots.acquire()
+        with self._lock:
+            self._waiting -= 1
+            self._active += 1
+        return True
+
+    def release(self):
+        with self._lock:
+            self._active -= 1
+        self._slots.release()
+
+    def inject_fault(self) -> Optional[str]:
+        """按配置的比例返回'error'、'timeout'或None"""
+        with self._lock:
+            roll = self._random.random()
+            self.stats['requests'] += 1
+            if roll < self.profile['error_rate']:
+                self.stats['errors'] += 1
+                return 'error'
+            if roll < self.profile['error_rate'] + self.profile['timeout_rate']:
+                self.stats['timeouts'] += 1
+                return 'timeout'
+        return None
+
+    def ensure_loaded(self, model: str) -> float:
+        """模型未加载或已过期时模拟加载，返回本次加载耗时（秒）"""
+        profile = self.model_profile(model)
+        with self._lock:
+            lock = self._load_locks.setdefault(model, threading.Lock())
+        with lock:
+            now = time.time()
+            last_used = self._loaded.get(model)
+            if last_used is not None and now - last_used < profile['keep_alive_seconds']:
+                self._loaded[model] = now
+                return 0.0
+            time.sleep(profile['cold_load_seconds'])
+            self._loaded[model] = time.time()
+            with self._lock:
+                self.stats['cold_loads'] += 1
+            return profile['cold_load_seconds']
+
+    def touch(self, model: str):
+        with self._lock:
+            self._loaded[model] = time.time()
+
+    def decode_delay(self, model: str) -> float:
+        """每个token的生成间隔，并行请求越多越慢"""
+        speed = self.model_profile(model)['decode_tokens_per_second']
+        with self._lock:
+            active = max(self._active, 1)
+        return (1 + self.profile['parallel_slowdown'] * (active - 1)) / speed
+
+    def running_models(self) -> List[Dict]:
+        """/api/ps的返回内容"""
+        now = time.time()
+        models = []
+        with self._lock:
+            loaded = dict(self._loaded)
+        for name, last_used in loaded.items():
+            keep_alive = self.model_profile(name)['keep_alive_seconds']
+            if now - last_used >= keep_alive:
+                continue
+            expires_at = datetime.fromtimestamp(last_used + keep_alive, tz=timezone.utc)
+            models.append({'name': name, 'model': name, 'size': 0, 'size_vram': 0,
+                           'digest': '', 'expires_at': expires_at.isoformat()})
+        return models
+
+
+def _count_prompt_tokens(messages: List[Dict]) -> int:
+    tokens = 0
+    for message in messages:
+        tokens += len(message.get('content') or '') // 2 + 4
+        for image in message.get('images') or []:
+            try:
+                width, height = Image.open(BytesIO(base64.b64decode(image))).size
+                tokens += estimate_image_tokens(width, height)
+            except Exception:
+                tokens += 729
+    return tokens
+
+
+def _timestamp() -> str:
+    return datetime.now(timezone.utc).isoformat()
+
+
+class _MockHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    mock: MockOllama = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status: int, body: Dict):
+        data = json.dumps(body, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _write_chunk(self, body: Dict):
+        data = (json.dumps(body, ensure_ascii=False) + '\n').encode('utf-8')
+        self.wfile.write(f'{len(data):X}\r\n'.encode('ascii') + data + b'\r\n')
+        self.wfile.flush()
+
+    def do_GET(self):
+        if self.path == '/api/tags':
+            names = self.mock.profile['serve_only'] or self.mock.profile['models']
+            models = [{'name': name, 'model': name, 'size': 0, 'digest': ''} for name in names]
+            self._send_json(200, {'models': models})
+        elif self.path == '/api/ps':
+            self._send_json(200, {'models': self.mock.running_models()})
+        elif self.path == '/api/version':
+            self._send_json(200, {'version': '0.0.0-mock'})
+        elif self.path == '/':
+            body = b'Ollama is running'
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        else:
+            self._send_json(404, {'error': 'not found'})
+
+    def do_POST(self):
+        if self.path not in ('/api/chat', '/api/generate', '/api/embed'):
+            self._send_json(404, {'error': 'not found'})
+            return
+        length = int(self.headers.get('Content-Length', 0))
+        request = json.loads(self.rfile.read(length) or b'{}')
+        if self.path == '/api/embed':
+            self._embed(request)
+            return
+        chat = self.path == '/api/chat'
+        model = request.get('model', '')
+        if chat:
+            messages = request.get('messages') or []
+        else:
+            messages = [{'content': request.get('prompt', ''), 'images': request.get('images')}]
+
+        if not self.mock.serves(model):
+            self._send_json(404, {'error': f"model '{model}' not found"})
+            return
+        fault = self.mock.inject_fault()
+        if fault == 'error':
+            self._send_json(500, {'error': 'mock: injected server error'})
+            return
+        if fault == 'timeout':
+            time.sleep(self.mock.profile['timeout_seconds'])
+            self._send_json(500, {'error': 'mock: injected timeout'})
+            return
+        if not self.mock.acquire():
+            self._send_json(503, {'error': 'server busy, please try again.  maximum pending requests exceeded'})
+            return
+        try:
+            self._generate(model, messages, chat, request.get('stream', True))
+        except (BrokenPipeError, ConnectionResetError):
+            # 客户端提前关闭流式连接（取消生成），和ollama一样停止生成
+            with self.mock._lock:
+                self.mock.stats['cancelled'] += 1
+        finally:
+            self.mock.release()
+            self.mock.touch(model)
+
+    def _embed(self, request: Dict):
+        """嵌入接口，用与语义缓存相同的本地哈希嵌入代替真实嵌入模型"""
+        from semantic_cache import hashing_embed
+        texts = request.get('input') or ''
+        texts = [texts] if isinstance(texts, str) else texts
+        self._send_json(200, {'model': request.get('model', ''),
+                              'embeddings': hashing_embed(texts).tolist()})
+
+    def _generate(self, model: str, messages: List[Dict], chat: bool, stream: bool):
+        started = time.time()
+        load_seconds = self.mock.ensure_loaded(model)
+        profile = self.mock.model_profile(model)
+        prompt_tokens = _count_prompt_tokens(messages)
+        prefill_seconds = prompt_tokens / profile['prefill_tokens_per_second']
+        time.sleep(prefill_seconds)
+
+        tokens = split_tokens(profile['response'])
+        base = {'model': model, 'created_at': _timestamp()}
+
+        def piece(content: str) -> Dict:
+            if chat:
+                return {'message': {'role': 'assistant', 'content': content}}
+            return {'response': content}
+
+        if stream:
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/x-ndjson')
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+
+        eval_started = time.time()
+        for token in tokens:
+            time.sleep(self.mock.decode_delay(model))
+            if stream:
+                self._write_chunk(dict(base, created_at=_timestamp(), done=False, **piece(token)))
+        eval_seconds = time.time() - eval_started
+
+        final = dict(
+            base,
+            created_at=_timestamp(),
+            done=True,
+            done_reason='stop',
+            total_duration=int((time.time() - started) * 1e9),
+            load_duration=int(load_seconds * 1e9),
+            prompt_eval_count=prompt_tokens,
+            prompt_eval_duration=int(prefill_seconds * 1e9),
+            eval_count=len(tokens),
+            eval_duration=int(eval_seconds * 1e9),
+            **piece('' if stream else profile['response']),
+        )
+        if stream:
+            self._write_chunk(final)
+            self.wfile.write(b'0\r\n\r\n')
+        else:
+            self._send_json(200, final)
+
+
+def start_mock_server(port: int = 11435, host: str = '127.0.0.1', profile: Optional[Dict] = None):
+    """在后台线程启动模拟服务，返回 (server, MockOllama)；设置 OLLAMA_HOST=http://host:port 即可接入"""
+    mock = MockOllama(profile or load_profile())
+    handler = type('MockHandler', (_MockHandler,), {'mock': mock})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='mock-ollama', daemon=True).start()
+    return server, mock
+
+
+def main():
+    parser = argparse.ArgumentParser(description='模拟ollama服务，用于没有GPU的机器上压测和联调')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=11435)
+    parser.add_argument('--profile', help='JSON配置文件，结构同DEFAULT_PROFILE')
+    parser.add_argument('--num-parallel', type=int, help='并发槽位数，对应OLLAMA_NUM_PARALLEL')
+    parser.add_argument('--max-queue', type=int, help='排队上限，对应OLLAMA_MAX_QUEUE')
+    parser.add_argument('--error-rate', type=float, help='返回500的请求比例')
+    parser.add_argument('--timeout-rate', type=float, help='卡住不响应的请求比例')
+    parser.add_argument('--timeout-seconds', type=float, help='卡住的秒数')
+    parser.add_argument('--seed', type=int, help='故障注入的随机种子')
+    parser.add_argument('--models', help='只提供这些模型（逗号分隔），用于模拟后端池中的不同主机')
+    args = parser.parse_args()
+
+    profile = load_profile(
+        args.profile, num_parallel=args.num_parallel, max_queue=args.max_queue, error_rate=args.error_rate,
+        timeout_rate=args.timeout_rate, timeout_seconds=args.timeout_seconds, seed=args.seed,
+        serve_only=[name.strip() for name in args.models.split(',')] if args.models else None,
+    )
+    server, mock = start_mock_server(args.port, args.host, profile)
+    print(f"🧪 模拟ollama已启动: http://{args.host}:{args.port}  (OLLAMA_HOST=http://{args.host}:{args.port})")
+    print(f"   并发 {profile['num_parallel']}，模型: {', '.join(profile['serve_only'] or profile['models'])}")
+    try:
+        while True:
+            time.sleep(60)
+            print(f"📊 {mock.stats}")
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,287 @@
+import os
+import time
+import queue
+import threading
+import contextvars
+from functools import partial
+from typing import Dict, Iterator, List, Optional
+
+from backend_pool import BackendPool, LiveCall, NoBackendAvailable, get_backend_pool
+from cancellation import (CancelToken, Cancelled, abort_on_cancel, current_token, record_cancellation,
+                          record_generation)
+from concurrency_limit import AdaptiveLimiter, get_limiter
+from resilience import OLLAMA_HEDGE, TTFT_TRACKER, retry_stream, stage_timeout
+from solver_metrics import MODEL_HEDGES, observe_ollama_response
+
+# 界面刷新节流：最短刷新间隔（秒）和触发立即刷新的累积字符数
+STREAM_UI_INTERVAL = float(os.environ.get('STREAM_UI_INTERVAL', '0.1'))
+STREAM_UI_MAX_CHARS = int(os.environ.get('STREAM_UI_MAX_CHARS', '512'))
+
+
+class _Attempt:
+    """对冲时发往某台主机的一次请求"""
+
+    def __init__(self, backend):
+        self.backend = backend
+        # 这次请求的句柄，落后的一方被取消时通过它立即关闭连接
+        self.call = LiveCall()
+        self.cancelled = False
+        self.finished = False
+
+    def cancel(self):
+        self.cancelled = True
+        self.call.abort()
+
+
+class ChatStream:
+    """ollama流式调用的包装：逐块产出文本增量，并统计首token时间和生成速度
+
+    用法::
+
+        stream = ChatStream('qwen2:latest', messages)
+        for delta in stream:
+            ...
+        stream.text, stream.stats
+
+    提前结束迭代或调用close()会关闭底层HTTP流式连接，ollama随即停止生成。
+    未指定client时由后端池选择主机；调用期间占用该主机上该模型自适应限流器的一个槽位，
+    结束时以首token时间（扣除模型加载）作为延迟样本。
+
+    两块之间超过该阶段的超时（stage_timeout）即视为生成卡住；还没有产出内容时，
+    超时、连接失败和5xx按带抖动的退避重试。hedge为True并且有多台主机时，超过首token时间的
+    p95仍没有输出就向另一台主机发出相同的请求，先出token的一方胜出，另一方的连接立即关闭。
+
+    token默认为当前请求的取消令牌（见 cancellation.py）：请求被取消时立即中止HTTP请求并抛出Cancelled，
+    还在等待首token（预填充）或两块之间停顿时也不等下一块到达；超过截止时间时在下一块到达时中止，
+    单次调用的超时也不超过截止时间。
+    """
+
+    def __init__(self, model: str, messages: List[Dict], options: Optional[Dict] = None, client=None,
+                 limiter: Optional[AdaptiveLimiter] = None, stage: str = 'math', hedge: bool = OLLAMA_HEDGE,
+                 token: Optional[CancelToken] = None):
+        self.model = model
+        self.messages = messages
+        self.options = options
+        self.client = client
+        self.limiter = limiter
+        self.stage = stage
+        self.hedge = hedge
+        self.token = token if token is not None else current_token()
+        self.text = ''
+        self.final_chunk = None
+        self.stats = {'model': model, 'ttft': None, 'total_seconds': None, 'eval_count': None,
+                      'tokens_per_second': None, 'chunks': 0, 'completed': False, 'hedged': False, 'cancelled': None}
+        self._iterator = None
+
+    def __iter__(self) -> Iterator[str]:
+        if self._iterator is None:
+            self._iterator = self._iterate()
+        return self._iterator
+
+    def _iterate(self) -> Iterator[str]:
+        started = time.time()
+        chunks = retry_stream(self._start, self.stage, can_retry=lambda: not self.text and not self._cancelled())
+        try:
+            for chunk in chunks:
+                delta = chunk['message']['content']
+                if delta:
+                    if self.stats['ttft'] is None:
+                        self.stats['ttft'] = round(time.time() - started, 3)
+                    self.stats['chunks'] += 1
+                    self.text += delta
+                    yield delta
+                if chunk.get('done'):
+                    self.final_chunk = chunk
+                    self.stats['completed'] = True
+                elif self._cancelled():
+                    raise Cancelled(self.token.reason)
+        finally:
+            # 关闭时逐层归还主机、限流槽位并关闭HTTP连接
+            chunks.close()
+            self.stats['total_seconds'] = round(time.time() - started, 3)
+            self._finish_stats(started)
+            self._record_outcome()
+            # 提前取消的流没有最后一块，不计入ollama自带的统计
+            observe_ollama_response(self.model, self.final_chunk)
+
+    def _cancelled(self) -> bool:
+        return self.token is not None and self.token.cancelled
+
+    def _call_timeout(self) -> float:
+        timeout = stage_timeout(self.stage)
+        return timeout if self.token is None else self.token.timeout(timeout)
+
+    def _record_outcome(self):
+        """完整生成计入平均耗时；因取消中止的生成估计节省的模型时间"""
+        if self.stats['completed']:
+            record_generation(self.stage, self.model, self.stats['total_seconds'])
+            return
+        if not self._cancelled():
+            return
+        self.stats['cancelled'] = self.token.reason
+        saved = record_cancellation(self.stage, self.model, self.token.reason, self.stats['total_seconds'])
+        print(f"🛑 {self.model} {self.stage}生成已中止（{self.token.reason}），已输出 {self.stats['chunks']} 块"
+              + (f"，预计节省约 {saved:.1f}s 模型时间" if saved is not None else ''))
+
+    def _start(self) -> Iterator:
+        """发起一次请求（重试时每次调用），产出原始的响应块"""
+        if self.client is not None:
+            yield from self._chunks_from(self.client.chat, self.limiter or get_limiter(self.model))
+            return
+        pool = get_backend_pool()
+        delay = TTFT_TRACKER.hedge_delay(self.stage, self.model) if self.hedge and len(pool.backends) > 1 else None
+        if delay is not None:
+            yield from self._hedged(pool, delay)
+            return
+        with pool.lease(self.model) as backend:
+            yield from self._chunks_from(partial(backend.chat, timeout=self._call_timeout()),
+                                         self.limiter or get_limiter(self.model, backend.name), LiveCall())
+
+    def _chunks_from(self, chat, limiter: AdaptiveLimiter, call: Optional[LiveCall] = None) -> Iterator:
+        """call为后端池主机上这次请求的句柄，取消时通过它立即中止请求"""
+        kwargs = {'options': self.options} if self.options else {}
+        if call is not None:
+            kwargs['call'] = call
+        with limiter.acquire() as permit, abort_on_cancel(call, self.token):
+            started = time.time()
+            ttft = None
+            final_chunk = None
+            chunks = chat(model=self.model, messages=self.messages, stream=True, **kwargs)
+            try:
+                for chunk in chunks:
+                    if ttft is None and chunk['message']['content']:
+                        ttft = time.time() - started
+                        TTFT_TRACKER.record(self.stage, self.model, ttft)
+                    if chunk.get('done'):
+                        final_chunk = chunk
+                    yield chunk
+            finally:
+                if hasattr(chunks, 'close'):
+                    chunks.close()
+                if ttft is not None:
+                    load_seconds = ((final_chunk or {}).get('load_duration') or 0) / 1e9
+                    permit.record(max(ttft - load_seconds, 0.0))
+
+    def _hedged(self, pool: BackendPool, delay: float) -> Iterator:
+        """对冲请求：第一次请求delay秒内没有输出时，向另一台主机发出相同请求，产出先出token一方的响应块"""
+        events = queue.Queue()
+        attempts = []
+
+        def launch():
+            attempt = _Attempt(pool.choose(self.model, exclude=[a.backend for a in attempts]))
+            attempts.append(attempt)
+            # 工作线程沿用调用方的上下文（请求追踪、传输字节计数）
+            threading.Thread(target=contextvars.copy_context().run, args=(self._run_attempt, pool, attempt, events),
+                             name='ollama-hedge', daemon=True).start()
+
+        launch()
+        deadline = time.monotonic() + delay
+        hedged = False
+        winner = None
+        error = None
+        try:
+            while True:
+                timeout = None if hedged or winner is not None else max(deadline - time.monotonic(), 0.0)
+                try:
+                    attempt, chunk, error = events.get(timeout=timeout)
+                except queue.Empty:
+                    hedged = True
+                    try:
+                        launch()
+                    except NoBackendAvailable:
+                        continue
+                    self.stats['hedged'] = True
+                    MODEL_HEDGES.inc(stage=self.stage, result='launched')
+                    print(f"🪁 {self.model}@{attempts[0].backend.name} {delay:.2f}s 内没有输出，"
+                          f"向 {attempts[-1].backend.name} 发出对冲请求")
+                    continue
+                if winner is not None and attempt is not winner:
+                    continue
+                if chunk is None:
+                    # 该请求已结束：胜出方结束即整个流结束，都失败时抛出最后一个错误
+                    attempt.finished = True
+                    if attempt is winner or (winner is None and all(a.finished for a in attempts)):
+                        if error is not None:
+                            raise error
+                        return
+                    continue
+                if winner is None:
+                    if not chunk['message']['content'] and not chunk.get('done'):
+                        continue
+                    winner = attempt
+                    for other in attempts:
+                        if other is not winner:
+                            other.cancel()
+                    if attempt is not attempts[0]:
+                        MODEL_HEDGES.inc(stage=self.stage, result='won')
+                yield chunk
+        finally:
+            for attempt in attempts:
+                attempt.cancel()
+
+    def _run_attempt(self, pool: BackendPool, attempt: _Attempt, events: queue.Queue):
+        error = None
+        try:
+            chunks = self._chunks_from(partial(attempt.backend.chat, timeout=self._call_timeout()),
+                                       get_limiter(self.model, attempt.backend.name), attempt.call)
+            try:
+                for chunk in chunks:
+                    if attempt.cancelled:
+                        break
+                    events.put((attempt, chunk, None))
+            finally:
+                chunks.close()
+        except Exception as e:
+            error = e
+        finally:
+            pool.release(attempt.backend, self.model, error)
+            events.put((attempt, None, error))
+
+    def _finish_stats(self, started: float):
+        """优先使用ollama返回的eval_count/eval_duration计算生成速度"""
+        if self.final_chunk is not None and self.final_chunk.get('eval_duration'):
+            eval_count = self.final_chunk.get('eval_count') or 0
+            self.stats['eval_count'] = eval_count
+            self.stats['tokens_per_second'] = round(eval_count / (self.final_chunk['eval_duration'] / 1e9), 2)
+        elif self.stats['ttft'] is not None:
+            # 提前取消时没有最终统计，按产出的块数粗略估算
+            generation = max(time.time() - started - self.stats['ttft'], 1e-9)
+            self.stats['eval_count'] = self.stats['chunks']
+            self.stats['tokens_per_second'] = round(self.stats['chunks'] / generation, 2)
+
+    def close(self):
+        """关闭流式连接并结束统计"""
+        if self._iterator is not None:
+            self._iterator.close()
+
+    def format_stats(self) -> str:
+        ttft = self.stats['ttft']
+        tps = self.stats['tokens_per_second']
+        return (f"{self.model} 首token {ttft if ttft is not None else '-'}s, "
+                f"{tps if tps is not None else '-'} tokens/s, 总耗时 {self.stats['total_seconds']}s")
+
+
+class UpdateThrottle:
+    """流式输出的界面刷新节流
+
+    距上次刷新超过interval秒，或新增内容达到max_chars个字符时才刷新，
+    避免长回答逐token推送把websocket占满。第一次调用总是刷新，尽早显示首个内容。
+    """
+
+    def __init__(self, interval: float = STREAM_UI_INTERVAL, max_chars: int = STREAM_UI_MAX_CHARS):
+        self.interval = interval
+        self.max_chars = max_chars
+        self._last_time = None
+        self._last_length = 0
+
+    def ready(self, text: str) -> bool:
+        """text为当前的累计文本，返回是否应该刷新界面"""
+        now = time.monotonic()
+        pending = len(text) - self._last_length
+        # pending为负说明文本重新开始（如识别升级分辨率重试），立即刷新
+        if (self._last_time is None or pending < 0 or pending >= self.max_chars
+                or now - self._last_time >= self.interval):
+            self._last_time = now
+            self._last_length = len(text)
+            return True
+        return False
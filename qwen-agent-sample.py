@@ -1,6 +1,5 @@
 import copy
 import os
-import ollama
 from typing import Dict, Iterator, List, Optional, Union
 from qwen_agent import Agent
 from qwen_agent.tools import BaseTool
@@ -8,7 +7,11 @@ from qwen_agent.agents import Assistant
 from qwen_agent.llm import BaseChatModel
 from qwen_agent.llm.schema import Message, ContentItem
 from qwen_agent.gui import WebUI
-from qwen_agent.utils.utils import encode_image_as_base64
+from admission import gradio_concurrency_limit, run_admitted
+from cancellation import Cancelled, cancellable_iter
+from concurrency_limit import limited_chat
+from ollama_stream import ChatStream
+from image_transport import wire_payload
 
 # 配置本地ollama服务的模型名称
 llm_config = {
@@ -30,11 +33,13 @@ class OllamaLLM(BaseChatModel):
         self.model_name = model_config['model']
         self.temperature = model_config.get('temperature', 0.1)
         self.max_tokens = model_config.get('max_tokens', 2048)
+        # 最近一次流式调用的首token时间和生成速度
+        self.last_stream_stats = None
     
     def _chat(self, messages, **kwargs):
         return self._chat_no_stream(messages, **kwargs)
     
-    def _chat_no_stream(self, messages, **kwargs):
+    def _to_ollama_messages(self, messages):
         # 转换qwen-agent的消息格式为ollama的消息格式
         ollama_messages = []
         
@@ -63,18 +68,14 @@ class OllamaLLM(BaseChatModel):
                         if item.text:
                             content_text += item.text + '\n'
                         if item.image:
-                            # 检查是否为base64编码
-                            if isinstance(item.image, str) and item.image.startswith('data:image/'):
-                                images.append(item.image)
-                            elif isinstance(item.image, str):
-                                # 文件路径，直接使用
-                                images.append(item.image)
+                            # 文件路径或data URL，经传输层转成原始字节（能转发原文件时不重新编码）
+                            images.append(wire_payload(item.image))
                     elif isinstance(item, dict):
                         # 处理字典格式的内容
                         if 'text' in item:
                             content_text += item['text'] + '\n'
                         if 'image' in item:
-                            images.append(item['image'])
+                            images.append(wire_payload(item['image']))
             elif isinstance(content, str):
                 content_text = content
             else:
@@ -91,16 +92,23 @@ class OllamaLLM(BaseChatModel):
                 ollama_message['images'] = images
             
             ollama_messages.append(ollama_message)
+        return ollama_messages
+
+    def _options(self):
+        return {
+            'temperature': self.temperature,
+            'max_tokens': self.max_tokens
+        }
+
+    def _chat_no_stream(self, messages, **kwargs):
+        ollama_messages = self._to_ollama_messages(messages)
         
         try:
-            # 调用本地ollama服务
-            response = ollama.chat(
+            # 调用ollama服务，由后端池选择主机
+            response = limited_chat(
                 model=self.model_name,
                 messages=ollama_messages,
-                options={
-                    'temperature': self.temperature,
-                    'max_tokens': self.max_tokens
-                }
+                options=self._options()
             )
             
             # 返回响应，确保返回Message对象
@@ -108,31 +116,31 @@ class OllamaLLM(BaseChatModel):
             print("模型响应:", result_content)
             
             return Message(role='assistant', content=result_content)
+        except Cancelled:
+            # 停止生成或超过截止时间，交给外层结束整个请求，不当作模型错误显示
+            raise
         except Exception as e:
             print(f"调用ollama服务时出错: {str(e)}")
             error_message = f"调用模型时出错: {str(e)}"
             return Message(role='assistant', content=error_message)
             
     def _chat_stream(self, messages, **kwargs):
-        # 简单实现流式响应，返回非流式响应的生成器
-        response = self._chat_no_stream(messages, **kwargs)
-        # 确保返回的是Message对象
-        if isinstance(response, Message):
-            yield [response]
-        elif isinstance(response, list):
-            # 确保列表中的每个元素都是Message对象
-            valid_messages = []
-            for msg in response:
-                if isinstance(msg, Message):
-                    valid_messages.append(msg)
-                elif isinstance(msg, dict) and 'role' in msg and 'content' in msg:
-                    valid_messages.append(Message(role=msg['role'], content=msg['content']))
-                else:
-                    valid_messages.append(Message(role='assistant', content=str(msg)))
-            yield valid_messages
-        else:
-            # 如果返回的是其他类型，包装成Message对象
-            yield [Message(role='assistant', content=str(response))]
+        # 使用ollama的流式输出，边生成边产出；delta_stream为True时只产出新增片段
+        delta_stream = kwargs.get('delta_stream', False)
+        stream = ChatStream(self.model_name, self._to_ollama_messages(messages), self._options())
+        try:
+            for delta in stream:
+                yield [Message(role='assistant', content=delta if delta_stream else stream.text)]
+        except Cancelled:
+            raise
+        except Exception as e:
+            print(f"调用ollama服务时出错: {str(e)}")
+            yield [Message(role='assistant', content=f"调用模型时出错: {str(e)}")]
+        finally:
+            # 调用方提前停止迭代时关闭连接，让ollama停止生成
+            stream.close()
+            self.last_stream_stats = stream.stats
+            print(f"⏱️ {stream.format_stats()}")
         
     def _chat_with_functions(self, messages, functions, **kwargs):
         # 实现带函数调用的聊天
@@ -190,6 +198,20 @@ class Visual_solve_equations(Agent):
 
     def _run(self, messages: List[Message],
              lang: str = 'zh', **kwargs) -> Iterator[List[Message]]:
+        # 先经过准入控制，排队时以助手消息显示排队位置
+        def reply(text: str) -> List[Message]:
+            return [Message(role='assistant', content=text)]
+
+        # WebUI停止生成时会关闭这个生成器，模型调用随之关闭连接、停止生成；
+        # 超过截止时间（REQUEST_DEADLINE）时同样中止
+        steps = run_admitted(lambda: self._solve_steps(messages, lang=lang, **kwargs), queued=reply, busy=reply)
+        try:
+            yield from cancellable_iter(steps)
+        except Cancelled as e:
+            yield reply(f"🛑 {e}")
+
+    def _solve_steps(self, messages: List[Message],
+                     lang: str = 'zh', **kwargs) -> Iterator[List[Message]]:
         # 确保消息格式正确
         if not messages:
             yield [Message(role='assistant', content='没有收到消息')]
@@ -250,26 +272,16 @@ class Visual_solve_equations(Agent):
         # 将图像路径从file://格式转换为本地路径
         image_path = str(input_image).replace('file://', '')
         
-        # 确保图像路径正确，并转换为base64编码格式
-        try:
-            # 检查图像文件是否存在
-            if os.path.exists(image_path):
-                # 将图像转换为base64编码
-                base64_image = encode_image_as_base64(image_path)
-                print(f'图像已成功转换为base64编码')
-            else:
-                print(f'警告：图像文件不存在: {image_path}')
-                base64_image = image_path
-        except Exception as e:
-            print(f'转换图像时出错: {str(e)}')
-            base64_image = image_path
-        
+        # 图像保持为本地路径，发送时由传输层直接转发原文件字节，不再预先转成base64
+        if not os.path.exists(image_path):
+            print(f'警告：图像文件不存在: {image_path}')
+
         # 创建包含文本和编码后图像的新消息
         image_message = Message(
             role='user',
             content=[
                 ContentItem(text=input_text),
-                ContentItem(image=base64_image)
+                ContentItem(image=image_path)
             ]
         )
         
@@ -301,8 +313,11 @@ class Visual_solve_equations(Agent):
 def app_gui():
     bot = Visual_solve_equations(llm=llm_config)
     WebUI(bot).run(
-        server_name="192.168.31.122",
-        server_port=7861
+        # 界面监听地址，默认监听所有网卡；ollama地址由OLLAMA_HOST/OLLAMA_BACKENDS配置
+        server_name=os.environ.get('GRADIO_SERVER_NAME', '0.0.0.0'),
+        server_port=7861,
+        # 排队和拒绝由准入控制负责，Gradio的并发上限高于准入容量，超出的请求才能被立即拒绝
+        concurrency_limit=gradio_concurrency_limit()
     )
 
 
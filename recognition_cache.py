@@ -0,0 +1,228 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Dict, Optional
+
+from image_hash import MultiIndexHammingIndex, thumbnail_difference
+
+# 缓存配置，可通过环境变量覆盖
+DEFAULT_CACHE_DIR = os.environ.get('RECOGNITION_CACHE_DIR', '.cache')
+DEFAULT_MEMORY_SIZE = int(os.environ.get('RECOGNITION_CACHE_SIZE', '1024'))
+# 近重复图片的最大感知哈希汉明距离，负数（默认-1）关闭近重复检索，0只接受感知哈希完全相同的候选。
+# 感知哈希分不清只差一个字符的题目，如 "2x - 4 = 0" 和 "2x - 4 = 1" 的距离为0，开启时建议不超过4
+DEFAULT_NEAR_DISTANCE = int(os.environ.get('NEAR_DUPLICATE_DISTANCE', '-1'))
+# 感知哈希的候选还要通过像素级校验：缩略图分块差异的最大值不超过该值（见 image_hash.thumbnail_difference）
+DEFAULT_NEAR_MAX_DIFFERENCE = float(os.environ.get('NEAR_DUPLICATE_MAX_DIFFERENCE', '0.05'))
+# 每个命名空间最多保留的近重复条目数，超出时删除最早的条目
+DEFAULT_NEAR_MAX_ENTRIES = int(os.environ.get('NEAR_DUPLICATE_MAX_ENTRIES', '10000'))
+
+
+def make_namespace(model: str, prompt: str, options: Optional[Dict] = None) -> str:
+    """近重复检索的命名空间：同模型、同提示词、同参数的结果才可复用"""
+    return make_cache_key('', model, prompt, options)
+
+
+def make_cache_key(pixel_digest: str, model: str, prompt: str, options: Optional[Dict] = None) -> str:
+    """由像素摘要、模型名、提示词和推理参数生成缓存键"""
+    material = json.dumps(
+        {
+            'pixels': pixel_digest,
+            'model': model,
+            'prompt': prompt,
+            'options': options or {},
+        },
+        sort_keys=True,
+        ensure_ascii=False,
+    )
+    return hashlib.sha256(material.encode('utf-8')).hexdigest()
+
+
+class RecognitionCache:
+    """图像识别结果缓存：内存LRU + 磁盘SQLite两级，另带感知哈希近重复检索
+
+    近重复检索先按感知哈希在多索引汉明表中找候选，再比较像素缩略图，
+    只有局部也几乎相同的图片才复用识别结果。
+    """
+
+    def __init__(self, cache_dir: Optional[str] = DEFAULT_CACHE_DIR, max_memory_items: int = DEFAULT_MEMORY_SIZE,
+                 near_distance: int = DEFAULT_NEAR_DISTANCE,
+                 near_max_difference: float = DEFAULT_NEAR_MAX_DIFFERENCE,
+                 near_max_entries: int = DEFAULT_NEAR_MAX_ENTRIES):
+        self.max_memory_items = max_memory_items
+        self.near_distance = near_distance
+        self.near_max_difference = near_max_difference
+        self.near_max_entries = near_max_entries
+        self._memory = OrderedDict()
+        self._near_indexes: Dict[str, MultiIndexHammingIndex] = {}
+        self._lock = threading.Lock()
+        self.stats = {'memory_hits': 0, 'disk_hits': 0, 'near_hits': 0, 'misses': 0}
+
+        # cache_dir为None时只启用内存缓存
+        self._db = None
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+            self.db_path = os.path.join(cache_dir, 'recognition_cache.sqlite')
+            self._db = sqlite3.connect(self.db_path, check_same_thread=False)
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS recognition '
+                '(key TEXT PRIMARY KEY, text TEXT NOT NULL, created_at REAL NOT NULL)'
+            )
+            columns = {row[1] for row in self._db.execute('PRAGMA table_info(near_duplicates)')}
+            if columns and 'thumbnail' not in columns:
+                # 旧版本的条目没有缩略图，无法做像素级校验，直接丢弃
+                self._db.execute('DROP TABLE near_duplicates')
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS near_duplicates '
+                '(namespace TEXT NOT NULL, phash TEXT NOT NULL, thumbnail BLOB NOT NULL, text TEXT NOT NULL, '
+                'created_at REAL NOT NULL)'
+            )
+            self._db.execute(
+                'CREATE INDEX IF NOT EXISTS near_duplicates_namespace ON near_duplicates (namespace, created_at)'
+            )
+            self._db.commit()
+
+    @property
+    def near_enabled(self) -> bool:
+        return self.near_distance >= 0
+
+    def get(self, key: str) -> Optional[str]:
+        """查询缓存，未命中返回None"""
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                self.stats['memory_hits'] += 1
+                return self._memory[key]
+
+            if self._db is not None:
+                row = self._db.execute('SELECT text FROM recognition WHERE key = ?', (key,)).fetchone()
+                if row is not None:
+                    self.stats['disk_hits'] += 1
+                    self._remember(key, row[0])
+                    return row[0]
+
+            return None
+
+    def put(self, key: str, text: str):
+        """写入缓存（内存和磁盘）"""
+        with self._lock:
+            self._remember(key, text)
+            if self._db is not None:
+                self._db.execute(
+                    'INSERT OR REPLACE INTO recognition (key, text, created_at) VALUES (?, ?, ?)',
+                    (key, text, time.time()),
+                )
+                self._db.commit()
+
+    def get_similar(self, namespace: str, phash_value: int, thumbnail: bytes) -> Optional[str]:
+        """查找近重复图片的识别结果：感知哈希距离在范围内并且缩略图通过像素级校验，未命中返回None"""
+        if not self.near_enabled:
+            return None
+        with self._lock:
+            for _, (text, candidate) in self._near_index(namespace).search(phash_value, self.near_distance):
+                if thumbnail_difference(thumbnail, candidate) <= self.near_max_difference:
+                    self.stats['near_hits'] += 1
+                    return text
+            return None
+
+    def put_similar(self, namespace: str, phash_value: int, thumbnail: bytes, text: str):
+        """登记图片感知哈希、缩略图与识别结果"""
+        if not self.near_enabled:
+            return
+        with self._lock:
+            index = self._near_index(namespace)
+            index.add(phash_value, (text, thumbnail))
+            if self._db is not None:
+                self._db.execute(
+                    'INSERT INTO near_duplicates (namespace, phash, thumbnail, text, created_at) VALUES (?, ?, ?, ?, ?)',
+                    (namespace, f'{phash_value:016x}', thumbnail, text, time.time()),
+                )
+                self._db.commit()
+            if len(index) > self.near_max_entries:
+                self._trim_near(namespace)
+
+    def _trim_near(self, namespace: str):
+        """删除最早的条目，保留上限的90%，避免每次写入都触发；内存索引不支持删除，下次使用时重新加载"""
+        keep = int(self.near_max_entries * 0.9)
+        if self._db is not None:
+            self._db.execute(
+                'DELETE FROM near_duplicates WHERE namespace = ? AND rowid NOT IN '
+                '(SELECT rowid FROM near_duplicates WHERE namespace = ? ORDER BY created_at DESC LIMIT ?)',
+                (namespace, namespace, keep),
+            )
+            self._db.commit()
+            del self._near_indexes[namespace]
+        else:
+            # 只有内存索引时按写入顺序保留最新的条目
+            old = self._near_indexes.pop(namespace)
+            index = self._near_indexes[namespace] = MultiIndexHammingIndex()
+            for hash_value, value in old.items()[-keep:]:
+                index.add(hash_value, value)
+
+    def record_miss(self):
+        """精确与近重复检索都未命中时记一次未命中"""
+        with self._lock:
+            self.stats['misses'] += 1
+
+    def _near_index(self, namespace: str) -> MultiIndexHammingIndex:
+        """获取命名空间的近重复索引，首次使用时从磁盘加载"""
+        index = self._near_indexes.get(namespace)
+        if index is None:
+            index = MultiIndexHammingIndex()
+            if self._db is not None:
+                rows = self._db.execute(
+                    'SELECT phash, thumbnail, text FROM near_duplicates WHERE namespace = ? ORDER BY created_at',
+                    (namespace,)
+                )
+                for phash_hex, thumbnail, text in rows:
+                    index.add(int(phash_hex, 16), (text, thumbnail))
+            self._near_indexes[namespace] = index
+        return index
+
+    def _remember(self, key: str, text: str):
+        """写入内存LRU并淘汰最久未使用的条目"""
+        self._memory[key] = text
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_items:
+            self._memory.popitem(last=False)
+
+    def hit_rate(self) -> float:
+        """缓存命中率"""
+        hits = self.stats['memory_hits'] + self.stats['disk_hits'] + self.stats['near_hits']
+        total = hits + self.stats['misses']
+        return hits / total if total else 0.0
+
+    def report(self) -> str:
+        """命中率报告"""
+        return (
+            f"识别缓存命中率 {self.hit_rate():.1%} "
+            f"(内存命中 {self.stats['memory_hits']}, 磁盘命中 {self.stats['disk_hits']}, "
+            f"近重复命中 {self.stats['near_hits']}, "
+            f"未命中 {self.stats['misses']})"
+        )
+
+    def clear(self):
+        """清空两级缓存"""
+        with self._lock:
+            self._memory.clear()
+            self._near_indexes.clear()
+            if self._db is not None:
+                self._db.execute('DELETE FROM recognition')
+                self._db.execute('DELETE FROM near_duplicates')
+                self._db.commit()
+
+
+_default_cache = None
+_default_cache_lock = threading.Lock()
+
+
+def get_recognition_cache() -> RecognitionCache:
+    """获取进程内共享的识别缓存"""
+    global _default_cache
+    with _default_cache_lock:
+        if _default_cache is None:
+            _default_cache = RecognitionCache()
+        return _default_cache
@@ -0,0 +1,182 @@
+import os
+import time
+import random
+import asyncio
+import threading
+from collections import deque
+from typing import Awaitable, Callable, Dict, Iterator, Optional, Tuple, TypeVar
+
+import httpx
+import ollama
+
+from cancellation import check_cancelled
+from solver_metrics import MODEL_RETRIES
+
+T = TypeVar('T')
+
+# 各阶段单次调用的超时（秒）：非流式调用为整个响应，流式调用为相邻两块之间的最长间隔（卡住的生成）
+STAGE_TIMEOUTS = {
+    'vision': float(os.environ.get('OLLAMA_TIMEOUT_VISION', '60')),
+    'math': float(os.environ.get('OLLAMA_TIMEOUT_MATH', '120')),
+    'embed': float(os.environ.get('OLLAMA_TIMEOUT_EMBED', '30')),
+}
+# 可重试错误的最多重试次数；退避为 [0, min(上限, 基数 * 2^n)] 之间的随机值（full jitter）
+OLLAMA_RETRIES = int(os.environ.get('OLLAMA_RETRIES', '2'))
+OLLAMA_RETRY_BASE = float(os.environ.get('OLLAMA_RETRY_BASE', '0.5'))
+OLLAMA_RETRY_MAX_DELAY = float(os.environ.get('OLLAMA_RETRY_MAX_DELAY', '5'))
+# 熔断：同一后端连续失败这么多次后熔断，冷却期过后放行一个试探请求
+OLLAMA_BREAKER_FAILURES = int(os.environ.get('OLLAMA_BREAKER_FAILURES', '5'))
+OLLAMA_BREAKER_COOLDOWN = float(os.environ.get('OLLAMA_BREAKER_COOLDOWN', '30'))
+# 对冲请求：设置 OLLAMA_HEDGE=1 后，流式调用超过首token时间的p95仍没有输出时，向另一台主机发出备份请求
+OLLAMA_HEDGE = os.environ.get('OLLAMA_HEDGE', '0') == '1'
+OLLAMA_HEDGE_PERCENTILE = float(os.environ.get('OLLAMA_HEDGE_PERCENTILE', '0.95'))
+# 样本不足时不对冲；对冲等待不短于该秒数，避免首token本来就很快时频繁重复请求
+HEDGE_MIN_SAMPLES = 20
+OLLAMA_HEDGE_MIN_DELAY = float(os.environ.get('OLLAMA_HEDGE_MIN_DELAY', '0.5'))
+TTFT_WINDOW = 200
+
+
+def stage_timeout(stage: str) -> float:
+    """某个阶段单次调用的超时，未知阶段按解题阶段处理"""
+    return STAGE_TIMEOUTS.get(stage, STAGE_TIMEOUTS['math'])
+
+
+def is_retryable(error: BaseException) -> bool:
+    """连接失败、超时、5xx和429可以重试；模型不存在等4xx错误重试也没用"""
+    if isinstance(error, ollama.ResponseError):
+        return error.status_code >= 500 or error.status_code == 429
+    return isinstance(error, (ConnectionError, httpx.TransportError, asyncio.TimeoutError, TimeoutError))
+
+
+def backoff_delay(attempt: int) -> float:
+    """第attempt次重试（从0开始）前的等待时间"""
+    return random.uniform(0, min(OLLAMA_RETRY_MAX_DELAY, OLLAMA_RETRY_BASE * 2 ** attempt))
+
+
+def _note_retry(stage: str, attempt: int, error: BaseException) -> float:
+    # 请求已取消或超过截止时间时不再重试
+    check_cancelled()
+    delay = backoff_delay(attempt)
+    MODEL_RETRIES.inc(stage=stage)
+    print(f"🔁 {stage}调用失败（{type(error).__name__}: {error}），{delay:.2f}s 后第{attempt + 1}次重试")
+    return delay
+
+
+def retry_call(fn: Callable[[], T], stage: str, retries: int = OLLAMA_RETRIES) -> T:
+    """执行一次模型调用，可重试的错误按带抖动的指数退避重试
+
+    模型调用没有副作用，可以安全重试。每次重试都重新经过后端池，
+    失败的主机被摘除或熔断后会换一台。
+    """
+    attempt = 0
+    while True:
+        try:
+            return fn()
+        except Exception as e:
+            if attempt >= retries or not is_retryable(e):
+                raise
+            time.sleep(_note_retry(stage, attempt, e))
+            attempt += 1
+
+
+def retry_stream(start: Callable[[], Iterator[T]], stage: str, can_retry: Callable[[], bool],
+                 retries: int = OLLAMA_RETRIES) -> Iterator[T]:
+    """retry_call的流式版本：只有还没向调用方产出内容（can_retry()为真）时才重新发起"""
+    attempt = 0
+    while True:
+        try:
+            yield from start()
+            return
+        except Exception as e:
+            if attempt >= retries or not is_retryable(e) or not can_retry():
+                raise
+            time.sleep(_note_retry(stage, attempt, e))
+            attempt += 1
+
+
+async def aretry_call(fn: Callable[[], Awaitable[T]], stage: str, retries: int = OLLAMA_RETRIES) -> T:
+    """retry_call的异步版本"""
+    attempt = 0
+    while True:
+        try:
+            return await fn()
+        except Exception as e:
+            if attempt >= retries or not is_retryable(e):
+                raise
+            await asyncio.sleep(_note_retry(stage, attempt, e))
+            attempt += 1
+
+
+class CircuitBreaker:
+    """单个后端的熔断器
+
+    连续失败 failure_threshold 次后打开，冷却 cooldown 秒内不再把请求发给该后端；
+    冷却结束后进入半开状态，只放行一个试探请求，成功则关闭，失败则重新打开。
+    """
+
+    def __init__(self, name: str, failure_threshold: int = OLLAMA_BREAKER_FAILURES,
+                 cooldown: float = OLLAMA_BREAKER_COOLDOWN):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.state = 'closed'
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def available(self) -> bool:
+        """能否接收请求（不改变状态，供挑选后端时过滤）"""
+        with self._lock:
+            if self.state == 'closed':
+                return True
+            if self.state == 'open':
+                return time.monotonic() - self.opened_at >= self.cooldown
+            return not self._probing
+
+    def on_lease(self):
+        """请求确定发往该后端时调用，冷却结束后的第一个请求作为试探"""
+        with self._lock:
+            if self.state != 'closed' and time.monotonic() - self.opened_at >= self.cooldown:
+                self.state = 'half_open'
+                self._probing = True
+
+    def record(self, error: Optional[BaseException]) -> Optional[str]:
+        """记录一次调用结果，状态变化时返回新状态"""
+        with self._lock:
+            previous = self.state
+            if error is None:
+                self.failures = 0
+                self.state = 'closed'
+            elif is_retryable(error):
+                self.failures += 1
+                if self.state == 'half_open' or self.failures >= self.failure_threshold:
+                    self.state = 'open'
+                    self.opened_at = time.monotonic()
+            self._probing = False
+            return self.state if self.state != previous else None
+
+
+class TtftTracker:
+    """按阶段和模型记录最近的首token时间，用于决定对冲等待多久"""
+
+    def __init__(self, window: int = TTFT_WINDOW):
+        self.window = window
+        self._samples: Dict[Tuple[str, str], deque] = {}
+        self._lock = threading.Lock()
+
+    def record(self, stage: str, model: str, ttft: float):
+        with self._lock:
+            self._samples.setdefault((stage, model), deque(maxlen=self.window)).append(ttft)
+
+    def hedge_delay(self, stage: str, model: str) -> Optional[float]:
+        """首token时间的p95，样本不足时返回None（不对冲）"""
+        with self._lock:
+            samples = sorted(self._samples.get((stage, model), ()))
+        if len(samples) < HEDGE_MIN_SAMPLES:
+            return None
+        index = min(int(len(samples) * OLLAMA_HEDGE_PERCENTILE), len(samples) - 1)
+        return max(samples[index], OLLAMA_HEDGE_MIN_DELAY)
+
+
+TTFT_TRACKER = TtftTracker()
@@ -0,0 +1,324 @@
+import os
+import re
+import json
+import zlib
+import queue
+import hashlib
+import threading
+import unicodedata
+from concurrent.futures import Future
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from backend_pool import get_backend_pool
+from cancellation import call_timeout
+from recognition_cache import DEFAULT_CACHE_DIR
+from resilience import retry_call, stage_timeout
+from solution_cache import normalize_problem_text
+
+# 语义缓存默认关闭，设置 SEMANTIC_CACHE=1 开启
+SEMANTIC_CACHE = os.environ.get('SEMANTIC_CACHE', '0') == '1'
+SEMANTIC_CACHE_DIR = os.environ.get('SEMANTIC_CACHE_DIR', os.path.join(DEFAULT_CACHE_DIR or '.cache', 'semantic'))
+# 嵌入模型：ollama上的嵌入模型名，或 hashing 使用本地字符n-gram哈希嵌入（无需模型，适合离线和压测）
+EMBEDDING_MODEL = os.environ.get('EMBEDDING_MODEL', 'nomic-embed-text')
+# 余弦相似度不低于该值才复用解答；按 nomic-embed-text 设定，hashing 嵌入只比较字面，换说法的题目通常低于该值
+SEMANTIC_THRESHOLD = float(os.environ.get('SEMANTIC_CACHE_THRESHOLD', '0.92'))
+# 并发的嵌入请求在该时间窗口内合并为一次批量调用
+EMBED_BATCH_WAIT = float(os.environ.get('EMBED_BATCH_WAIT', '0.005'))
+EMBED_MAX_BATCH = int(os.environ.get('EMBED_MAX_BATCH', '32'))
+
+HASHING_DIMENSIONS = 256
+
+_NUMBER = re.compile(r'[-+]?\d+(?:\.\d+)?')
+_DIGITS = re.compile(r'\d+(?:\.\d+)?')
+# 规范化文本中的公式片段：连续的字母、数字、运算符和括号，中文、标点和空白处断开
+_FORMULA = re.compile(r'[A-Za-z0-9.+\-*/^=<>()\[\]{}\\_|!]+')
+_OPERATORS = set('+-*/^=<>')
+# NFKC不处理的减号变体
+_MINUS_SIGNS = str.maketrans({'−': '-', '–': '-', '—': '-'})
+
+
+def numeric_signature(text: str) -> Tuple[str, ...]:
+    """按出现顺序提取题目中的数值常量（连同正负号），数值不同的题目不会互相命中"""
+    text = unicodedata.normalize('NFKC', text).translate(_MINUS_SIGNS)
+    return tuple(_NUMBER.findall(re.sub(r'\s+', '', text)))
+
+
+def formula_skeleton(text: str) -> Tuple[str, ...]:
+    """题目中各公式片段的运算符/变量骨架，数值替换为#
+
+    “解方程 2x-4=0”与“求x: 2x − 4 = 0”的骨架都是 ('#x-#=#',)；运算或变量不同的题目
+    （2x+4=0、2y-4=0、x^2-4=0）骨架不同，即使数值常量相同也不会互相命中。
+    """
+    skeleton = []
+    for token in _FORMULA.findall(normalize_problem_text(text)):
+        # 不含运算符的片段（“求x”里的x、英文单词）是措辞，不是公式
+        if _OPERATORS.intersection(token):
+            skeleton.append(_DIGITS.sub('#', token))
+    return tuple(skeleton)
+
+
+def hashing_embed(texts: Sequence[str], dimensions: int = HASHING_DIMENSIONS) -> np.ndarray:
+    """字符1-3gram的带符号特征哈希嵌入，作为不依赖嵌入模型的本地替代"""
+    vectors = np.zeros((len(texts), dimensions), dtype=np.float32)
+    for row, text in enumerate(texts):
+        for n in (1, 2, 3):
+            for i in range(len(text) - n + 1):
+                value = zlib.crc32(text[i:i + n].encode('utf-8'))
+                vectors[row, value % dimensions] += 1.0 if value & 0x80000000 else -1.0
+    return vectors
+
+
+def embed_texts(texts: Sequence[str], model: str = EMBEDDING_MODEL) -> np.ndarray:
+    """批量计算文本嵌入，返回float32矩阵
+
+    与对话调用一样经过后端池和熔断器，单次调用超过embed阶段的超时即放弃，可重试的错误按退避重试。
+    """
+    if model == 'hashing':
+        return hashing_embed(texts)
+
+    def call():
+        with get_backend_pool().lease(model) as backend:
+            return backend.embed(timeout=call_timeout(stage_timeout('embed')), model=model, input=list(texts))
+
+    response = retry_call(call, 'embed')
+    return np.asarray(response['embeddings'], dtype=np.float32)
+
+
+class EmbeddingBatcher:
+    """把并发的嵌入请求合并为批量调用
+
+    后台线程取到第一个请求后再等待 wait_seconds，收集同期到达的请求（最多max_batch条）
+    一起发给嵌入模型，每条文本通过Future拿到自己的向量。
+    """
+
+    def __init__(self, model: str = EMBEDDING_MODEL, wait_seconds: float = EMBED_BATCH_WAIT,
+                 max_batch: int = EMBED_MAX_BATCH):
+        self.model = model
+        self.wait_seconds = wait_seconds
+        self.max_batch = max_batch
+        self._queue = queue.Queue()
+        self.stats = {'texts': 0, 'calls': 0}
+        threading.Thread(target=self._run, name='embedding-batcher', daemon=True).start()
+
+    def submit(self, texts: Sequence[str]) -> List[Future]:
+        futures = []
+        for text in texts:
+            future = Future()
+            self._queue.put((text, future))
+            futures.append(future)
+        return futures
+
+    def embed(self, texts: Sequence[str]) -> np.ndarray:
+        """计算嵌入并等待结果"""
+        return np.stack([future.result() for future in self.submit(texts)])
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            try:
+                while len(batch) < self.max_batch:
+                    batch.append(self._queue.get(timeout=self.wait_seconds))
+            except queue.Empty:
+                pass
+            try:
+                vectors = embed_texts([text for text, _ in batch], self.model)
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            self.stats['texts'] += len(batch)
+            self.stats['calls'] += 1
+            for (_, future), vector in zip(batch, vectors):
+                future.set_result(vector)
+
+
+class VectorIndex:
+    """NumPy最近邻索引，按分桶（命名空间+数值常量+公式骨架）做精确余弦检索
+
+    向量以float32原始字节追加写入 vectors.f32，条目信息追加写入 entries.jsonl；
+    启动时vectors.f32以内存映射方式打开，不把全部向量读入内存。
+    """
+
+    def __init__(self, directory: Optional[str], dimensions: Optional[int] = None):
+        self.directory = directory
+        self.dimensions = dimensions
+        self._persisted = None
+        self._appended: List[np.ndarray] = []
+        self._answers: List[str] = []
+        self._buckets: Dict[str, List[int]] = {}
+        self._lock = threading.Lock()
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+            self._load()
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    def _load(self):
+        meta_path = self._path('index.json')
+        if not os.path.exists(meta_path):
+            return
+        with open(meta_path, 'r', encoding='utf-8') as f:
+            self.dimensions = json.load(f)['dimensions']
+        with open(self._path('entries.jsonl'), 'r', encoding='utf-8') as f:
+            entries = []
+            for line in f:
+                try:
+                    entries.append(json.loads(line))
+                except json.JSONDecodeError:
+                    # 上次中断时可能留下半行
+                    break
+        vector_bytes = os.path.getsize(self._path('vectors.f32'))
+        count = min(len(entries), vector_bytes // (4 * self.dimensions))
+        # 两个文件的条数不一致（写入中途被中断）时截断到一致，之后的追加才能对齐
+        if count * 4 * self.dimensions != vector_bytes:
+            os.truncate(self._path('vectors.f32'), count * 4 * self.dimensions)
+        if count != len(entries):
+            with open(self._path('entries.jsonl'), 'w', encoding='utf-8') as f:
+                for entry in entries[:count]:
+                    f.write(json.dumps(entry, ensure_ascii=False) + '\n')
+        if count:
+            self._persisted = np.memmap(self._path('vectors.f32'), dtype=np.float32, mode='r',
+                                        shape=(count, self.dimensions))
+        for row, entry in enumerate(entries[:count]):
+            self._answers.append(entry['answer'])
+            self._buckets.setdefault(entry['bucket'], []).append(row)
+
+    def __len__(self) -> int:
+        return len(self._answers)
+
+    def _vector(self, row: int) -> np.ndarray:
+        persisted = 0 if self._persisted is None else len(self._persisted)
+        return self._persisted[row] if row < persisted else self._appended[row - persisted]
+
+    def search(self, bucket: str, vector: np.ndarray) -> Tuple[Optional[str], float]:
+        """返回同一分桶中余弦相似度最高的解答及相似度"""
+        with self._lock:
+            rows = list(self._buckets.get(bucket, ()))
+            if not rows:
+                return None, 0.0
+            candidates = np.stack([self._vector(row) for row in rows])
+            scores = candidates @ vector
+            best = int(np.argmax(scores))
+            return self._answers[rows[best]], float(scores[best])
+
+    def add(self, buckets: Sequence[str], vectors: np.ndarray, answers: Sequence[str]):
+        with self._lock:
+            if self.dimensions is None:
+                self.dimensions = vectors.shape[1]
+            if self.directory:
+                self._persist(buckets, vectors, answers)
+            for bucket, vector, answer in zip(buckets, vectors, answers):
+                self._buckets.setdefault(bucket, []).append(len(self._answers))
+                self._answers.append(answer)
+                self._appended.append(vector)
+
+    def _persist(self, buckets: Sequence[str], vectors: np.ndarray, answers: Sequence[str]):
+        meta_path = self._path('index.json')
+        if not os.path.exists(meta_path):
+            with open(meta_path, 'w', encoding='utf-8') as f:
+                json.dump({'dimensions': self.dimensions}, f)
+        # 先写向量再写条目，加载时以两者中较少的一方为准
+        with open(self._path('vectors.f32'), 'ab') as f:
+            f.write(np.ascontiguousarray(vectors, dtype=np.float32).tobytes())
+        with open(self._path('entries.jsonl'), 'a', encoding='utf-8') as f:
+            for bucket, answer in zip(buckets, answers):
+                f.write(json.dumps({'bucket': bucket, 'answer': answer}, ensure_ascii=False) + '\n')
+
+
+def _normalize_rows(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+class SemanticCache:
+    """按题目语义复用解答的缓存层，位于精确匹配的解答缓存之后
+
+    题目文本经嵌入模型转为向量，只在命名空间（模型、提示词、参数）、数值常量和公式骨架都相同的
+    条目中检索，余弦相似度不低于阈值时返回缓存的解答。
+    """
+
+    def __init__(self, directory: Optional[str] = SEMANTIC_CACHE_DIR, model: str = EMBEDDING_MODEL,
+                 threshold: float = SEMANTIC_THRESHOLD):
+        self.model = model
+        self.threshold = threshold
+        # 不同嵌入模型的向量不可比，各自使用独立的索引目录
+        index_dir = os.path.join(directory, re.sub(r'[^\w.-]', '_', model)) if directory else None
+        self.index = VectorIndex(index_dir)
+        self.batcher = EmbeddingBatcher(model)
+        self.stats = {'hits': 0, 'misses': 0, 'errors': 0}
+        self._stats_lock = threading.Lock()
+
+    @staticmethod
+    def bucket(namespace: str, problem_text: str) -> str:
+        material = json.dumps([namespace, numeric_signature(problem_text), formula_skeleton(problem_text)])
+        return hashlib.sha256(material.encode('utf-8')).hexdigest()
+
+    def _embed(self, texts: Sequence[str]) -> np.ndarray:
+        return _normalize_rows(self.batcher.embed([normalize_problem_text(text) for text in texts]))
+
+    def lookup_many(self, namespace: str, problem_texts: Sequence[str]) -> List[Optional[str]]:
+        """批量查询，返回与输入一一对应的解答（未命中为None）；嵌入失败时视为全部未命中"""
+        try:
+            vectors = self._embed(problem_texts)
+        except Exception as e:
+            print(f"⚠️ 语义缓存嵌入失败，跳过语义检索: {e}")
+            with self._stats_lock:
+                self.stats['errors'] += 1
+            return [None] * len(problem_texts)
+        answers = []
+        for text, vector in zip(problem_texts, vectors):
+            answer, score = self.index.search(self.bucket(namespace, text), vector)
+            answers.append(answer if answer is not None and score >= self.threshold else None)
+        with self._stats_lock:
+            hits = sum(answer is not None for answer in answers)
+            self.stats['hits'] += hits
+            self.stats['misses'] += len(answers) - hits
+        return answers
+
+    def lookup(self, namespace: str, problem_text: str) -> Optional[str]:
+        return self.lookup_many(namespace, [problem_text])[0]
+
+    def add_many(self, namespace: str, problem_texts: Sequence[str], answers: Sequence[str]):
+        """批量写入题目与解答，嵌入在后台批量计算，不阻塞调用方"""
+        futures = self.batcher.submit([normalize_problem_text(text) for text in problem_texts])
+        # 后台线程按提交顺序完成Future，最后一个完成时前面的都已完成
+        futures[-1].add_done_callback(lambda _: self._store(namespace, problem_texts, answers, futures))
+
+    def _store(self, namespace: str, problem_texts: Sequence[str], answers: Sequence[str],
+               futures: List[Future]):
+        try:
+            vectors = _normalize_rows(np.stack([future.result() for future in futures]))
+        except Exception as e:
+            print(f"⚠️ 语义缓存嵌入失败，解答未写入语义缓存: {e}")
+            with self._stats_lock:
+                self.stats['errors'] += 1
+            return
+        buckets = [self.bucket(namespace, text) for text in problem_texts]
+        self.index.add(buckets, vectors, answers)
+
+    def add(self, namespace: str, problem_text: str, answer: str):
+        self.add_many(namespace, [problem_text], [answer])
+
+    def report(self) -> str:
+        total = self.stats['hits'] + self.stats['misses']
+        rate = self.stats['hits'] / total if total else 0.0
+        return (f"语义缓存命中率 {rate:.1%} (命中 {self.stats['hits']}, 未命中 {self.stats['misses']}, "
+                f"索引 {len(self.index)} 条, 嵌入批次 {self.batcher.stats['calls']})")
+
+
+_default_cache = None
+_default_cache_lock = threading.Lock()
+
+
+def get_semantic_cache() -> Optional[SemanticCache]:
+    """获取进程内共享的语义缓存，未开启时返回None"""
+    global _default_cache
+    if not SEMANTIC_CACHE:
+        return None
+    with _default_cache_lock:
+        if _default_cache is None:
+            _default_cache = SemanticCache()
+        return _default_cache
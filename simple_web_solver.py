@@ -1,7 +1,5 @@
-import os
-import ollama
 from qwen_agent.gui import WebUI
-from qwen_agent.utils.utils import encode_image_as_base64
+from solver_core import recognize_image, solve_problem
 
 def math_solver(messages):
     """数学解题智能体"""
@@ -20,12 +18,8 @@ def math_solver(messages):
             if isinstance(content, list):
                 for item in content:
                     if hasattr(item, 'image') and item.image:
-                        image_path = str(item.image).replace('file://', '')
-                        
-                        if os.path.exists(image_path):
-                            image_data = encode_image_as_base64(image_path)
-                        else:
-                            image_data = image_path
+                        # 直接传递路径，由传输层读取原始字节，避免重复base64编码
+                        image_data = str(item.image).replace('file://', '')
                         break
     except Exception as e:
         print(f"处理图片时出错: {e}")
@@ -36,31 +30,14 @@ def math_solver(messages):
     try:
         print("🔍 步骤1: 识别图片中的数学内容...")
         
-        # 步骤1: 图像识别
-        vision_response = ollama.chat(
-            model='granite3.2-vision',
-            messages=[{
-                'role': 'user',
-                'content': '请识别图片中的数学方程式或题目，并转换为清晰的文本格式',
-                'images': [image_data]
-            }]
-        )
-        
-        recognized_text = vision_response['message']['content']
+        # 步骤1: 图像识别（命中识别缓存时不调用vision模型）
+        recognized_text = recognize_image(image_data)
         print(f"✅ 识别结果: {recognized_text}")
         
         print("🧮 步骤2: 解答数学问题...")
         
-        # 步骤2: 数学解题
-        math_response = ollama.chat(
-            model='qwen2:latest',
-            messages=[{
-                'role': 'user',
-                'content': f"请详细解答以下数学问题：\n{recognized_text}\n\n请提供完整的解题步骤和最终答案。"
-            }]
-        )
-        
-        final_answer = math_response['message']['content']
+        # 步骤2: 数学解题（经过SymPy快速通道、解答缓存、请求合并、后端池和自适应并发）
+        final_answer = solve_problem(recognized_text)
         return [final_answer]
         
     except Exception as e:
@@ -0,0 +1,149 @@
+import os
+import threading
+import contextvars
+from typing import Callable, Dict, Iterator, Optional
+
+from cancellation import CancelToken, current_token, use_token
+from solver_metrics import COALESCED_REQUESTS
+
+# 设置 SINGLEFLIGHT=0 关闭请求合并
+SINGLEFLIGHT = os.environ.get('SINGLEFLIGHT', '1') != '0'
+
+_EMPTY = object()
+
+
+class _Flight:
+    """一次在途调用：后台线程推进源迭代器，所有订阅者读取同一份输出"""
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.latest = _EMPTY
+        self.version = 0
+        self.done = False
+        self.error = None
+        self.subscribers = 1
+        # 还没有离开的订阅者数，降为0时取消后台调用
+        self.active = 1
+        # 后台调用使用自己的取消令牌，不受单个订阅者取消的影响
+        self.token = CancelToken()
+
+
+class SingleFlight:
+    """合并相同键的并发请求
+
+    第一个请求（leader）在后台线程中执行，之后到达的相同请求（follower）直接订阅它的输出，
+    不再重复调用模型。源迭代器产出的是累计结果（累计文本、完整消息列表），订阅者总是拿到
+    最新的一项，读取较慢时跳过中间状态不影响最终结果。某个订阅者中途退出（关闭生成器、
+    请求被取消或超过截止时间）时后台调用继续运行，其他订阅者照常收到完整输出；所有订阅者
+    都离开后取消后台调用，模型调用随即关闭连接、停止生成。调用结束后该键即被移除，
+    之后的请求由缓存接手。
+
+    用法::
+
+        for text in SOLUTION_FLIGHTS.stream(key, lambda: _stream_solution(...)):
+            ...
+    """
+
+    def __init__(self, name: str, description: str):
+        self.name = name
+        self.description = description
+        self._flights: Dict[str, _Flight] = {}
+        self._lock = threading.Lock()
+        self.stats = {'leaders': 0, 'followers': 0}
+
+    def stream(self, key: str, factory: Callable[[], Iterator]) -> Iterator:
+        """订阅key对应的在途调用，没有时用factory创建源迭代器并在后台执行"""
+        if not SINGLEFLIGHT:
+            return factory()
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is None:
+                flight = self._flights[key] = _Flight()
+                self.stats['leaders'] += 1
+                leader = True
+            else:
+                flight.subscribers += 1
+                flight.active += 1
+                self.stats['followers'] += 1
+                leader = False
+        if leader:
+            # 在leader的上下文中执行，时间线和传输统计记在leader名下
+            context = contextvars.copy_context()
+            threading.Thread(target=context.run, args=(self._run, key, flight, factory),
+                             name=f'singleflight-{self.name}', daemon=True).start()
+        else:
+            COALESCED_REQUESTS.inc(stage=self.name)
+            print(f"🔗 合并到进行中的{self.description}请求，当前共 {flight.subscribers} 个请求等待同一结果")
+        return self._subscribe(key, flight, current_token())
+
+    def call(self, key: str, fn: Callable[[], object]):
+        """非流式版本：相同key的并发调用只执行一次fn，都返回它的结果"""
+        result = None
+        for result in self.stream(key, lambda: iter([fn()])):
+            pass
+        return result
+
+    def _run(self, key: str, flight: _Flight, factory: Callable[[], Iterator]):
+        try:
+            with use_token(flight.token):
+                for item in factory():
+                    with flight.condition:
+                        flight.latest = item
+                        flight.version += 1
+                        flight.condition.notify_all()
+        except BaseException as e:
+            flight.error = e
+        finally:
+            with self._lock:
+                # 所有订阅者离开时键已被移除，之后的相同请求可能已经开始了新的调用
+                if self._flights.get(key) is flight:
+                    del self._flights[key]
+            with flight.condition:
+                flight.done = True
+                flight.condition.notify_all()
+
+    def _subscribe(self, key: str, flight: _Flight, token: Optional[CancelToken]) -> Iterator:
+        seen = 0
+        remove = token.on_cancel(lambda: self._notify(flight)) if token is not None else None
+        try:
+            while True:
+                with flight.condition:
+                    while flight.version == seen and not flight.done:
+                        if token is not None:
+                            token.check()
+                        # 有截止时间时等到截止为止，取消时由回调唤醒
+                        flight.condition.wait(token.remaining() if token is not None else None)
+                    if flight.version == seen:
+                        if flight.error is not None:
+                            raise flight.error
+                        return
+                    item = flight.latest
+                    seen = flight.version
+                yield item
+        finally:
+            if remove is not None:
+                remove()
+            self._leave(key, flight, token.reason if token is not None and token.reason else 'cancelled')
+
+    @staticmethod
+    def _notify(flight: _Flight):
+        with flight.condition:
+            flight.condition.notify_all()
+
+    def _leave(self, key: str, flight: _Flight, reason: str):
+        with self._lock:
+            flight.active -= 1
+            abandoned = flight.active == 0 and not flight.done
+            if abandoned and self._flights.get(key) is flight:
+                # 新到的相同请求重新发起调用，不订阅即将取消的这一次
+                del self._flights[key]
+        if abandoned:
+            flight.token.cancel(reason)
+            print(f"🛑 {self.description}请求的调用方都已离开，停止进行中的调用")
+
+    def report(self) -> str:
+        return f"{self.description}请求合并: leader {self.stats['leaders']} 个，follower {self.stats['followers']} 个"
+
+
+RECOGNITION_FLIGHTS = SingleFlight('vision', '识别')
+SOLUTION_FLIGHTS = SingleFlight('math', '解题')
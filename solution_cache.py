@@ -0,0 +1,192 @@
+import os
+import re
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+import unicodedata
+from collections import OrderedDict
+from typing import Dict, Optional
+
+from recognition_cache import DEFAULT_CACHE_DIR
+
+# 缓存配置，可通过环境变量覆盖
+SOLUTION_CACHE_DIR = os.environ.get('SOLUTION_CACHE_DIR', DEFAULT_CACHE_DIR)
+SOLUTION_CACHE_SIZE = int(os.environ.get('SOLUTION_CACHE_SIZE', '1024'))
+# 磁盘最多保存的解答条数，超出时淘汰最久未使用的
+SOLUTION_CACHE_DISK_SIZE = int(os.environ.get('SOLUTION_CACHE_DISK_SIZE', '100000'))
+# 解答的有效期（秒），0表示永不过期；换了数学模型版本时可以调小让旧解答自然失效
+SOLUTION_CACHE_TTL = float(os.environ.get('SOLUTION_CACHE_TTL', str(7 * 24 * 3600)))
+
+# 识别结果常见的LaTeX定界符，去掉后 $2x-4=0$ 与 2x-4=0 视为同一题
+_LATEX_DELIMITERS = re.compile(r'\$\$|\$|\\\(|\\\)|\\\[|\\\]')
+_LATEX_SIZING = re.compile(r'\\(?:left|right|displaystyle)\b')
+_SPACES = re.compile(r'\s+')
+# 非字母数字字符（运算符、括号、中文等）两侧的空白没有意义
+_SPACE_AROUND_SYMBOL = re.compile(r' ?([^\w ]|[\u4e00-\u9fff]) ?')
+# 系数与变量之间的空白：2 x -> 2x
+_SPACE_IN_TERM = re.compile(r'(?<=\d) (?=[A-Za-z])')
+_TRAILING_PUNCTUATION = '。.，,；;'
+# NFKC不会把减号(U+2212)和各种连字符、破折号统一成'-'，识别结果里它们都表示减号
+_DASHES = str.maketrans({ch: '-' for ch in '\u2010\u2011\u2012\u2013\u2014\u2015\u2212\u2796\ufe58\ufe63\uff0d'})
+
+
+def normalize_problem_text(text: str) -> str:
+    """把识别出的题目文本规范化，措辞相同、排版不同的题目得到相同结果
+
+    统一全角/半角（NFKC）和减号写法，去掉LaTeX定界符，合并空白，并去掉运算符、括号和中文两侧的空白。
+    """
+    text = unicodedata.normalize('NFKC', text).translate(_DASHES)
+    text = _LATEX_DELIMITERS.sub(' ', text)
+    text = _LATEX_SIZING.sub('', text)
+    text = _SPACES.sub(' ', text).strip()
+    text = _SPACE_AROUND_SYMBOL.sub(r'\1', text)
+    text = _SPACE_IN_TERM.sub('', text)
+    return text.rstrip(_TRAILING_PUNCTUATION)
+
+
+def make_solution_key(problem_text: str, model: str, prompt_template: str, options: Optional[Dict] = None) -> str:
+    """由规范化后的题目、模型名、提示词模板和推理参数生成缓存键"""
+    material = json.dumps(
+        {
+            'problem': normalize_problem_text(problem_text),
+            'model': model,
+            'prompt': prompt_template,
+            'options': options or {},
+        },
+        sort_keys=True,
+        ensure_ascii=False,
+    )
+    return hashlib.sha256(material.encode('utf-8')).hexdigest()
+
+
+class SolutionCache:
+    """解答缓存：内存LRU + 磁盘SQLite两级，条目带有效期，磁盘条数有上限"""
+
+    def __init__(self, cache_dir: Optional[str] = SOLUTION_CACHE_DIR, max_memory_items: int = SOLUTION_CACHE_SIZE,
+                 max_disk_items: int = SOLUTION_CACHE_DISK_SIZE, ttl_seconds: float = SOLUTION_CACHE_TTL):
+        self.max_memory_items = max_memory_items
+        self.max_disk_items = max_disk_items
+        self.ttl_seconds = ttl_seconds
+        # 键 -> (解答, 写入时间)
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {'memory_hits': 0, 'disk_hits': 0, 'misses': 0, 'expired': 0, 'evicted': 0}
+
+        # cache_dir为空时只启用内存缓存
+        self._db = None
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+            self.db_path = os.path.join(cache_dir, 'solution_cache.sqlite')
+            self._db = sqlite3.connect(self.db_path, check_same_thread=False)
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS solutions '
+                '(key TEXT PRIMARY KEY, answer TEXT NOT NULL, created_at REAL NOT NULL, accessed_at REAL NOT NULL)'
+            )
+            self._db.execute('CREATE INDEX IF NOT EXISTS solutions_accessed ON solutions (accessed_at)')
+            if self.ttl_seconds > 0:
+                self._db.execute('DELETE FROM solutions WHERE created_at < ?', (time.time() - self.ttl_seconds,))
+            self._db.commit()
+            self._disk_count = self._db.execute('SELECT COUNT(*) FROM solutions').fetchone()[0]
+
+    def _expired(self, created_at: float, now: float) -> bool:
+        return self.ttl_seconds > 0 and now - created_at > self.ttl_seconds
+
+    def get(self, key: str) -> Optional[str]:
+        """查询缓存，未命中或已过期返回None"""
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                if not self._expired(entry[1], now):
+                    self._memory.move_to_end(key)
+                    self.stats['memory_hits'] += 1
+                    return entry[0]
+                del self._memory[key]
+
+            if self._db is not None:
+                row = self._db.execute('SELECT answer, created_at FROM solutions WHERE key = ?', (key,)).fetchone()
+                if row is not None:
+                    if not self._expired(row[1], now):
+                        self.stats['disk_hits'] += 1
+                        self._db.execute('UPDATE solutions SET accessed_at = ? WHERE key = ?', (now, key))
+                        self._db.commit()
+                        self._remember(key, row[0], row[1])
+                        return row[0]
+                    self._db.execute('DELETE FROM solutions WHERE key = ?', (key,))
+                    self._db.commit()
+                    self._disk_count -= 1
+                    entry = row
+
+            if entry is not None:
+                self.stats['expired'] += 1
+            self.stats['misses'] += 1
+            return None
+
+    def put(self, key: str, answer: str):
+        """写入缓存（内存和磁盘），磁盘超出上限时淘汰最久未使用的条目"""
+        now = time.time()
+        with self._lock:
+            self._remember(key, answer, now)
+            if self._db is None:
+                return
+            exists = self._db.execute('SELECT 1 FROM solutions WHERE key = ?', (key,)).fetchone() is not None
+            self._db.execute(
+                'INSERT OR REPLACE INTO solutions (key, answer, created_at, accessed_at) VALUES (?, ?, ?, ?)',
+                (key, answer, now, now),
+            )
+            if not exists:
+                self._disk_count += 1
+            overflow = self._disk_count - self.max_disk_items
+            if overflow > 0:
+                self._db.execute(
+                    'DELETE FROM solutions WHERE key IN '
+                    '(SELECT key FROM solutions ORDER BY accessed_at LIMIT ?)', (overflow,)
+                )
+                self._disk_count -= overflow
+                self.stats['evicted'] += overflow
+            self._db.commit()
+
+    def _remember(self, key: str, answer: str, created_at: float):
+        """写入内存LRU并淘汰最久未使用的条目"""
+        self._memory[key] = (answer, created_at)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_items:
+            self._memory.popitem(last=False)
+
+    def hit_rate(self) -> float:
+        """缓存命中率"""
+        hits = self.stats['memory_hits'] + self.stats['disk_hits']
+        total = hits + self.stats['misses']
+        return hits / total if total else 0.0
+
+    def report(self) -> str:
+        """命中率报告"""
+        return (
+            f"解答缓存命中率 {self.hit_rate():.1%} "
+            f"(内存命中 {self.stats['memory_hits']}, 磁盘命中 {self.stats['disk_hits']}, "
+            f"未命中 {self.stats['misses']}, 过期 {self.stats['expired']})"
+        )
+
+    def clear(self):
+        """清空两级缓存"""
+        with self._lock:
+            self._memory.clear()
+            if self._db is not None:
+                self._db.execute('DELETE FROM solutions')
+                self._db.commit()
+                self._disk_count = 0
+
+
+_default_cache = None
+_default_cache_lock = threading.Lock()
+
+
+def get_solution_cache() -> SolutionCache:
+    """获取进程内共享的解答缓存"""
+    global _default_cache
+    with _default_cache_lock:
+        if _default_cache is None:
+            _default_cache = SolutionCache()
+        return _default_cache
@@ -0,0 +1,582 @@
+import os
+import base64
+import time
+import asyncio
+import hashlib
+import threading
+import contextvars
+from collections import Counter
+from io import BytesIO
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from PIL import Image
+
+from async_ollama import achat
+from concurrency_limit import limited_chat
+from image_hash import phash, pixel_thumbnail
+from image_transport import (encode_smallest, format_usage, original_bytes, record_wire_bytes, track_request,
+                             wire_payload)
+from image_preprocess import RESOLUTION_TIERS, looks_like_math, prepare_for_vision
+from ollama_stream import ChatStream
+from stream_handoff import VISION_HANDOFF, get_handoff_tracker, handoff_prompt, problem_end
+from recognition_cache import get_recognition_cache, make_cache_key, make_namespace
+from semantic_cache import get_semantic_cache
+from singleflight import RECOGNITION_FLIGHTS, SOLUTION_FLIGHTS
+from solution_cache import get_solution_cache, make_solution_key
+from solver_metrics import (MATH_SECONDS, RECOGNITION_CACHE, SOLUTION_CACHE, SOLVER_ROUTE, VISION_SECONDS,
+                            observe_ollama_response)
+from symbolic_solver import SYMBOLIC_FAST_PATH, solve_symbolic
+from solver_trace import record_model_spans, span
+
+# 各解题脚本共用的模型与提示词
+VISION_MODEL = 'granite3.2-vision'
+MATH_MODEL = 'qwen2:latest'
+VISION_PROMPT = '请识别图片中的数学方程式或题目，并转换为清晰的文本格式'
+MATH_PROMPT_TEMPLATE = "请详细解答以下数学问题：\n{problem}\n\n请提供完整的解题步骤和最终答案。"
+
+# 自适应分辨率：先发送低分辨率灰度图，识别结果不合格再升级
+ADAPTIVE_RESOLUTION = os.environ.get('ADAPTIVE_RESOLUTION', '1') != '0'
+
+# 每个请求最终停留的分辨率档位计数
+TIER_COUNTS = Counter()
+_tier_lock = threading.Lock()
+
+# 解题请求走SymPy快速通道（symbolic）还是数学模型（model）的计数
+ROUTE_COUNTS = Counter()
+_route_lock = threading.Lock()
+
+
+def load_pil_image(image) -> Image.Image:
+    """把PIL图像、文件路径、字节串或base64字符串统一解码为PIL图像"""
+    if isinstance(image, Image.Image):
+        return image
+    if isinstance(image, (bytes, bytearray)):
+        return Image.open(BytesIO(image))
+
+    value = str(image)
+    if value.startswith('file://'):
+        value = value.replace('file://', '')
+    if os.path.exists(value):
+        return Image.open(value)
+    if value.startswith('data:image/'):
+        # data:image/png;base64,xxxx
+        value = value.split(',', 1)[1]
+    return Image.open(BytesIO(base64.b64decode(value)))
+
+
+def encode_pil_image(pil_image: Image.Image) -> str:
+    """将PIL图像编码为base64字符串"""
+    buffered = BytesIO()
+    pil_image.save(buffered, format="PNG")
+    return base64.b64encode(buffered.getvalue()).decode('utf-8')
+
+
+def pixel_digest(pil_image: Image.Image) -> str:
+    """对解码后的像素计算摘要，与文件容器格式和元数据无关"""
+    digest = hashlib.sha256()
+    digest.update(f'{pil_image.mode}:{pil_image.size}'.encode('utf-8'))
+    digest.update(pil_image.tobytes())
+    return digest.hexdigest()
+
+
+def image_fingerprint(image, pil_image: Optional[Image.Image] = None, perceptual: bool = True):
+    """计算图像的像素摘要与感知哈希，无法解码时摘要退化为对原始值求摘要、感知哈希为None
+
+    perceptual为False时不计算感知哈希（大图上要一百多毫秒），同样返回None。
+    """
+    try:
+        if pil_image is None:
+            pil_image = load_pil_image(image)
+        return pixel_digest(pil_image), phash(pil_image) if perceptual else None
+    except Exception:
+        raw = image if isinstance(image, (bytes, bytearray)) else str(image).encode('utf-8')
+        return hashlib.sha256(raw).hexdigest(), None
+
+
+def _chat_kwargs(options: Optional[Dict]) -> Dict:
+    return {'options': options} if options else {}
+
+
+def vision_messages(payload, prompt: str) -> List[Dict]:
+    """构造vision模型的请求消息，payload为图片字节时由ollama客户端在HTTP边界做一次base64"""
+    return [{
+        'role': 'user',
+        'content': prompt,
+        'images': [payload]
+    }]
+
+
+def math_messages(problem_text: str) -> List[Dict]:
+    """构造数学模型的请求消息"""
+    return [{
+        'role': 'user',
+        'content': MATH_PROMPT_TEMPLATE.format(problem=problem_text)
+    }]
+
+
+def _call_vision(payload, prompt: str, model: str, options: Optional[Dict], handoff: bool = False):
+    """调用vision模型识别单张图片
+
+    Returns:
+        tuple: (识别文本, 提前交接信息或None)
+    """
+    started = time.time()
+    if not handoff:
+        vision_response = limited_chat(
+            stage='vision',
+            model=model,
+            messages=vision_messages(payload, prompt),
+            **_chat_kwargs(options)
+        )
+        VISION_SECONDS.observe(time.time() - started, model=model)
+        observe_ollama_response(model, vision_response)
+        record_model_spans('vision', model, started, time.time(), vision_response)
+        return vision_response['message']['content'], None
+
+    stream = ChatStream(model, vision_messages(payload, handoff_prompt(prompt)), options, stage='vision')
+    cut = None
+    try:
+        for _ in stream:
+            cut = problem_end(stream.text)
+            if cut is not None:
+                break
+    except BaseException:
+        stream.close()
+        raise
+    return _finish_vision_stream(model, stream, cut, started)
+
+
+def _finish_vision_stream(model: str, stream: ChatStream, cut: Optional[int], started: float):
+    """结束一次流式识别：按交接位置截断文本，取消剩余生成并记录节省的时间
+
+    Returns:
+        tuple: (识别文本, 提前交接信息或None)
+    """
+    tracker = get_handoff_tracker()
+    seconds = time.time() - started
+    # 提前交接时只统计解题实际等待的部分
+    VISION_SECONDS.observe(seconds, model=model)
+    record_model_spans('vision', model, started, started + seconds, stream.final_chunk, stream.stats['ttft'])
+    text = stream.text[:cut].rstrip() if cut is not None else stream.text
+    if cut is None or stream.stats['completed']:
+        stream.close()
+        tracker.record_completed(model, seconds)
+        print(f"⏱️ {stream.format_stats()}")
+        return text, None
+
+    handoff = tracker.record_handoff(model, seconds)
+    if tracker.should_sample(model):
+        # 采样基线：剩余生成在后台跑完，解题不必等待
+        tracker.drain_in_background(model, stream, started)
+    else:
+        # 关闭连接即取消剩余的生成，vision模型不再占用GPU
+        stream.close()
+        print(f"⏱️ {stream.format_stats()}")
+    print(f"✂️ 题目已完整输出，提前结束识别 | {tracker.report(handoff)}")
+    return text, handoff
+
+
+def _original_payload(image, pil_image, image_data):
+    """原图档位的发送数据：优先转发原始上传字节，无法解码的输入原样交给ollama"""
+    source = image_data if image_data is not None else image
+    try:
+        return wire_payload(source, pil_image)
+    except ValueError:
+        return source
+
+
+def _adaptive_steps(image, pil_image, image_data):
+    """先用低分辨率灰度图识别，结果未通过检查时逐级升级分辨率
+
+    与IO无关的生成器：每次yield一份待识别的图片数据，由调用方发送识别文本回来，
+    同步和异步两种调用方式共用这段逻辑。
+
+    Returns:
+        tuple: (识别文本, 最终使用的分辨率档位)
+    """
+    if pil_image is None or not ADAPTIVE_RESOLUTION:
+        with span('image_encode', tier='full'):
+            payload = _original_payload(image, pil_image, image_data)
+        recognized_text = yield payload
+        return recognized_text, 'full'
+
+    previous_size = None
+    for tier, token_budget in RESOLUTION_TIERS:
+        with span('image_encode', tier=tier):
+            if token_budget is None:
+                tier_data = _original_payload(image, pil_image, image_data)
+            else:
+                prepared = prepare_for_vision(pil_image, token_budget)
+                # 小图在各档位缩放结果相同，不重复请求
+                if prepared.size == previous_size:
+                    continue
+                previous_size = prepared.size
+                tier_data, _ = encode_smallest(prepared)
+                record_wire_bytes(len(tier_data))
+
+        recognized_text = yield tier_data
+        if token_budget is None or looks_like_math(recognized_text):
+            return recognized_text, tier
+        print(f"↗️ {tier}档识别结果未通过检查，升级分辨率重试")
+
+
+def content_digest(image, image_data=None) -> str:
+    """请求合并用的图片内容摘要：能取到原始文件字节时对字节求摘要，否则对解码后的像素求摘要"""
+    data = original_bytes(image_data if image_data is not None else image)
+    if data is not None:
+        return hashlib.sha256(data).hexdigest()
+    try:
+        return pixel_digest(load_pil_image(image))
+    except Exception:
+        raw = image if isinstance(image, (bytes, bytearray)) else str(image).encode('utf-8')
+        return hashlib.sha256(raw).hexdigest()
+
+
+def _flight_key(*parts) -> str:
+    return hashlib.sha256(repr(parts).encode('utf-8')).hexdigest()
+
+
+def recognize_image_detailed(image, image_data=None, prompt: str = VISION_PROMPT,
+                             model: str = VISION_MODEL, options: Optional[Dict] = None,
+                             near_duplicates: bool = True, handoff: bool = VISION_HANDOFF) -> Dict:
+    """识别图片中的数学内容，命中识别缓存时跳过vision模型调用
+
+    Args:
+        image: 用于计算缓存键的图像（PIL图像、路径、字节串或base64）
+        image_data: 原图的原始数据（路径、字节串或base64），默认取自image
+        prompt: 识别提示词
+        model: vision模型名称
+        options: ollama推理参数
+        near_duplicates: 是否按感知哈希复用近重复图片的结果
+        handoff: 是否流式识别，题目输出完整后提前结束vision生成
+
+    Returns:
+        dict: text为识别文本，source为结果来源（cache/near_duplicate/model），
+            tier为最终使用的分辨率档位，usage为图像传输字节数与峰值内存，
+            handoff为提前交接信息（未提前结束时为None）
+    """
+    key = _flight_key('call', content_digest(image, image_data), model, prompt, options, near_duplicates, handoff)
+    # 同一张图片的并发请求共用一次识别，各自拿到结果的浅拷贝
+    return dict(RECOGNITION_FLIGHTS.call(key, lambda: _recognize_image_detailed(
+        image, image_data, prompt, model, options, near_duplicates, handoff)))
+
+
+def _recognize_image_detailed(image, image_data, prompt: str, model: str, options: Optional[Dict],
+                              near_duplicates: bool, handoff: bool) -> Dict:
+    handoff_info = None
+    with track_request() as usage:
+        steps = _recognition_steps(image, image_data, prompt, model, options, near_duplicates)
+        try:
+            payload = next(steps)
+            while True:
+                recognized_text, handoff_info = _call_vision(payload, prompt, model, options, handoff)
+                payload = steps.send(recognized_text)
+        except StopIteration as stop:
+            result = stop.value
+    result['handoff'] = handoff_info
+    return _finish_recognition(result, usage)
+
+
+def _finish_recognition(result: Dict, usage: Dict) -> Dict:
+    if usage['wire_bytes']:
+        print(f"📤 {format_usage(usage)}")
+    result['usage'] = usage
+    return result
+
+
+def _recognition_steps(image, image_data, prompt: str, model: str, options: Optional[Dict],
+                       near_duplicates: bool):
+    """识别流程（缓存、近重复检索、自适应分辨率），以生成器形式与IO解耦"""
+    cache = get_recognition_cache()
+    # PIL延迟解码，计算像素摘要时才真正读取像素，因此一并计入解码耗时
+    with span('image_decode'):
+        try:
+            pil_image = load_pil_image(image)
+        except Exception:
+            pil_image = None
+        digest, _ = image_fingerprint(image, pil_image, perceptual=False)
+    key = make_cache_key(digest, model, prompt, options)
+    namespace = make_namespace(model, prompt, options)
+
+    cached_text = cache.get(key)
+    if cached_text is not None:
+        RECOGNITION_CACHE.inc(result='hit')
+        print(f"⚡ 命中识别缓存，跳过{model}调用 | {cache.report()}")
+        return {'text': cached_text, 'source': 'cache', 'tier': None}
+
+    # 同一张图重新上传（压缩、光照不同）时按感知哈希找候选，再经像素级校验后复用结果；
+    # 整页切分出的小图近重复检索不可靠，既不查询也不登记；感知哈希只在开启近重复检索时计算
+    near_duplicates = near_duplicates and cache.near_enabled and pil_image is not None
+    if near_duplicates:
+        with span('image_phash'):
+            perceptual_hash = phash(pil_image)
+            thumbnail = pixel_thumbnail(pil_image)
+        similar_text = cache.get_similar(namespace, perceptual_hash, thumbnail)
+        if similar_text is not None:
+            cache.put(key, similar_text)
+            RECOGNITION_CACHE.inc(result='near_hit')
+            print(f"⚡ 命中近重复图片，跳过{model}调用 | {cache.report()}")
+            return {'text': similar_text, 'source': 'near_duplicate', 'tier': None}
+
+    cache.record_miss()
+    RECOGNITION_CACHE.inc(result='miss')
+
+    recognized_text, tier = yield from _adaptive_steps(image, pil_image, image_data)
+    with _tier_lock:
+        TIER_COUNTS[tier] += 1
+    print(f"🔎 识别使用分辨率档位: {tier} | 档位分布: {dict(TIER_COUNTS)}")
+
+    cache.put(key, recognized_text)
+    if near_duplicates:
+        cache.put_similar(namespace, perceptual_hash, thumbnail, recognized_text)
+    print(f"📦 识别结果已缓存 | {cache.report()}")
+    return {'text': recognized_text, 'source': 'model', 'tier': tier}
+
+
+def recognize_image(image, image_data=None, prompt: str = VISION_PROMPT,
+                    model: str = VISION_MODEL, options: Optional[Dict] = None) -> str:
+    """识别图片中的数学内容，只返回识别文本"""
+    return recognize_image_detailed(image, image_data, prompt, model, options)['text']
+
+
+def fast_path_fraction() -> float:
+    """SymPy快速通道处理的解题请求占比"""
+    with _route_lock:
+        total = sum(ROUTE_COUNTS.values())
+        return ROUTE_COUNTS['symbolic'] / total if total else 0.0
+
+
+def _symbolic_solution(problem_text: str, model: str) -> Optional[str]:
+    """识别后的路由：简单方程、方程组和求导用SymPy本地求解，其余返回None交给数学模型"""
+    if not SYMBOLIC_FAST_PATH:
+        return None
+    with span('symbolic_solve'):
+        result = solve_symbolic(problem_text)
+    route = 'symbolic' if result is not None else 'model'
+    with _route_lock:
+        ROUTE_COUNTS[route] += 1
+    SOLVER_ROUTE.inc(route=route)
+    if result is None:
+        return None
+    print(f"🧮 SymPy本地求解（{result['type']}），跳过{model}调用 | 快速通道占比 {fast_path_fraction():.1%}")
+    return result['answer']
+
+
+def _cached_solution(problem_text: str, model: str, options: Optional[Dict]) -> Tuple[str, Optional[str]]:
+    """按规范化后的题目文本查询解答缓存，未命中时再查语义缓存（开启时），返回 (缓存键, 缓存的解答或None)"""
+    cache = get_solution_cache()
+    key = make_solution_key(problem_text, model, MATH_PROMPT_TEMPLATE, options)
+    answer = cache.get(key)
+    if answer is not None:
+        SOLUTION_CACHE.inc(result='hit')
+        print(f"⚡ 命中解答缓存，跳过{model}调用 | {cache.report()}")
+        return key, answer
+
+    semantic = get_semantic_cache()
+    if semantic is not None:
+        with span('semantic_lookup'):
+            answer = semantic.lookup(_solution_namespace(model, options), problem_text)
+        if answer is not None:
+            SOLUTION_CACHE.inc(result='semantic_hit')
+            cache.put(key, answer)
+            print(f"⚡ 命中语义缓存，跳过{model}调用 | {semantic.report()}")
+            return key, answer
+    SOLUTION_CACHE.inc(result='miss')
+    return key, None
+
+
+def _solution_namespace(model: str, options: Optional[Dict]) -> str:
+    """语义缓存的命名空间：同模型、同提示词、同参数的解答才可复用"""
+    return make_solution_key('', model, MATH_PROMPT_TEMPLATE, options)
+
+
+def _store_solution(key: str, problem_text: str, model: str, options: Optional[Dict], answer: str):
+    """把新解答写入解答缓存和语义缓存"""
+    get_solution_cache().put(key, answer)
+    semantic = get_semantic_cache()
+    if semantic is not None:
+        semantic.add(_solution_namespace(model, options), problem_text, answer)
+
+
+def _solution_flight_key(kind: str, problem_text: str, model: str, options: Optional[Dict]) -> str:
+    return _flight_key(kind, make_solution_key(problem_text, model, MATH_PROMPT_TEMPLATE, options))
+
+
+def solve_problem(problem_text: str, model: str = MATH_MODEL, options: Optional[Dict] = None) -> str:
+    """解答识别出的题目：SymPy能解的在本地求解，规范化后相同的题目直接返回缓存的解答，其余调用数学模型
+
+    规范化后相同的并发请求共用一次解答。
+    """
+    return SOLUTION_FLIGHTS.call(_solution_flight_key('call', problem_text, model, options),
+                                 lambda: _solve_problem(problem_text, model, options))
+
+
+def _solve_problem(problem_text: str, model: str, options: Optional[Dict]) -> str:
+    symbolic_answer = _symbolic_solution(problem_text, model)
+    if symbolic_answer is not None:
+        return symbolic_answer
+    key, cached_answer = _cached_solution(problem_text, model, options)
+    if cached_answer is not None:
+        return cached_answer
+    started = time.time()
+    math_response = limited_chat(
+        model=model,
+        messages=math_messages(problem_text),
+        **_chat_kwargs(options)
+    )
+    MATH_SECONDS.observe(time.time() - started, model=model)
+    observe_ollama_response(model, math_response)
+    record_model_spans('math', model, started, time.time(), math_response)
+    answer = math_response['message']['content']
+    _store_solution(key, problem_text, model, options, answer)
+    return answer
+
+
+def stream_recognition(image, image_data=None, prompt: str = VISION_PROMPT,
+                       model: str = VISION_MODEL, options: Optional[Dict] = None,
+                       near_duplicates: bool = True,
+                       handoff: bool = VISION_HANDOFF) -> Iterator[Tuple[str, Optional[Dict]]]:
+    """recognize_image_detailed的流式版本，边识别边产出文本
+
+    生成过程中产出 (累计识别文本, None)，结束时产出 (最终识别文本, 结果dict)。
+    命中缓存时只产出最终结果；自适应分辨率升级重试时累计文本从头开始。
+    handoff为True时题目输出完整即结束识别，调用方可以马上开始解题。
+    同一张图片的并发请求共用一次识别，后到的请求从当前进度开始收到同样的输出；
+    某个调用方提前退出时识别继续进行，不影响其他调用方。
+    """
+    key = _flight_key('stream', content_digest(image, image_data), model, prompt, options, near_duplicates,
+                      handoff)
+    return RECOGNITION_FLIGHTS.stream(key, lambda: _stream_recognition(
+        image, image_data, prompt, model, options, near_duplicates, handoff))
+
+
+def _stream_recognition(image, image_data, prompt: str, model: str, options: Optional[Dict],
+                        near_duplicates: bool, handoff: bool) -> Iterator[Tuple[str, Optional[Dict]]]:
+    handoff_info = None
+    # Gradio等调用方可能在不同线程/上下文中推进生成器，传输统计固定在同一个上下文里进行
+    context = contextvars.copy_context()
+    tracker = track_request()
+    usage = context.run(tracker.__enter__)
+    try:
+        steps = _recognition_steps(image, image_data, prompt, model, options, near_duplicates)
+        try:
+            payload = context.run(next, steps)
+            while True:
+                started = time.time()
+                stream = ChatStream(model, vision_messages(payload, handoff_prompt(prompt) if handoff else prompt),
+                                    options, stage='vision')
+                cut = None
+                try:
+                    for _ in stream:
+                        if handoff:
+                            cut = problem_end(stream.text)
+                            if cut is not None:
+                                break
+                        yield stream.text, None
+                except BaseException:
+                    stream.close()
+                    raise
+                recognized_text, handoff_info = _finish_vision_stream(model, stream, cut, started)
+                payload = context.run(steps.send, recognized_text)
+        except StopIteration as stop:
+            result = stop.value
+    finally:
+        context.run(tracker.__exit__, None, None, None)
+    result['handoff'] = handoff_info
+    result = _finish_recognition(result, usage)
+    yield result['text'], result
+
+
+def stream_solution(problem_text: str, model: str = MATH_MODEL, options: Optional[Dict] = None) -> Iterator[str]:
+    """solve_problem的流式版本，逐块产出累计的解答文本；本地求解或命中解答缓存时只产出一次完整解答
+
+    规范化后相同的并发请求共用一次解答，调用方提前退出时解答继续进行。
+    """
+    return SOLUTION_FLIGHTS.stream(_solution_flight_key('stream', problem_text, model, options),
+                                   lambda: _stream_solution(problem_text, model, options))
+
+
+def _stream_solution(problem_text: str, model: str, options: Optional[Dict]) -> Iterator[str]:
+    symbolic_answer = _symbolic_solution(problem_text, model)
+    if symbolic_answer is not None:
+        yield symbolic_answer
+        return
+    key, cached_answer = _cached_solution(problem_text, model, options)
+    if cached_answer is not None:
+        yield cached_answer
+        return
+    started = time.time()
+    stream = ChatStream(model, math_messages(problem_text), options)
+    try:
+        for _ in stream:
+            yield stream.text
+    finally:
+        stream.close()
+        # 被调用方提前中断的解答不完整，不写入缓存
+        if stream.stats['completed']:
+            _store_solution(key, problem_text, model, options, stream.text)
+        MATH_SECONDS.observe(stream.stats['total_seconds'] or 0.0, model=model)
+        record_model_spans('math', model, started, time.time(), stream.final_chunk, stream.stats['ttft'])
+        print(f"⏱️ {stream.format_stats()}")
+
+
+def _advance(steps, value=None):
+    """把识别流程推进一步，返回 (是否结束, 下一个payload或最终结果)
+
+    StopIteration不能穿过asyncio.to_thread返回的Future，在线程内转换成返回值。
+    """
+    try:
+        return False, steps.send(value)
+    except StopIteration as stop:
+        return True, stop.value
+
+
+async def arecognize_image_detailed(image, image_data=None, prompt: str = VISION_PROMPT,
+                                    model: str = VISION_MODEL, options: Optional[Dict] = None,
+                                    near_duplicates: bool = True) -> Dict:
+    """recognize_image_detailed的异步版本，通过共享的AsyncClient调用ollama
+
+    解码、摘要和SQLite缓存读写都在线程中执行，不阻塞事件循环。不做请求合并。
+    """
+    with track_request() as usage:
+        steps = _recognition_steps(image, image_data, prompt, model, options, near_duplicates)
+        done, payload = await asyncio.to_thread(_advance, steps)
+        while not done:
+            started = time.time()
+            response = await achat(stage='vision', model=model, messages=vision_messages(payload, prompt),
+                                   **_chat_kwargs(options))
+            VISION_SECONDS.observe(time.time() - started, model=model)
+            record_model_spans('vision', model, started, time.time(), response)
+            done, payload = await asyncio.to_thread(_advance, steps, response['message']['content'])
+        result = payload
+    # 异步路径使用非流式调用，不做提前交接
+    result['handoff'] = None
+    return _finish_recognition(result, usage)
+
+
+async def arecognize_image(image, image_data=None, prompt: str = VISION_PROMPT,
+                           model: str = VISION_MODEL, options: Optional[Dict] = None) -> str:
+    """识别图片中的数学内容（异步），只返回识别文本"""
+    return (await arecognize_image_detailed(image, image_data, prompt, model, options))['text']
+
+
+async def asolve_problem(problem_text: str, model: str = MATH_MODEL, options: Optional[Dict] = None) -> str:
+    """solve_problem的异步版本，不做请求合并"""
+    # SymPy求解是CPU计算，缓存查询和写入是SQLite读写（开启语义缓存时还要等待嵌入），都放到线程里执行，不阻塞事件循环
+    symbolic_answer = await asyncio.to_thread(_symbolic_solution, problem_text, model)
+    if symbolic_answer is not None:
+        return symbolic_answer
+    key, cached_answer = await asyncio.to_thread(_cached_solution, problem_text, model, options)
+    if cached_answer is not None:
+        return cached_answer
+    started = time.time()
+    math_response = await achat(
+        model=model,
+        messages=math_messages(problem_text),
+        **_chat_kwargs(options)
+    )
+    MATH_SECONDS.observe(time.time() - started, model=model)
+    record_model_spans('math', model, started, time.time(), math_response)
+    answer = math_response['message']['content']
+    await asyncio.to_thread(_store_solution, key, problem_text, model, options, answer)
+    return answer
@@ -0,0 +1,269 @@
+import os
+import time
+import bisect
+import threading
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Optional, Sequence, Tuple
+
+# 设置端口后以Prometheus文本格式在 http://<host>:<port>/metrics 暴露指标，未设置时只在进程内统计
+METRICS_PORT = int(os.environ.get('SOLVER_METRICS_PORT', '0'))
+METRICS_HOST = os.environ.get('SOLVER_METRICS_HOST', '127.0.0.1')
+
+# 延迟直方图的分桶上限（秒），覆盖缓存命中到冷启动加载模型
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2, 3, 5, 8, 13, 20, 30, 60, 120)
+
+LabelValues = Tuple[str, ...]
+
+
+def _format_labels(names: Sequence[str], values: LabelValues, extra: str = '') -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _escape(value: str) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    """带标签的指标基类，各标签组合的取值保存在字典中"""
+
+    kind = ''
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[LabelValues, object] = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> LabelValues:
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+    def render(self) -> str:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        with self._lock:
+            lines.extend(self._render_samples())
+        return '\n'.join(lines)
+
+    def _render_samples(self):
+        for key, value in sorted(self._values.items()):
+            yield f'{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}'
+
+
+class Counter(_Metric):
+    """只增不减的计数器"""
+
+    kind = 'counter'
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+
+class Gauge(Counter):
+    """可增可减的当前值"""
+
+    kind = 'gauge'
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(_Metric):
+    """累积分桶直方图"""
+
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # 每个桶只记本桶的数量，输出时再累加
+                state = self._values[key] = {'counts': [0] * (len(self.buckets) + 1), 'sum': 0.0, 'count': 0}
+            state['counts'][index] += 1
+            state['sum'] += value
+            state['count'] += 1
+
+    def _render_samples(self):
+        for key, state in sorted(self._values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), state['counts']):
+                cumulative += count
+                le = 'le="' + _format_value(float(bound)) + '"'
+                yield f'{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}'
+            yield f'{self.name}_sum{_format_labels(self.labelnames, key)} {_format_value(state["sum"])}'
+            yield f'{self.name}_count{_format_labels(self.labelnames, key)} {state["count"]}'
+
+
+class MetricsRegistry:
+    """进程内的指标集合"""
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric: _Metric) -> _Metric:
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f'指标 {metric.name} 已注册')
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Gauge:
+        return self.register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                  buckets: Sequence[float] = LATENCY_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self) -> str:
+        """生成Prometheus文本格式的指标"""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return '\n'.join(metric.render() for metric in metrics) + '\n'
+
+
+REGISTRY = MetricsRegistry()
+
+VISION_SECONDS = REGISTRY.histogram('solver_vision_seconds', 'vision模型单次调用耗时', ['model'])
+MATH_SECONDS = REGISTRY.histogram('solver_math_seconds', '数学模型单次调用耗时', ['model'])
+QUEUE_WAIT_SECONDS = REGISTRY.histogram('solver_queue_wait_seconds', '流水线各阶段的排队等待时间', ['stage'])
+REQUEST_SECONDS = REGISTRY.histogram('solver_request_seconds', '解题请求端到端耗时', ['entry'])
+ERRORS = REGISTRY.counter('solver_errors_total', '各阶段出错次数', ['stage'])
+RECOGNITION_CACHE = REGISTRY.counter('solver_recognition_cache_total', '识别缓存查询结果', ['result'])
+SOLUTION_CACHE = REGISTRY.counter('solver_solution_cache_total', '解答缓存查询结果', ['result'])
+COALESCED_REQUESTS = REGISTRY.counter('solver_coalesced_requests_total', '合并到在途相同请求的次数', ['stage'])
+SOLVER_ROUTE = REGISTRY.counter('solver_route_total', '解题请求的路由：SymPy快速通道或数学模型', ['route'])
+ADMISSION_REQUESTS = REGISTRY.gauge('solver_admission_requests', '准入控制下处理中和排队中的请求数', ['state'])
+ADMISSION_REJECTED = REGISTRY.counter('solver_admission_rejected_total', '准入控制拒绝的请求数', ['reason'])
+ADMISSION_WAIT_SECONDS = REGISTRY.histogram('solver_admission_wait_seconds', '准入前的排队等待时间')
+IN_FLIGHT = REGISTRY.gauge('solver_in_flight_requests', '正在处理的解题请求数', ['entry'])
+MODEL_CONCURRENCY_LIMIT = REGISTRY.gauge(
+    'solver_model_concurrency_limit', '自适应限流器当前的并发上限', ['backend', 'model'])
+MODEL_IN_FLIGHT = REGISTRY.gauge('solver_model_in_flight', '正在进行的模型调用数', ['backend', 'model'])
+MODEL_RTT_SECONDS = REGISTRY.gauge(
+    'solver_model_rtt_seconds', '模型调用的排队+prefill延迟，short为最近几次的均值，baseline为无排队基线',
+    ['backend', 'model', 'window'])
+BACKEND_HEALTHY = REGISTRY.gauge('solver_backend_healthy', 'ollama后端是否健康（1/0）', ['backend'])
+BACKEND_DRAINING = REGISTRY.gauge('solver_backend_draining', 'ollama后端是否在排空（1/0）', ['backend'])
+BACKEND_OUTSTANDING = REGISTRY.gauge('solver_backend_outstanding', '各ollama后端的在途请求数', ['backend'])
+BACKEND_CIRCUIT_OPEN = REGISTRY.gauge('solver_backend_circuit_open', 'ollama后端的熔断器是否打开（1/0）', ['backend'])
+MODEL_RETRIES = REGISTRY.counter('solver_model_retries_total', '模型调用的重试次数', ['stage'])
+MODEL_HEDGES = REGISTRY.counter('solver_model_hedges_total', '对冲请求：launched为发出的备份请求，won为备份请求先出结果', ['stage', 'result'])
+CANCELLED_GENERATIONS = REGISTRY.counter('solver_cancelled_generations_total', '被取消（cancelled）或超过截止时间（deadline）而中止的模型生成', ['stage', 'reason'])
+CANCEL_SAVED_SECONDS = REGISTRY.counter('solver_cancel_saved_seconds_total', '取消生成估计节省的模型时间（秒）', ['stage'])
+BACKEND_REQUESTS = REGISTRY.counter('solver_backend_requests_total', '分配到各ollama后端的调用数', ['backend', 'model'])
+
+OLLAMA_REQUESTS = REGISTRY.counter('ollama_requests_total', 'ollama调用次数', ['model'])
+OLLAMA_PROMPT_EVAL_TOKENS = REGISTRY.counter(
+    'ollama_prompt_eval_tokens_total', 'ollama返回的prompt_eval_count累计', ['model'])
+OLLAMA_EVAL_TOKENS = REGISTRY.counter('ollama_eval_tokens_total', 'ollama返回的eval_count累计', ['model'])
+OLLAMA_EVAL_SECONDS = REGISTRY.counter(
+    'ollama_eval_duration_seconds_total', 'ollama返回的eval_duration累计', ['model'])
+OLLAMA_LOAD_SECONDS = REGISTRY.counter(
+    'ollama_load_duration_seconds_total', 'ollama返回的load_duration累计', ['model'])
+
+
+def observe_ollama_response(model: str, response) -> None:
+    """记录ollama响应（非流式响应或流式的最后一块）自带的计数和耗时字段"""
+    if response is None:
+        return
+    OLLAMA_REQUESTS.inc(model=model)
+    # ollama返回的耗时单位为纳秒
+    OLLAMA_PROMPT_EVAL_TOKENS.inc(response.get('prompt_eval_count') or 0, model=model)
+    OLLAMA_EVAL_TOKENS.inc(response.get('eval_count') or 0, model=model)
+    OLLAMA_EVAL_SECONDS.inc((response.get('eval_duration') or 0) / 1e9, model=model)
+    OLLAMA_LOAD_SECONDS.inc((response.get('load_duration') or 0) / 1e9, model=model)
+
+
+@contextmanager
+def track_solve(entry: str):
+    """统计一个解题请求：在途请求数、端到端耗时和出错次数
+
+    用法::
+
+        with track_solve('gradio'):
+            ...
+    """
+    IN_FLIGHT.inc(entry=entry)
+    started = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        ERRORS.inc(stage=entry)
+        raise
+    finally:
+        IN_FLIGHT.dec(entry=entry)
+        REQUEST_SECONDS.observe(time.perf_counter() - started, entry=entry)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?', 1)[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = REGISTRY.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # 抓取请求很频繁，不打印访问日志
+        pass
+
+
+_server: Optional[ThreadingHTTPServer] = None
+_server_lock = threading.Lock()
+
+
+def start_metrics_server(port: int = METRICS_PORT, host: str = METRICS_HOST) -> Optional[ThreadingHTTPServer]:
+    """在后台线程启动指标端点，重复调用只启动一次；port为0时不启动"""
+    global _server
+    if not port:
+        return None
+    with _server_lock:
+        if _server is None:
+            try:
+                _server = ThreadingHTTPServer((host, port), _MetricsHandler)
+            except OSError as e:
+                # 多个入口同时运行时端口可能已被占用，不影响解题
+                print(f"⚠️ 指标端点启动失败: {e}")
+                return None
+            threading.Thread(target=_server.serve_forever, name='metrics-server', daemon=True).start()
+            print(f"📈 指标端点已启动: http://{host}:{port}/metrics")
+        return _server
+
+
+# 任何入口（Gradio、WebUI、批量模式）设置SOLVER_METRICS_PORT即可开启
+start_metrics_server()
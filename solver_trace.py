@@ -0,0 +1,273 @@
+import os
+import json
+import time
+import uuid
+import queue
+import random
+import argparse
+import threading
+import contextvars
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional
+
+# 设置文件路径后，每个解题请求的时间线以JSON行写入该文件；未设置时不记录
+TRACE_FILE = os.environ.get('SOLVER_TRACE_FILE', '')
+# 采样比例，流量大时可以只记录一部分请求
+TRACE_SAMPLE_RATE = float(os.environ.get('SOLVER_TRACE_SAMPLE', '1.0'))
+# ollama返回的load_duration超过该秒数视为冷启动加载模型
+COLD_LOAD_SECONDS = float(os.environ.get('TRACE_COLD_LOAD_SECONDS', '0.5'))
+
+_current = contextvars.ContextVar('solver_trace', default=None)
+
+
+class Trace:
+    """一个解题请求的时间线，由若干带起止时间的span组成"""
+
+    def __init__(self, name: str, **attributes):
+        self.trace_id = uuid.uuid4().hex
+        self.name = name
+        self.attributes = attributes
+        self.start = time.time()
+        self.end = None
+        self.spans: List[Dict] = []
+        self.cold_loads: Dict[str, float] = {}
+        self.emissions = {'count': 0, 'first': None, 'last': None, 'blocked_seconds': 0.0}
+
+    def add_span(self, name: str, start: float, end: float, **attributes):
+        # list.append是原子操作，流水线的不同线程可以同时写入同一条时间线
+        self.spans.append({'name': name, 'start': start, 'duration': max(end - start, 0.0),
+                           'attributes': attributes})
+
+    def mark_cold_load(self, model: str, seconds: float):
+        self.cold_loads[model] = round(seconds, 3)
+
+    def record_emission(self, start: float, end: float):
+        """记录一次界面推送，多次推送合并为一个span，避免长回答产生大量span"""
+        emissions = self.emissions
+        emissions['count'] += 1
+        emissions['first'] = start if emissions['first'] is None else emissions['first']
+        emissions['last'] = end
+        emissions['blocked_seconds'] += end - start
+
+    def finish(self, error: Optional[BaseException] = None):
+        if self.end is not None:
+            return
+        self.end = time.time()
+        if error is not None:
+            self.attributes['error'] = str(error)
+        if self.emissions['count']:
+            self.add_span('ui_emission', self.emissions['first'], self.emissions['last'],
+                          emissions=self.emissions['count'],
+                          blocked_seconds=round(self.emissions['blocked_seconds'], 4))
+        if self.cold_loads:
+            print(f"🥶 模型冷启动加载: {self.cold_loads}")
+        _get_writer().write(self.to_dict())
+
+    def to_dict(self) -> Dict:
+        return {
+            'trace_id': self.trace_id,
+            'name': self.name,
+            'start': self.start,
+            'duration': round((self.end or time.time()) - self.start, 6),
+            'cold_load': bool(self.cold_loads),
+            'cold_loads': self.cold_loads,
+            'attributes': self.attributes,
+            'spans': sorted(self.spans, key=lambda item: item['start']),
+        }
+
+
+class _TraceWriter:
+    """后台线程把时间线追加写入JSONL，请求线程只做一次入队"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._queue = queue.Queue()
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        threading.Thread(target=self._run, name='trace-writer', daemon=True).start()
+
+    def write(self, record: Dict):
+        self._queue.put(record)
+
+    def _run(self):
+        with open(self.path, 'a', encoding='utf-8') as out:
+            while True:
+                records = [self._queue.get()]
+                # 一次取走积压的所有记录，减少flush次数
+                while not self._queue.empty():
+                    records.append(self._queue.get_nowait())
+                for record in records:
+                    out.write(json.dumps(record, ensure_ascii=False) + '\n')
+                out.flush()
+
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def _get_writer() -> _TraceWriter:
+    global _writer
+    with _writer_lock:
+        if _writer is None:
+            _writer = _TraceWriter(TRACE_FILE)
+        return _writer
+
+
+def start_trace(name: str, **attributes) -> Optional[Trace]:
+    """开始记录一个请求的时间线，未开启或未被采样时返回None"""
+    if not TRACE_FILE or random.random() >= TRACE_SAMPLE_RATE:
+        return None
+    return Trace(name, **attributes)
+
+
+def current_trace() -> Optional[Trace]:
+    return _current.get()
+
+
+@contextmanager
+def activate_trace(trace: Optional[Trace]):
+    """在当前上下文中把trace设为活动时间线（用于流水线的工作线程）"""
+    token = _current.set(trace)
+    try:
+        yield trace
+    finally:
+        _current.reset(token)
+
+
+@contextmanager
+def trace_request(name: str, **attributes):
+    """记录一个同步或异步请求的完整时间线
+
+    用法::
+
+        with trace_request('gradio_async'):
+            ...
+    """
+    trace = start_trace(name, **attributes)
+    token = _current.set(trace)
+    try:
+        yield trace
+    except BaseException as e:
+        if trace is not None:
+            trace.finish(e)
+        raise
+    finally:
+        _current.reset(token)
+        if trace is not None:
+            trace.finish()
+
+
+def traced_iter(name: str, iterator: Iterator, **attributes) -> Iterator:
+    """记录流式处理函数（Gradio生成器等）的时间线
+
+    调用方可能在不同线程中推进生成器，这里让内部生成器的每一步都在同一个上下文中执行，
+    并把每次yield到恢复之间的时间记为界面推送耗时。
+    """
+    trace = start_trace(name, **attributes)
+    if trace is None:
+        yield from iterator
+        return
+    context = contextvars.copy_context()
+    context.run(_current.set, trace)
+    error = None
+    try:
+        while True:
+            try:
+                item = context.run(next, iterator)
+            except StopIteration:
+                return
+            emitted = time.time()
+            yield item
+            trace.record_emission(emitted, time.time())
+    except BaseException as e:
+        error = e
+        raise
+    finally:
+        if hasattr(iterator, 'close'):
+            iterator.close()
+        trace.finish(error if isinstance(error, Exception) else None)
+
+
+@contextmanager
+def span(name: str, **attributes):
+    """记录一段代码的耗时，没有活动时间线时不做任何事"""
+    trace = _current.get()
+    if trace is None:
+        yield
+        return
+    start = time.time()
+    try:
+        yield
+    finally:
+        trace.add_span(name, start, time.time(), **attributes)
+
+
+def record_model_spans(stage: str, model: str, start: float, end: float, response=None,
+                       ttft: Optional[float] = None):
+    """根据墙钟时间和ollama返回的耗时字段记录一次模型调用
+
+    有完整响应时按load_duration、prompt_eval_duration、eval_duration依次拆分为
+    加载、prefill、生成三段；流式调用被提前取消时没有这些字段，按首token时间拆分。
+    """
+    trace = _current.get()
+    if trace is None:
+        return
+    trace.add_span(f'{stage}_call', start, end, model=model)
+    if response is not None and response.get('eval_duration'):
+        # ollama返回的耗时单位为纳秒
+        load = (response.get('load_duration') or 0) / 1e9
+        prefill = (response.get('prompt_eval_duration') or 0) / 1e9
+        generation = response['eval_duration'] / 1e9
+        cursor = start
+        if load:
+            trace.add_span(f'{stage}_load', cursor, cursor + load, model=model)
+            cursor += load
+            if load >= COLD_LOAD_SECONDS:
+                trace.mark_cold_load(model, load)
+        trace.add_span(f'{stage}_prefill', cursor, cursor + prefill, model=model,
+                       tokens=response.get('prompt_eval_count'))
+        cursor += prefill
+        trace.add_span(f'{stage}_generation', cursor, cursor + generation, model=model,
+                       tokens=response.get('eval_count'))
+    elif ttft is not None:
+        trace.add_span(f'{stage}_prefill', start, start + ttft, model=model)
+        trace.add_span(f'{stage}_generation', start + ttft, end, model=model, cancelled=True)
+
+
+def to_chrome_trace(records: List[Dict]) -> Dict:
+    """转换为Chrome trace event格式，可在Perfetto或chrome://tracing中打开"""
+    events = []
+    for index, record in enumerate(records, start=1):
+        events.append({'name': 'thread_name', 'ph': 'M', 'pid': 1, 'tid': index,
+                       'args': {'name': f"{record['name']} {record['trace_id'][:8]}"}})
+        args = dict(record['attributes'], cold_load=record['cold_load'], cold_loads=record['cold_loads'])
+        events.append({'name': record['name'], 'ph': 'X', 'pid': 1, 'tid': index,
+                       'ts': record['start'] * 1e6, 'dur': record['duration'] * 1e6, 'args': args})
+        for item in record['spans']:
+            events.append({'name': item['name'], 'ph': 'X', 'pid': 1, 'tid': index,
+                           'ts': item['start'] * 1e6, 'dur': item['duration'] * 1e6,
+                           'args': item['attributes']})
+    return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='把解题时间线JSONL转换为Chrome trace格式')
+    parser.add_argument('traces', help='SOLVER_TRACE_FILE写出的JSONL文件')
+    parser.add_argument('-o', '--output', default='trace.json', help='输出文件，可在Perfetto中打开')
+    parser.add_argument('--slowest', type=int, default=0, help='只导出耗时最长的N个请求')
+    parser.add_argument('--cold-only', action='store_true', help='只导出发生模型冷启动的请求')
+    args = parser.parse_args()
+
+    with open(args.traces, 'r', encoding='utf-8') as f:
+        records = [json.loads(line) for line in f if line.strip()]
+    if args.cold_only:
+        records = [record for record in records if record['cold_load']]
+    if args.slowest:
+        records = sorted(records, key=lambda record: record['duration'], reverse=True)[:args.slowest]
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(to_chrome_trace(records), f, ensure_ascii=False)
+    print(f"📝 已导出 {len(records)} 个请求的时间线到 {args.output}")
+
+
+if __name__ == "__main__":
+    main()
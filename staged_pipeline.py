@@ -0,0 +1,226 @@
+import os
+import time
+import queue
+import threading
+import contextvars
+from concurrent.futures import Future
+from typing import Callable, Dict, Optional
+
+from solver_core import solve_problem
+from solver_metrics import ERRORS, IN_FLIGHT, QUEUE_WAIT_SECONDS, REQUEST_SECONDS
+from solver_trace import activate_trace, start_trace
+from worksheet_layout import recognize_worksheet
+
+# 流水线配置，可通过环境变量覆盖
+PIPELINE_VISION_WORKERS = int(os.environ.get('PIPELINE_VISION_WORKERS', '2'))
+PIPELINE_MATH_WORKERS = int(os.environ.get('PIPELINE_MATH_WORKERS', '2'))
+PIPELINE_QUEUE_SIZE = int(os.environ.get('PIPELINE_QUEUE_SIZE', '16'))
+
+_STOP = object()
+
+
+class _StageStats:
+    """单个阶段的运行统计"""
+
+    def __init__(self, name: str, workers: int, stage_queue: queue.Queue):
+        self.name = name
+        self.workers = workers
+        self.queue = stage_queue
+        self.busy = 0
+        self.processed = 0
+        self.errors = 0
+        self.busy_seconds = 0.0
+        self.wait_seconds = 0.0
+        self.started_at = time.time()
+        self.lock = threading.Lock()
+
+    def snapshot(self) -> Dict:
+        with self.lock:
+            elapsed = max(time.time() - self.started_at, 1e-9)
+            busy_seconds = self.busy_seconds
+            return {
+                'queue_depth': self.queue.qsize(),
+                'queue_capacity': self.queue.maxsize,
+                'workers': self.workers,
+                'busy_workers': self.busy,
+                'processed': self.processed,
+                'errors': self.errors,
+                # 利用率 = 各工作线程忙碌时间之和 / (运行时长 * 线程数)
+                'utilization': round(busy_seconds / (elapsed * self.workers), 4),
+                'avg_queue_wait': round(self.wait_seconds / self.processed, 4) if self.processed else 0.0,
+            }
+
+
+class StagedPipeline:
+    """识别、解题两阶段流水线
+
+    两个阶段之间用有界队列连接，各自拥有独立的工作线程。第N张图片解题时，
+    第N+1张图片已经在识别，vision模型和数学模型不再互相空等。队列满时
+    submit会阻塞，形成背压。
+    """
+
+    def __init__(self, vision_workers: int = PIPELINE_VISION_WORKERS, math_workers: int = PIPELINE_MATH_WORKERS,
+                 queue_size: int = PIPELINE_QUEUE_SIZE, vision_fn: Optional[Callable] = None,
+                 math_fn: Optional[Callable] = None):
+        self.vision_fn = vision_fn or recognize_worksheet
+        self.math_fn = math_fn or solve_problem
+        self._vision_queue = queue.Queue(maxsize=queue_size)
+        self._math_queue = queue.Queue(maxsize=queue_size)
+        self._stats = {
+            'vision': _StageStats('vision', vision_workers, self._vision_queue),
+            'math': _StageStats('math', math_workers, self._math_queue),
+        }
+        self._threads = []
+        for index in range(vision_workers):
+            self._start_worker(f'vision-{index}', self._vision_worker)
+        for index in range(math_workers):
+            self._start_worker(f'math-{index}', self._math_worker)
+
+    def _start_worker(self, name: str, target: Callable):
+        thread = threading.Thread(target=target, name=f'pipeline-{name}', daemon=True)
+        thread.start()
+        self._threads.append(thread)
+
+    def submit(self, image, timeout: Optional[float] = None, **metadata) -> Future:
+        """提交一张图片，返回Future，结果为包含识别文本和解答的dict
+
+        Raises:
+            queue.Full: 在timeout秒内识别队列一直是满的
+        """
+        future = Future()
+        job = {
+            'image': image,
+            'future': future,
+            'record': dict(metadata),
+            'submitted_at': time.time(),
+            'enqueued_at': time.time(),
+            'trace': start_trace('pipeline', **metadata),
+            # 工作线程在提交方的上下文副本中执行各阶段，取消令牌、截止时间等contextvars随任务传递
+            'context': contextvars.copy_context(),
+        }
+        try:
+            self._vision_queue.put(job, timeout=timeout)
+        except queue.Full as e:
+            if job['trace'] is not None:
+                job['trace'].finish(e)
+            raise
+        IN_FLIGHT.inc(entry='pipeline')
+        future.add_done_callback(lambda f: self._finish_request(job))
+        return future
+
+    def _finish_request(self, job: Dict):
+        IN_FLIGHT.dec(entry='pipeline')
+        REQUEST_SECONDS.observe(time.time() - job['submitted_at'], entry='pipeline')
+        if job['trace'] is not None:
+            future = job['future']
+            job['trace'].finish(None if future.cancelled() else future.exception())
+
+    def solve(self, image, timeout: Optional[float] = None, **metadata) -> Dict:
+        """同步提交并等待结果"""
+        return self.submit(image, **metadata).result(timeout=timeout)
+
+    def _run_stage(self, stage: str, job: Dict, fn: Callable, argument):
+        """执行一个阶段并记录排队与忙碌时间，出错时返回None并结束该任务"""
+        stats = self._stats[stage]
+        started = time.time()
+        with stats.lock:
+            stats.busy += 1
+            stats.wait_seconds += started - job['enqueued_at']
+        QUEUE_WAIT_SECONDS.observe(started - job['enqueued_at'], stage=stage)
+        if job['trace'] is not None:
+            job['trace'].add_span(f'{stage}_queue_wait', job['enqueued_at'], started)
+        try:
+            return job['context'].run(self._call_traced, job['trace'], fn, argument), None
+        except Exception as e:
+            return None, e
+        finally:
+            finished = time.time()
+            job['record'][f'{stage}_seconds'] = round(finished - started, 3)
+            job['record'][f'{stage}_queue_wait_seconds'] = round(started - job['enqueued_at'], 3)
+            with stats.lock:
+                stats.busy -= 1
+                stats.processed += 1
+                stats.busy_seconds += finished - started
+
+    @staticmethod
+    def _call_traced(trace, fn: Callable, argument):
+        with activate_trace(trace):
+            return fn(argument)
+
+    def _fail(self, stage: str, job: Dict, error: Exception):
+        with self._stats[stage].lock:
+            self._stats[stage].errors += 1
+        ERRORS.inc(stage=stage)
+        job['future'].set_exception(error)
+
+    def _vision_worker(self):
+        while True:
+            job = self._vision_queue.get()
+            if job is _STOP:
+                return
+            # 任务在排队期间被取消则直接丢弃
+            if not job['future'].set_running_or_notify_cancel():
+                continue
+            recognition, error = self._run_stage('vision', job, self.vision_fn, job['image'])
+            if error is not None:
+                self._fail('vision', job, error)
+                continue
+            job['record']['recognition'] = recognition
+            job['record']['recognized_text'] = recognition['text']
+            job['enqueued_at'] = time.time()
+            self._math_queue.put(job)
+
+    def _math_worker(self):
+        while True:
+            job = self._math_queue.get()
+            if job is _STOP:
+                return
+            answer, error = self._run_stage('math', job, self.math_fn, job['record']['recognized_text'])
+            if error is not None:
+                self._fail('math', job, error)
+                continue
+            job['record']['answer'] = answer
+            job['record']['total_seconds'] = round(time.time() - job['submitted_at'], 3)
+            job['future'].set_result(job['record'])
+
+    def stats(self) -> Dict:
+        """各阶段的队列深度、忙碌线程数、利用率等统计"""
+        return {name: stats.snapshot() for name, stats in self._stats.items()}
+
+    def format_stats(self) -> str:
+        """格式化统计信息"""
+        parts = []
+        for name, snapshot in self.stats().items():
+            parts.append(
+                f"{name}: 队列 {snapshot['queue_depth']}/{snapshot['queue_capacity']}, "
+                f"忙碌 {snapshot['busy_workers']}/{snapshot['workers']}, "
+                f"利用率 {snapshot['utilization']:.0%}, 已处理 {snapshot['processed']}"
+            )
+        return ' | '.join(parts)
+
+    def shutdown(self, wait: bool = True):
+        """停止工作线程（已排队的任务会先处理完）"""
+        for _ in range(self._stats['vision'].workers):
+            self._vision_queue.put(_STOP)
+        if wait:
+            for thread in self._threads:
+                if thread.name.startswith('pipeline-vision'):
+                    thread.join()
+        for _ in range(self._stats['math'].workers):
+            self._math_queue.put(_STOP)
+        if wait:
+            for thread in self._threads:
+                thread.join()
+
+
+_default_pipeline = None
+_default_pipeline_lock = threading.Lock()
+
+
+def get_pipeline() -> StagedPipeline:
+    """获取进程内共享的解题流水线，Gradio处理函数和批量模式都提交到这里"""
+    global _default_pipeline
+    with _default_pipeline_lock:
+        if _default_pipeline is None:
+            _default_pipeline = StagedPipeline()
+        return _default_pipeline
@@ -0,0 +1,120 @@
+import os
+import time
+import threading
+from typing import Dict, Optional
+
+# 流式交接：识别出完整题目后取消剩余的vision生成，立即开始解题；设置 VISION_HANDOFF=1 开启
+VISION_HANDOFF = os.environ.get('VISION_HANDOFF', '0') == '1'
+
+# 结构化结束标记：开启交接时提示词要求模型在题目后输出该标记，只在标记处截断
+END_MARKER = '[END]'
+HANDOFF_PROMPT_SUFFIX = f'。题目内容输出完毕后，单独一行输出{END_MARKER}'
+# 每隔多少次提前交接，在后台让一次vision生成跑完，更新顺序执行的耗时基线；0表示不采样
+HANDOFF_BASELINE_EVERY = int(os.environ.get('HANDOFF_BASELINE_EVERY', '20'))
+
+
+def handoff_prompt(prompt: str) -> str:
+    """开启交接时发给vision模型的提示词，要求题目之后输出结束标记"""
+    return prompt + HANDOFF_PROMPT_SUFFIX
+
+
+def problem_end(text: str) -> Optional[int]:
+    """判断流式识别文本中题目是否已经输出完整
+
+    只认结构化结束标记。“图中∠ABC=90°”这类题干和描述图片的段落无法可靠区分，
+    模型没有输出标记时宁可等生成结束，也不截掉题目。
+
+    Returns:
+        题目结束位置（截断下标），尚未结束返回None
+    """
+    marker = text.find(END_MARKER)
+    return marker if marker != -1 else None
+
+
+class HandoffTracker:
+    """统计提前交接节省的时间
+
+    完整输出的vision调用耗时按模型做指数滑动平均，作为顺序执行时的基线；
+    提前交接时，节省时间 = 基线 - 实际识别耗时。检测器总能提前交接时没有完整调用
+    可做基线，因此每隔baseline_every次交接，把剩余生成放到后台线程跑完来采样基线，
+    解题阶段不受影响。
+    """
+
+    def __init__(self, smoothing: float = 0.2, baseline_every: int = HANDOFF_BASELINE_EVERY):
+        self.smoothing = smoothing
+        self.baseline_every = baseline_every
+        self._baseline: Dict[str, float] = {}
+        self._sampling = set()
+        self._lock = threading.Lock()
+        self.stats = {'handoffs': 0, 'completed': 0, 'baseline_samples': 0, 'saved_seconds': 0.0}
+
+    def _update_baseline(self, model: str, seconds: float):
+        baseline = self._baseline.get(model)
+        self._baseline[model] = seconds if baseline is None else baseline + self.smoothing * (seconds - baseline)
+
+    def record_completed(self, model: str, seconds: float):
+        """记录一次完整输出的vision调用"""
+        with self._lock:
+            self._update_baseline(model, seconds)
+            self.stats['completed'] += 1
+
+    def record_handoff(self, model: str, seconds: float) -> Dict:
+        """记录一次提前交接，返回交接信息"""
+        with self._lock:
+            baseline = self._baseline.get(model)
+            saved = round(max(baseline - seconds, 0.0), 3) if baseline is not None else None
+            self.stats['handoffs'] += 1
+            self.stats['saved_seconds'] += saved or 0.0
+        return {
+            'seconds': round(seconds, 3),
+            'estimated_full_seconds': round(baseline, 3) if baseline is not None else None,
+            'saved_seconds': saved,
+        }
+
+    def should_sample(self, model: str) -> bool:
+        """本次交接后是否在后台跑完剩余生成来采样基线"""
+        if self.baseline_every <= 0:
+            return False
+        with self._lock:
+            # 同一模型同时只采样一次，避免并发请求一起占用vision模型
+            if model in self._sampling:
+                return False
+            if model not in self._baseline or self.stats['handoffs'] % self.baseline_every == 0:
+                self._sampling.add(model)
+                return True
+            return False
+
+    def drain_in_background(self, model: str, stream, started: float):
+        """在后台线程读完剩余的流式输出，记录完整耗时作为基线"""
+        def drain():
+            try:
+                for _ in stream:
+                    pass
+            except Exception:
+                pass
+            finally:
+                stream.close()
+            with self._lock:
+                self._sampling.discard(model)
+                if stream.stats['completed']:
+                    self._update_baseline(model, time.time() - started)
+                    self.stats['baseline_samples'] += 1
+
+        threading.Thread(target=drain, name='handoff-baseline', daemon=True).start()
+
+    def report(self, info: Dict) -> str:
+        """格式化一次提前交接的信息和累计节省时间"""
+        if info['saved_seconds'] is None:
+            saved = '暂无完整识别的基线'
+        else:
+            saved = f"比完整输出预计节省 {info['saved_seconds']}s"
+        return (f"识别 {info['seconds']}s，{saved} | 累计提前交接 {self.stats['handoffs']} 次，"
+                f"共节省 {self.stats['saved_seconds']:.1f}s")
+
+
+_tracker = HandoffTracker()
+
+
+def get_handoff_tracker() -> HandoffTracker:
+    """获取进程内共享的交接统计"""
+    return _tracker
@@ -0,0 +1,330 @@
+import os
+import re
+import unicodedata
+from typing import Dict, List, Optional, Tuple
+
+import sympy
+from sympy.parsing.sympy_parser import (convert_xor, implicit_multiplication_application, parse_expr,
+                                        standard_transformations)
+
+# 识别结果是简单方程、方程组或求导时用SymPy在本地求解，设置 SYMBOLIC_FAST_PATH=0 关闭
+SYMBOLIC_FAST_PATH = os.environ.get('SYMBOLIC_FAST_PATH', '1') != '0'
+
+# 超过这个长度的文本不像简单题目，直接交给数学模型
+MAX_PROBLEM_CHARS = 400
+# 防止 2^(10^10) 之类的输入让化简卡住
+MAX_EXPONENT = 10
+MAX_EQUATIONS = 3
+
+_TRANSFORMS = standard_transformations + (implicit_multiplication_application, convert_xor)
+_FUNCTIONS = {'sin': sympy.sin, 'cos': sympy.cos, 'tan': sympy.tan, 'exp': sympy.exp, 'ln': sympy.log,
+              'log': sympy.log, 'sqrt': sympy.sqrt, 'pi': sympy.pi, 'e': sympy.E}
+
+_SUPERSCRIPTS = str.maketrans({'²': '^2', '³': '^3', '⁴': '^4', '−': '-', '–': '-', '×': '*', '÷': '/',
+                               '·': '*', 'π': 'pi', '√': 'sqrt'})
+_LATEX_FRAC = re.compile(r'\\[dt]?frac\{([^{}]*)\}\{([^{}]*)\}')
+_LATEX_COMMANDS = [(r'\cdot', '*'), (r'\times', '*'), (r'\div', '/'), (r'\left', ''), (r'\right', ''),
+                   (r'\sqrt', 'sqrt'), (r'\sin', 'sin'), (r'\cos', 'cos'), (r'\tan', 'tan'), (r'\ln', 'ln'),
+                   (r'\pi', 'pi'), ('\\(', ' '), ('\\)', ' '), ('\\[', ' '), ('\\]', ' '), ('$', ' ')]
+# 一行中一段连续的数学表达式（不含中文和标点）
+_MATH_RUN = re.compile(r'[0-9A-Za-z+\-*/^().= \t]+')
+_IDENTIFIER = re.compile(r'[A-Za-z]+')
+_DERIVATIVE = re.compile(r'求导|导数|derivative|d\s*/\s*d\s*[a-z]', re.IGNORECASE)
+_D_DX = re.compile(r'd\s*/\s*d\s*([a-z])')
+_FUNCTION_PREFIX = re.compile(r'^\s*(?:[fgy]\s*(?:\(\s*[a-z]\s*\))?\s*=)')
+# 去掉已解析的公式后，剩余文字只能是这些纯指令；“求4x+1的值”“两根之和”“在x=2处的导数”等
+# 问的不是方程的解或导函数本身，交给数学模型
+_DIRECTIVE_SEPARATORS = re.compile(r'[\s:：,，。.;；!！?？]+')
+_EQUATION_DIRECTIVE = re.compile(
+    r'(?:(?:求解|解下列|解这个|解|求)?方程组?(?:的解)?|求解)?(?:求[a-z](?:[和、与及]?[a-z])*(?:的值)?)?'
+    r'|solve(?:theequations?|thesystem|for[a-z](?:and[a-z])*)?')
+_DERIVATIVE_DIRECTIVE = re.compile(
+    r'(?:求?(?:函数)?的?导数|(?:对函数)?求导(?:数|函数)?|(?:find)?(?:the)?derivative(?:of)?)?')
+
+
+def _to_plain_math(text: str) -> str:
+    """把LaTeX和Unicode数学符号转换为SymPy可以解析的写法"""
+    text = text.translate(_SUPERSCRIPTS)
+    text = unicodedata.normalize('NFKC', text)
+    for _ in range(3):
+        text = _LATEX_FRAC.sub(r'((\1)/(\2))', text)
+    for command, replacement in _LATEX_COMMANDS:
+        text = text.replace(command, replacement)
+    return text.replace('{', '(').replace('}', ')')
+
+
+def _parse(expression: str) -> Optional[sympy.Expr]:
+    """解析单个表达式，含未知函数名、过大指数或无法解析时返回None"""
+    expression = expression.strip()
+    if not expression:
+        return None
+    # parse_expr内部使用eval，只放行单字母变量和白名单中的函数名
+    for name in _IDENTIFIER.findall(expression):
+        if len(name) > 1 and name not in _FUNCTIONS:
+            return None
+    local_dict = dict(_FUNCTIONS)
+    local_dict.update({name: sympy.Symbol(name) for name in _IDENTIFIER.findall(expression)
+                       if name not in _FUNCTIONS})
+    try:
+        parsed = parse_expr(expression, local_dict=local_dict, transformations=_TRANSFORMS, evaluate=False)
+    except Exception:
+        return None
+    if not isinstance(parsed, sympy.Expr):
+        return None
+    for power in parsed.atoms(sympy.Pow):
+        if not power.exp.is_number or abs(power.exp) > MAX_EXPONENT:
+            return None
+    return parsed
+
+
+def _latex(expr) -> str:
+    return sympy.latex(expr)
+
+
+def extract_equations(text: str) -> List[sympy.Eq]:
+    """从识别文本中找出所有形如 左边 = 右边 的方程"""
+    return [equation for _, equation in _equation_runs(text)]
+
+
+def _equation_runs(text: str) -> List[Tuple[Tuple[int, int], sympy.Eq]]:
+    """extract_equations的详细版本，同时返回每个方程在文本中的位置"""
+    equations = []
+    for match in _MATH_RUN.finditer(text):
+        run = match.group()
+        if run.count('=') != 1:
+            continue
+        left, right = run.split('=')
+        lhs, rhs = _parse(left), _parse(right)
+        if lhs is None or rhs is None:
+            continue
+        equations.append((match.span(), sympy.Eq(lhs, rhs, evaluate=False)))
+    return equations
+
+
+def _expression_after(text: str, start: int) -> Optional[Tuple[Tuple[int, int], str]]:
+    """取求导标记之后的第一段数学表达式（去掉 f(x)= / y= 前缀），连同它在文本中的位置"""
+    for match in _MATH_RUN.finditer(text, start):
+        run = _FUNCTION_PREFIX.sub('', match.group()).strip()
+        if run and '=' not in run and _IDENTIFIER.search(run):
+            return match.span(), run
+    return None
+
+
+def _is_directive(text: str, spans: List[Tuple[int, int]], directive: re.Pattern) -> bool:
+    """去掉已解析的公式后，剩余文字是否只是“解方程”“求x”“求导”之类的指令"""
+    remainder, position = [], 0
+    for start, end in sorted(spans):
+        remainder.append(text[position:start])
+        position = end
+    remainder.append(text[position:])
+    leftover = _DIRECTIVE_SEPARATORS.sub('', ''.join(remainder)).lower()
+    return directive.fullmatch(leftover) is not None
+
+
+def _solve_equation(equation: sympy.Eq) -> Optional[str]:
+    """一元一次、一元二次方程"""
+    expr = sympy.expand(equation.lhs - equation.rhs)
+    symbols = sorted(expr.free_symbols, key=str)
+    if len(symbols) != 1:
+        return None
+    x = symbols[0]
+    try:
+        poly = sympy.Poly(expr, x)
+    except sympy.PolynomialError:
+        return None
+    if any(not coefficient.is_rational for coefficient in poly.all_coeffs()):
+        return None
+    if poly.degree() == 1:
+        return _linear_steps(equation, poly, x)
+    if poly.degree() == 2:
+        return _quadratic_steps(equation, poly, x)
+    return None
+
+
+def _linear_steps(equation: sympy.Eq, poly: sympy.Poly, x: sympy.Symbol) -> str:
+    a, b = poly.all_coeffs()
+    solution = -b / a
+    lines = [
+        f"这是关于 ${x}$ 的一元一次方程 ${_latex(equation.lhs)} = {_latex(equation.rhs)}$。",
+        "",
+        "**解题步骤：**",
+        "",
+        "1. **移项整理：** 把含未知数的项留在左边，常数项移到右边：",
+        f"   \\[ {_latex(a * x)} = {_latex(-b)} \\]",
+    ]
+    if a != 1:
+        lines += [
+            f"2. **系数化为1：** 两边同时除以 ${_latex(a)}$：",
+            f"   \\[ {x} = {_latex(solution)} \\]",
+        ]
+    lines += ["", "**最终答案：**", "", f"\\[ {x} = {_latex(solution)} \\]"]
+    return '\n'.join(lines)
+
+
+def _quadratic_steps(equation: sympy.Eq, poly: sympy.Poly, x: sympy.Symbol) -> str:
+    a, b, c = poly.all_coeffs()
+    discriminant = b ** 2 - 4 * a * c
+    roots = sympy.solve(poly.as_expr(), x)
+    lines = [
+        f"这是关于 ${x}$ 的一元二次方程 ${_latex(equation.lhs)} = {_latex(equation.rhs)}$。",
+        "",
+        "**解题步骤：**",
+        "",
+        "1. **化为一般形式** $ax^2 + bx + c = 0$：",
+        f"   \\[ {_latex(poly.as_expr())} = 0 \\]",
+        f"   其中 $a = {_latex(a)}$，$b = {_latex(b)}$，$c = {_latex(c)}$。",
+        "2. **计算判别式：**",
+        f"   \\[ \\Delta = b^2 - 4ac = {_latex(b ** 2)} {'-' if 4 * a * c >= 0 else '+'} {_latex(abs(4 * a * c))} "
+        f"= {_latex(discriminant)} \\]",
+    ]
+    factored = sympy.factor(poly.as_expr())
+    if discriminant >= 0 and all(root.is_rational for root in roots):
+        lines += [
+            "3. **因式分解：**",
+            f"   \\[ {_latex(factored)} = 0 \\]",
+        ]
+    else:
+        lines += [
+            "3. **代入求根公式** $x = \\dfrac{-b \\pm \\sqrt{\\Delta}}{2a}$：",
+            f"   \\[ {x} = \\frac{{{_latex(-b)} \\pm \\sqrt{{{_latex(discriminant)}}}}}{{{_latex(2 * a)}}} \\]",
+        ]
+    if discriminant < 0:
+        lines.append("   判别式小于0，方程没有实数根，在复数范围内的根为：")
+    elif discriminant == 0:
+        lines.append("   判别式等于0，方程有两个相等的实数根：")
+    answer = ' \\quad \\text{或} \\quad '.join(f"{x} = {_latex(root)}" for root in roots)
+    lines += [
+        f"   \\[ {answer} \\]",
+        "",
+        "**最终答案：**",
+        "",
+        f"\\[ {answer} \\]",
+    ]
+    return '\n'.join(lines)
+
+
+def _solve_system(equations: List[sympy.Eq]) -> Optional[str]:
+    """二元、三元一次方程组，要求有唯一解"""
+    expressions = [sympy.expand(equation.lhs - equation.rhs) for equation in equations]
+    symbols = sorted(set().union(*(expr.free_symbols for expr in expressions)), key=str)
+    if len(symbols) != len(equations):
+        return None
+    for expr in expressions:
+        try:
+            if sympy.Poly(expr, *symbols).total_degree() != 1:
+                return None
+        except sympy.PolynomialError:
+            return None
+    solutions = sympy.linsolve(expressions, symbols)
+    if len(solutions) != 1:
+        return None
+    solution = next(iter(solutions))
+    if any(value.free_symbols for value in solution):
+        # 无穷多解
+        return None
+
+    lines = [f"这是{'二三'[len(equations) - 2]}元一次方程组：", "", "\\[ \\begin{cases}"]
+    lines += [f"{_latex(equation.lhs)} = {_latex(equation.rhs)} \\\\" for equation in equations]
+    lines += ["\\end{cases} \\]", "", "**解题步骤：**", ""]
+    substitution = False
+    if len(equations) == 2:
+        first, second = symbols
+        expressed = sympy.solve(expressions[0], first)
+        substitution = len(expressed) == 1 and second in expressions[1].subs(first, expressed[0]).free_symbols
+        if substitution:
+            substituted = sympy.expand(expressions[1].subs(first, expressed[0]))
+            lines += [
+                "1. **用代入法消元：** 由第一个方程得",
+                f"   \\[ {first} = {_latex(expressed[0])} \\]",
+                "2. **代入第二个方程：**",
+                f"   \\[ {_latex(substituted)} = 0 \\]",
+                f"   解得 ${second} = {_latex(solution[1])}$。",
+                f"3. **回代：** 把 ${second} = {_latex(solution[1])}$ 代入 ${first} = {_latex(expressed[0])}$，"
+                f"得 ${first} = {_latex(solution[0])}$。",
+            ]
+    if not substitution:
+        lines += [
+            "1. **写成标准形式：**",
+            *[f"   \\[ {_latex(expr)} = 0 \\]" for expr in expressions],
+            "2. **用加减消元法依次消去未知数并回代**，得到唯一解。",
+        ]
+    answer = ',\\ '.join(f"{symbol} = {_latex(value)}" for symbol, value in zip(symbols, solution))
+    lines += ["", "**最终答案：**", "", f"\\[ {answer} \\]"]
+    return '\n'.join(lines)
+
+
+def _solve_derivative(text: str) -> Optional[str]:
+    """对初等函数求导，逐项应用求导法则"""
+    d_dx = _D_DX.search(text)
+    variable = sympy.Symbol(d_dx.group(1)) if d_dx else None
+    text = _D_DX.sub(' ', text)
+    match = _DERIVATIVE.search(text)
+    found = (_expression_after(text, match.end()) if match else None) or _expression_after(text, 0)
+    if found is None:
+        return None
+    span, expression = found
+    if not _is_directive(text, [span], _DERIVATIVE_DIRECTIVE):
+        return None
+    expr = _parse(expression)
+    if expr is None:
+        return None
+    symbols = sorted(expr.free_symbols, key=str)
+    if variable is None:
+        if len(symbols) != 1:
+            return None
+        variable = symbols[0]
+    elif variable not in expr.free_symbols:
+        return None
+
+    expr = sympy.expand(expr) if expr.is_polynomial(variable) else expr
+    derivative = sympy.simplify(sympy.diff(expr, variable))
+    v = str(variable)
+    lines = [
+        f"求函数 $f({v}) = {_latex(expr)}$ 的导数。",
+        "",
+        "**解题步骤：**",
+        "",
+        "1. **逐项求导：** 和的导数等于各项导数之和，常数的导数为0：",
+    ]
+    for term in sympy.Add.make_args(expr):
+        lines.append(f"   \\[ \\frac{{d}}{{d{v}}}\\left({_latex(term)}\\right) = {_latex(sympy.diff(term, variable))} \\]")
+    lines += [
+        "2. **合并结果：**",
+        f"   \\[ f'({v}) = {_latex(derivative)} \\]",
+        "",
+        "**最终答案：**",
+        "",
+        f"\\[ f'({v}) = {_latex(derivative)} \\]",
+    ]
+    return '\n'.join(lines)
+
+
+def solve_symbolic(problem_text: str) -> Optional[Dict]:
+    """尝试在本地求解，支持一元一次/二次方程、一次方程组和求导
+
+    只处理公式之外只有纯指令（解方程、求x、求导等）的题目；题目问的是别的量
+    （“若2x+3=7，求4x+1的值”“两根之和”“在x=2处的导数”）时不求解。
+    成功时返回 {'type': 题型, 'answer': 带步骤的解答}，题型不支持或解析失败时返回None，
+    由调用方交给数学模型。
+    """
+    if len(problem_text) > MAX_PROBLEM_CHARS:
+        return None
+    text = _to_plain_math(problem_text)
+    try:
+        if _DERIVATIVE.search(text):
+            answer = _solve_derivative(text)
+            return {'type': 'derivative', 'answer': answer} if answer else None
+        runs = _equation_runs(text)
+        if not _is_directive(text, [span for span, _ in runs], _EQUATION_DIRECTIVE):
+            return None
+        equations = [equation for _, equation in runs]
+        if len(equations) == 1:
+            answer = _solve_equation(equations[0])
+            return {'type': 'equation', 'answer': answer} if answer else None
+        if 2 <= len(equations) <= MAX_EQUATIONS:
+            answer = _solve_system(equations)
+            return {'type': 'system', 'answer': answer} if answer else None
+    except Exception as e:
+        # 快速通道出任何问题都不影响解题，交给数学模型
+        print(f"⚠️ 符号求解失败，交给数学模型: {e}")
+    return None
@@ -0,0 +1,66 @@
+import pytest
+
+from admission import (AdmissionController, ServerBusy, gradio_concurrency_limit, gradio_queue_size,
+                       run_admitted)
+
+
+def make_controller(**kwargs):
+    options = dict(max_in_flight=2, max_queue=2, max_wait=0, initial_service_seconds=10)
+    options.update(kwargs)
+    return AdmissionController(**options)
+
+
+def test_gradio_limit_exceeds_admission_capacity():
+    controller = make_controller()
+    capacity = controller.max_in_flight + controller.max_queue
+    assert gradio_concurrency_limit(controller) > capacity
+    assert gradio_queue_size(controller) >= 1
+
+
+def test_request_beyond_capacity_is_rejected_inside_gradio_limit():
+    controller = make_controller()
+    tickets = [controller.enter() for _ in range(4)]
+    # 第容量+1个请求仍在Gradio的并发上限之内，能进入处理函数并被立即拒绝
+    assert len(tickets) + 1 <= gradio_concurrency_limit(controller)
+    with pytest.raises(ServerBusy) as busy:
+        controller.enter()
+    assert busy.value.retry_after >= 1
+    assert controller.stats['rejected'] == 1
+
+
+def test_disabled_controller_leaves_gradio_unbounded():
+    controller = make_controller(max_in_flight=0)
+    assert gradio_concurrency_limit(controller) is None
+    assert gradio_queue_size(controller) is None
+
+
+def test_fifo_promotion_and_abandon():
+    controller = make_controller(max_in_flight=1)
+    first = controller.enter()
+    second = controller.enter()
+    third = controller.enter()
+    assert (first.admitted, controller.position(second), controller.position(third)) == (True, 1, 2)
+    controller.release(second)
+    assert controller.stats['abandoned'] == 1
+    controller.release(first)
+    assert third.admitted
+
+
+def test_wait_estimate_rejects_hopeless_requests():
+    controller = make_controller(max_in_flight=1, max_queue=10, max_wait=15)
+    controller.enter()
+    controller.enter()
+    with pytest.raises(ServerBusy):
+        controller.enter()
+
+
+def test_run_admitted_reports_busy_and_releases():
+    controller = make_controller(max_in_flight=1, max_queue=0)
+    outputs = list(run_admitted(lambda: iter(['done']), queued=lambda text: text, busy=lambda text: text,
+                                controller=controller))
+    assert outputs == ['done']
+    held = controller.enter()
+    outputs = list(run_admitted(lambda: iter(['done']), queued=lambda text: text, busy=lambda text: text,
+                                controller=controller))
+    assert len(outputs) == 1 and '服务繁忙' in outputs[0]
+    controller.release(held)
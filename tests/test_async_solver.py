@@ -0,0 +1,44 @@
+import asyncio
+import threading
+
+from PIL import Image
+
+from recognition_cache import RecognitionCache
+from solution_cache import SolutionCache
+
+
+def test_async_paths_keep_cache_io_off_the_event_loop(tmp_path, monkeypatch):
+    import solver_core
+    recognition = RecognitionCache(cache_dir=str(tmp_path / 'recognition'))
+    solutions = SolutionCache(cache_dir=str(tmp_path / 'solution'))
+    loop_threads = set()
+
+    def off_loop(method):
+        def wrapper(*args, **kwargs):
+            assert threading.get_ident() not in loop_threads, f'{method.__name__} ran on the event loop'
+            return method(*args, **kwargs)
+        return wrapper
+
+    for cache in (recognition, solutions):
+        monkeypatch.setattr(cache, 'get', off_loop(cache.get))
+        monkeypatch.setattr(cache, 'put', off_loop(cache.put))
+    monkeypatch.setattr(solver_core, 'get_recognition_cache', lambda: recognition)
+    monkeypatch.setattr(solver_core, 'get_solution_cache', lambda: solutions)
+
+    async def fake_achat(stage='math', **kwargs):
+        return {'message': {'content': '请求 ' + stage}}
+
+    monkeypatch.setattr(solver_core, 'achat', fake_achat)
+
+    async def run():
+        loop_threads.add(threading.get_ident())
+        image = Image.new('RGB', (64, 64), 'white')
+        first = await solver_core.arecognize_image_detailed(image)
+        second = await solver_core.arecognize_image_detailed(image)
+        answer = await solver_core.asolve_problem('证明三角形内角和为180度')
+        cached = await solver_core.asolve_problem('证明三角形内角和为180度')
+        return first, second, answer, cached
+
+    first, second, answer, cached = asyncio.run(run())
+    assert (first['source'], second['source']) == ('model', 'cache')
+    assert answer == cached == '请求 math'
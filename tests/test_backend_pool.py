@@ -0,0 +1,81 @@
+import json
+
+import httpx
+
+from backend_pool import Backend, BackendPool, HostClient
+
+
+def _chat_response(request):
+    body = {'model': 'm', 'created_at': '2024-01-01T00:00:00Z', 'done': True,
+            'message': {'role': 'assistant', 'content': 'ok'}}
+    return httpx.Response(200, json=body)
+
+
+def _stream_response(request):
+    lines = [{'model': 'm', 'created_at': '2024-01-01T00:00:00Z', 'done': False,
+              'message': {'role': 'assistant', 'content': 'o'}},
+             {'model': 'm', 'created_at': '2024-01-01T00:00:00Z', 'done': True,
+              'message': {'role': 'assistant', 'content': 'k'}}]
+    return httpx.Response(200, content='\n'.join(json.dumps(line) for line in lines).encode())
+
+
+def make_backend(handler, seen):
+    def record(request):
+        seen.append(request.extensions['timeout']['read'])
+        return handler(request)
+
+    backend = Backend('http://host-a:11434')
+    backend.client = HostClient(host=backend.url, transport=httpx.MockTransport(record))
+    return backend
+
+
+def test_one_client_per_host_with_per_request_timeouts():
+    seen = []
+    backend = make_backend(_chat_response, seen)
+    client = backend.client
+    for timeout in (12.3456, 7.891, 0.5):
+        assert backend.chat(timeout=timeout, model='m', messages=[])['message']['content'] == 'ok'
+    assert seen == [12.3456, 7.891, 0.5]
+    assert backend.client is client
+
+
+def test_stream_keeps_timeout_of_its_call():
+    seen = []
+
+    def handler(request):
+        streaming = json.loads(request.content).get('stream')
+        return _stream_response(request) if streaming else _chat_response(request)
+
+    backend = make_backend(handler, seen)
+    stream = backend.chat(timeout=3.25, model='m', messages=[], stream=True)
+    # 流式请求在迭代时才发出，期间其他调用使用的超时不影响它
+    backend.chat(timeout=99.0, model='m', messages=[])
+    assert ''.join(chunk['message']['content'] for chunk in stream) == 'ok'
+    assert seen == [99.0, 3.25]
+
+
+def test_calls_outside_with_timeout_use_client_default():
+    seen = []
+
+    def record(request):
+        seen.append(request.extensions['timeout']['read'])
+        return _chat_response(request)
+
+    client = HostClient(host='http://host-a:11434', timeout=42.0, transport=httpx.MockTransport(record))
+    client.chat(model='m', messages=[])
+    client.with_timeout(5.0, 'chat', model='m', messages=[])
+    client.chat(model='m', messages=[])
+    assert seen == [42.0, 5.0, 42.0]
+
+
+def test_pool_prefers_least_outstanding_and_skips_open_breaker():
+    first, second = Backend('http://a'), Backend('http://b')
+    pool = BackendPool([first, second], health_interval=0)
+    leased = pool.choose('m')
+    other = pool.choose('m')
+    assert {leased, other} == {first, second}
+    pool.release(leased, 'm')
+    pool.release(other, 'm')
+    for _ in range(second.breaker.failure_threshold):
+        second.breaker.record(TimeoutError())
+    assert all(pool.choose('m') is first for _ in range(3))
@@ -0,0 +1,197 @@
+import json
+import socket
+import threading
+import time
+
+import httpx
+import pytest
+
+import concurrency_limit
+import ollama_stream
+from backend_pool import Backend, BackendPool, HostClient
+from cancellation import (CancelToken, Cancelled, call_timeout, cancel_session, cancellable_iter, check_cancelled,
+                          current_token, use_token)
+from concurrency_limit import limited_chat
+from ollama_stream import ChatStream
+from singleflight import SingleFlight
+
+
+def test_token_deadline_and_callbacks():
+    token = CancelToken(0.05)
+    fired = []
+    token.on_cancel(lambda: fired.append('first'))
+    remove = token.on_cancel(lambda: fired.append('removed'))
+    remove()
+    assert not token.cancelled
+    assert token.timeout(60) <= 0.05
+    time.sleep(0.06)
+    with pytest.raises(Cancelled) as cancelled:
+        token.check()
+    assert cancelled.value.reason == 'deadline'
+    token.cancel('cancelled')
+    assert fired == ['first'] and token.reason == 'deadline'
+    # 已取消时注册的回调立即执行
+    token.on_cancel(lambda: fired.append('late'))
+    assert fired == ['first', 'late']
+
+
+def test_call_timeout_outside_request_is_unchanged():
+    assert current_token() is None
+    assert call_timeout(30) == 30
+    check_cancelled()
+    with use_token(CancelToken(1)):
+        assert call_timeout(30) <= 1
+
+
+def test_cancellable_iter_runs_steps_with_token_and_closes_on_cancel():
+    seen = []
+    closed = threading.Event()
+
+    def steps():
+        try:
+            while True:
+                seen.append(current_token())
+                yield len(seen)
+        finally:
+            closed.set()
+
+    token = CancelToken()
+    stream = cancellable_iter(steps(), session='session-1', token=token)
+    assert next(stream) == 1 and seen == [token]
+    assert cancel_session('session-1') == 1
+    assert closed.is_set()
+    with pytest.raises(StopIteration):
+        next(stream)
+    assert cancel_session('session-1') == 0
+
+
+def test_singleflight_shares_one_call():
+    flights = SingleFlight('test', '测试')
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def source():
+        calls.append(1)
+        started.set()
+        release.wait(1)
+        yield 'partial'
+        yield 'done'
+
+    first = flights.stream('key', source)
+    results = []
+    reader = threading.Thread(target=lambda: results.append(list(first)[-1]))
+    reader.start()
+    started.wait(1)
+    second = flights.stream('key', source)
+    release.set()
+    assert list(second)[-1] == 'done'
+    reader.join(1)
+    assert results == ['done'] and len(calls) == 1
+    assert flights.stats == {'leaders': 1, 'followers': 1}
+
+
+def test_singleflight_cancels_call_when_all_subscribers_leave():
+    flights = SingleFlight('test', '测试')
+    tokens = []
+    release = threading.Event()
+
+    def source():
+        tokens.append(current_token())
+        yield 'partial'
+        release.wait(1)
+        yield 'done'
+
+    subscriber = CancelToken(0.1)
+    with use_token(subscriber):
+        stream = flights.stream('key', source)
+    assert next(stream) == 'partial'
+    time.sleep(0.12)
+    with pytest.raises(Cancelled):
+        next(stream)
+    # 后台调用使用自己的令牌，唯一的订阅者离开后以同样的原因取消
+    assert tokens[0] is not subscriber and tokens[0].reason == 'deadline'
+    release.set()
+
+
+class StalledServer:
+    """接收请求后一直不响应的主机（模拟还在预填充的模型），记录客户端断开连接的时间"""
+
+    def __init__(self):
+        self.socket = socket.socket()
+        self.socket.bind(('127.0.0.1', 0))
+        self.socket.listen()
+        self.url = f'http://127.0.0.1:{self.socket.getsockname()[1]}'
+        self.disconnects = []
+        threading.Thread(target=self._serve, daemon=True).start()
+
+    def _serve(self):
+        while True:
+            try:
+                conn, _ = self.socket.accept()
+            except OSError:
+                return
+            threading.Thread(target=self._handle, args=(conn,), daemon=True).start()
+
+    def _handle(self, conn):
+        with conn:
+            while conn.recv(65536):
+                pass
+        self.disconnects.append(time.monotonic())
+
+    def wait_disconnect(self, timeout: float = 2) -> bool:
+        deadline = time.monotonic() + timeout
+        while not self.disconnects and time.monotonic() < deadline:
+            time.sleep(0.01)
+        return bool(self.disconnects)
+
+
+@pytest.fixture
+def stalled_server():
+    server = StalledServer()
+    yield server
+    server.socket.close()
+
+
+def use_pool(monkeypatch, backends):
+    pool = BackendPool(backends, health_interval=0)
+    monkeypatch.setattr(concurrency_limit, 'get_backend_pool', lambda: pool)
+    monkeypatch.setattr(ollama_stream, 'get_backend_pool', lambda: pool)
+    return pool
+
+
+@pytest.mark.parametrize('streaming', [False, True])
+def test_cancel_aborts_call_still_waiting_for_first_token(monkeypatch, stalled_server, streaming):
+    use_pool(monkeypatch, [Backend(stalled_server.url)])
+    # 截止时间只是兜底，正常情况下在0.2秒时就被取消
+    token = CancelToken(5)
+    threading.Timer(0.2, token.cancel).start()
+    started = time.monotonic()
+    with pytest.raises(Cancelled) as cancelled, use_token(token):
+        if streaming:
+            list(ChatStream('m', [], hedge=False))
+        else:
+            limited_chat(model='m', messages=[])
+    # 不等读取超时，取消后连接立即断开
+    assert cancelled.value.reason == 'cancelled' and time.monotonic() - started < 2
+    assert stalled_server.wait_disconnect() and stalled_server.disconnects[0] - started < 2
+
+
+def test_hedge_closes_losing_attempt_immediately(monkeypatch, stalled_server):
+    def stream_response(request):
+        lines = [{'model': 'm', 'created_at': '2024-01-01T00:00:00Z', 'done': False,
+                  'message': {'role': 'assistant', 'content': 'o'}},
+                 {'model': 'm', 'created_at': '2024-01-01T00:00:00Z', 'done': True,
+                  'message': {'role': 'assistant', 'content': 'k'}}]
+        return httpx.Response(200, content='\n'.join(json.dumps(line) for line in lines).encode())
+
+    fast = Backend('http://fast-host:11434')
+    fast.client = HostClient(host=fast.url, transport=httpx.MockTransport(stream_response))
+    # 第一次请求发往不响应的主机，0.1秒后向另一台主机发出对冲请求
+    use_pool(monkeypatch, [Backend(stalled_server.url), fast])
+    monkeypatch.setattr(ollama_stream.TTFT_TRACKER, 'hedge_delay', lambda stage, model: 0.1)
+    stream = ChatStream('m', [], hedge=True, token=CancelToken(5))
+    started = time.monotonic()
+    assert ''.join(stream) == 'ok' and stream.stats['hedged']
+    # 落后的一方还没有任何输出，不等下一块（或读取超时）就关闭连接
+    assert stalled_server.wait_disconnect() and stalled_server.disconnects[0] - started < 2
@@ -0,0 +1,92 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from cancellation import CancelToken, Cancelled, use_token
+from concurrency_limit import AdaptiveLimiter
+
+
+def make_limiter(**kwargs):
+    options = dict(initial_limit=1, min_limit=1, max_limit=8, enabled=True)
+    options.update(kwargs)
+    return AdaptiveLimiter('test', 'model', **options)
+
+
+def test_acquire_times_out_when_full():
+    limiter = make_limiter()
+    with limiter.acquire():
+        started = time.monotonic()
+        with pytest.raises(TimeoutError):
+            with limiter.acquire(timeout=0.05):
+                pass
+        assert time.monotonic() - started < 1
+    assert limiter.in_flight == 0
+
+
+def test_acquire_honours_request_deadline():
+    limiter = make_limiter()
+    with limiter.acquire():
+        with use_token(CancelToken(0.05)):
+            with pytest.raises(Cancelled) as cancelled:
+                with limiter.acquire():
+                    pass
+    assert cancelled.value.reason == 'deadline'
+
+
+def test_cancel_wakes_waiting_acquire():
+    limiter = make_limiter()
+    token = CancelToken()
+    errors = []
+
+    def wait():
+        with use_token(token):
+            try:
+                with limiter.acquire():
+                    pass
+            except Cancelled as e:
+                errors.append(e)
+
+    with limiter.acquire():
+        waiter = threading.Thread(target=wait)
+        waiter.start()
+        time.sleep(0.05)
+        token.cancel()
+        waiter.join(timeout=1)
+        assert not waiter.is_alive() and len(errors) == 1
+
+
+def test_async_acquire_honours_request_deadline():
+    limiter = make_limiter()
+
+    async def run():
+        with use_token(CancelToken(0.05)):
+            async with limiter.aacquire():
+                pass
+
+    with limiter.acquire():
+        with pytest.raises(Cancelled):
+            asyncio.run(run())
+
+
+def test_limit_grows_when_latency_is_flat_and_shrinks_on_queueing():
+    limiter = make_limiter(initial_limit=4, smoothing=1.0)
+    for _ in range(20):
+        with limiter.acquire() as permit:
+            permit.in_flight = 4
+            permit.record(0.1)
+    grown = limiter.limit
+    assert grown > 4
+    for _ in range(10):
+        with limiter.acquire() as permit:
+            permit.record(1.0)
+    assert limiter.limit < grown
+
+
+def test_failures_back_off():
+    limiter = make_limiter(initial_limit=4)
+    with pytest.raises(RuntimeError):
+        with limiter.acquire():
+            raise RuntimeError('boom')
+    assert limiter.limit == pytest.approx(3.6)
@@ -0,0 +1,51 @@
+import random
+
+import pytest
+
+from image_hash import MultiIndexHammingIndex, hamming_distance, thumbnail_difference
+
+
+def _flip(value, bits):
+    for bit in bits:
+        value ^= 1 << bit
+    return value
+
+
+def test_mih_matches_linear_scan():
+    rng = random.Random(7)
+    index = MultiIndexHammingIndex()
+    hashes = [rng.getrandbits(64) for _ in range(500)]
+    query = hashes[0]
+    # 在不同距离上放一些近邻，保证结果不只有查询本身
+    for distance in range(1, 12):
+        hashes.append(_flip(query, rng.sample(range(64), distance)))
+    for value, hash_value in enumerate(hashes):
+        index.add(hash_value, value)
+    for max_distance in (0, 3, 6, 10):
+        expected = sorted(hamming_distance(query, h) for h in hashes if hamming_distance(query, h) <= max_distance)
+        assert [distance for distance, _ in index.search(query, max_distance)] == expected
+
+
+def test_mih_nearest_and_items():
+    index = MultiIndexHammingIndex()
+    index.add(0b1011, 'a')
+    index.add(0b1000, 'b')
+    assert index.nearest(0b1010, 1) == (1, 'a')
+    assert index.nearest(1 << 63, 0) is None
+    assert index.items() == [(0b1011, 'a'), (0b1000, 'b')] and len(index) == 2
+
+
+def test_mih_rejects_uneven_chunks():
+    with pytest.raises(ValueError):
+        MultiIndexHammingIndex(num_chunks=5)
+
+
+def test_thumbnail_difference():
+    plain = bytes(64 * 64)
+    assert thumbnail_difference(plain, plain) == 0.0
+    # 一个8x8块全部改变时，块内平均差即为最大差异
+    changed = bytearray(plain)
+    for row in range(8):
+        changed[row * 64:row * 64 + 8] = b'\xff' * 8
+    assert thumbnail_difference(plain, bytes(changed)) == pytest.approx(1.0)
+    assert thumbnail_difference(plain, bytes(32 * 32)) == 1.0
@@ -0,0 +1,133 @@
+import io
+import sqlite3
+
+from PIL import Image, ImageDraw, ImageEnhance, ImageFont
+
+from image_hash import hamming_distance, phash, pixel_thumbnail
+from recognition_cache import RecognitionCache
+
+NAMESPACE = 'ns'
+
+
+def render(text: str) -> Image.Image:
+    image = Image.new('RGB', (400, 120), 'white')
+    try:
+        font = ImageFont.truetype('DejaVuSans.ttf', 40)
+    except OSError:
+        font = ImageFont.load_default(size=40)
+    ImageDraw.Draw(image).text((20, 30), text, fill='black', font=font)
+    return image
+
+
+def recompress(image: Image.Image, quality: int = 50) -> Image.Image:
+    buffered = io.BytesIO()
+    image.save(buffered, format='JPEG', quality=quality)
+    return Image.open(io.BytesIO(buffered.getvalue())).convert('RGB')
+
+
+def remember(cache: RecognitionCache, image: Image.Image, text: str):
+    cache.put_similar(NAMESPACE, phash(image), pixel_thumbnail(image), text)
+
+
+def lookup(cache: RecognitionCache, image: Image.Image):
+    return cache.get_similar(NAMESPACE, phash(image), pixel_thumbnail(image))
+
+
+def test_near_duplicates_disabled_by_default(tmp_path):
+    cache = RecognitionCache(cache_dir=str(tmp_path))
+    image = render('2x - 4 = 0')
+    remember(cache, image, '2x - 4 = 0')
+    assert lookup(cache, image) is None
+
+
+def test_one_character_difference_is_not_reused(tmp_path):
+    cache = RecognitionCache(cache_dir=str(tmp_path), near_distance=6)
+    original = render('2x - 4 = 0')
+    remember(cache, original, '2x - 4 = 0')
+    for other in ('2x - 4 = 1', '3x + 5 = 7', '5y - 1 = 4'):
+        image = render(other)
+        # 感知哈希落在检索范围内，必须由像素级校验拒绝
+        assert hamming_distance(phash(original), phash(image)) <= 8
+        assert lookup(cache, image) is None, other
+
+
+def test_recompressed_copy_is_reused(tmp_path):
+    cache = RecognitionCache(cache_dir=str(tmp_path), near_distance=4)
+    original = render('2x - 4 = 0')
+    remember(cache, original, '2x - 4 = 0')
+    assert lookup(cache, recompress(original)) == '2x - 4 = 0'
+    assert lookup(cache, ImageEnhance.Brightness(original).enhance(0.8)) == '2x - 4 = 0'
+
+
+def test_entries_are_bounded_per_namespace(tmp_path):
+    cache = RecognitionCache(cache_dir=str(tmp_path), near_distance=4, near_max_entries=10)
+    thumbnail = pixel_thumbnail(render('x = 1'))
+    for value in range(25):
+        cache.put_similar(NAMESPACE, value << 32, thumbnail, str(value))
+    count = cache._db.execute('SELECT COUNT(*) FROM near_duplicates WHERE namespace = ?', (NAMESPACE,)).fetchone()[0]
+    assert count <= 10
+    # 最新的条目保留下来
+    assert cache.get_similar(NAMESPACE, 24 << 32, thumbnail) == '24'
+
+
+def test_legacy_table_without_thumbnails_is_dropped(tmp_path):
+    db = sqlite3.connect(str(tmp_path / 'recognition_cache.sqlite'))
+    db.execute('CREATE TABLE near_duplicates (namespace TEXT NOT NULL, phash TEXT NOT NULL, text TEXT NOT NULL, '
+               'created_at REAL NOT NULL)')
+    db.execute("INSERT INTO near_duplicates VALUES (?, ?, '2x - 4 = 0', 0)", (NAMESPACE, f'{phash(render("2x - 4 = 0")):016x}'))
+    db.commit()
+    db.close()
+    cache = RecognitionCache(cache_dir=str(tmp_path), near_distance=6)
+    assert lookup(cache, render('2x - 4 = 1')) is None
+    indexes = {row[1] for row in cache._db.execute('PRAGMA index_list(near_duplicates)')}
+    assert 'near_duplicates_namespace' in indexes
+
+
+def _recognize(image: Image.Image, text: str, near_duplicates: bool):
+    """不调用模型，直接驱动sans-IO的识别流程，模型的回答由text给出"""
+    import solver_core
+    steps = solver_core._recognition_steps(image, None, 'prompt', 'model', None, near_duplicates)
+    try:
+        payload = next(steps)
+        while True:
+            # 未命中缓存时流程交出的是发给vision模型的图片字节
+            assert isinstance(payload, bytes) and payload
+            payload = steps.send(text)
+    except StopIteration as stop:
+        return stop.value
+
+
+def test_crops_recognized_without_near_duplicates_are_not_indexed(tmp_path, monkeypatch):
+    import solver_core
+    cache = RecognitionCache(cache_dir=str(tmp_path), near_distance=4)
+    monkeypatch.setattr(solver_core, 'get_recognition_cache', lambda: cache)
+    image = render('2x - 4 = 0')
+    assert _recognize(image, '2x - 4 = 0', near_duplicates=False)['source'] == 'model'
+    assert cache._db.execute('SELECT COUNT(*) FROM near_duplicates').fetchone()[0] == 0
+
+    assert _recognize(render('3x + 5 = 7'), '3x + 5 = 7', near_duplicates=True)['source'] == 'model'
+    result = _recognize(recompress(render('3x + 5 = 7')), 'unused', near_duplicates=True)
+    assert result == {'text': '3x + 5 = 7', 'source': 'near_duplicate', 'tier': None}
+
+
+def test_distance_zero_enables_exact_phash_matching(tmp_path):
+    cache = RecognitionCache(cache_dir=str(tmp_path), near_distance=0)
+    assert cache.near_enabled
+    image = render('2x - 4 = 0')
+    remember(cache, image, '2x - 4 = 0')
+    assert lookup(cache, image.copy()) == '2x - 4 = 0'
+    assert lookup(cache, render('2x - 4 = 1')) is None
+
+
+def test_phash_not_computed_when_near_duplicates_disabled(tmp_path, monkeypatch):
+    import solver_core
+    cache = RecognitionCache(cache_dir=str(tmp_path))
+    monkeypatch.setattr(solver_core, 'get_recognition_cache', lambda: cache)
+
+    def fail(*args, **kwargs):
+        raise AssertionError('phash should not run while near-duplicate reuse is off')
+
+    monkeypatch.setattr(solver_core, 'phash', fail)
+    monkeypatch.setattr(solver_core, 'pixel_thumbnail', fail)
+    assert _recognize(render('2x - 4 = 0'), '2x - 4 = 0', near_duplicates=True)['source'] == 'model'
+    assert _recognize(render('2x - 4 = 0'), 'unused', near_duplicates=True)['source'] == 'cache'
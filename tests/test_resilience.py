@@ -0,0 +1,67 @@
+import time
+
+import httpx
+import ollama
+import pytest
+
+import resilience
+from resilience import CircuitBreaker, is_retryable, retry_call
+
+
+def test_retryable_errors():
+    assert is_retryable(httpx.ConnectError('refused'))
+    assert is_retryable(TimeoutError())
+    assert is_retryable(ollama.ResponseError('busy', 503))
+    assert is_retryable(ollama.ResponseError('slow down', 429))
+    assert not is_retryable(ollama.ResponseError('model not found', 404))
+    assert not is_retryable(ValueError())
+
+
+def test_breaker_opens_after_threshold_and_probes_once():
+    breaker = CircuitBreaker('host', failure_threshold=2, cooldown=0.05)
+    assert breaker.record(TimeoutError()) is None
+    assert breaker.record(TimeoutError()) == 'open'
+    assert not breaker.available()
+    time.sleep(0.06)
+    assert breaker.available()
+    breaker.on_lease()
+    # 半开状态只放行一个试探请求
+    assert breaker.state == 'half_open' and not breaker.available()
+    assert breaker.record(None) == 'closed'
+    assert breaker.available()
+
+
+def test_failed_probe_reopens():
+    breaker = CircuitBreaker('host', failure_threshold=1, cooldown=0.01)
+    breaker.record(TimeoutError())
+    time.sleep(0.02)
+    breaker.on_lease()
+    assert breaker.record(TimeoutError()) == 'open'
+
+
+def test_non_retryable_errors_do_not_trip_breaker():
+    breaker = CircuitBreaker('host', failure_threshold=1)
+    breaker.record(ollama.ResponseError('model not found', 404))
+    assert breaker.state == 'closed'
+
+
+def test_retry_call_retries_only_retryable(monkeypatch):
+    monkeypatch.setattr(resilience, 'backoff_delay', lambda attempt: 0)
+    calls = []
+
+    def flaky():
+        calls.append(1)
+        if len(calls) < 3:
+            raise httpx.ConnectError('refused')
+        return 'ok'
+
+    assert retry_call(flaky, 'math', retries=2) == 'ok'
+
+    def missing():
+        calls.append(1)
+        raise ollama.ResponseError('model not found', 404)
+
+    calls.clear()
+    with pytest.raises(ollama.ResponseError):
+        retry_call(missing, 'math', retries=2)
+    assert len(calls) == 1
@@ -0,0 +1,63 @@
+import time
+
+import numpy as np
+
+from semantic_cache import SemanticCache, formula_skeleton, hashing_embed
+from solution_cache import normalize_problem_text
+
+
+def test_paraphrases_share_skeleton():
+    assert formula_skeleton('解方程 2x-4=0') == formula_skeleton('求x: 2x − 4 = 0') == ('#x-#=#',)
+
+
+def test_skeleton_separates_operators_and_variables():
+    skeletons = {formula_skeleton(text) for text in ('解方程 2x-4=0', '解方程 2x+4=0', '解方程 2y-4=0',
+                                                     '解方程 2x^4=0')}
+    assert len(skeletons) == 4
+
+
+def test_same_numbers_different_operation_use_different_buckets():
+    assert SemanticCache.bucket('ns', '解方程 2x-4=0') != SemanticCache.bucket('ns', '解方程 2x*4=0')
+    assert SemanticCache.bucket('ns', '解方程 2x-4=0') == SemanticCache.bucket('ns', '求x: 2x − 4 = 0')
+
+
+def test_hashing_paraphrase_stays_below_default_threshold():
+    texts = [normalize_problem_text(text) for text in ('解方程 2x-4=0', '求x: 2x − 4 = 0')]
+    vectors = hashing_embed(texts)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    assert float(vectors[0] @ vectors[1]) < 0.92
+
+
+def _wait_for(cache, size):
+    deadline = time.time() + 5
+    while len(cache.index) < size and time.time() < deadline:
+        time.sleep(0.01)
+
+
+def test_lookup_hits_only_within_bucket():
+    # hashing嵌入只比较字面，这里放低阈值只检验分桶
+    cache = SemanticCache(directory=None, model='hashing', threshold=0.6)
+    cache.add('ns', '解方程 2x-4=0', 'x=2')
+    _wait_for(cache, 1)
+    assert cache.lookup('ns', '求x: 2x − 4 = 0') == 'x=2'
+    assert cache.lookup('ns', '解方程 2x+4=0') is None
+    assert cache.lookup('other', '解方程 2x-4=0') is None
+
+
+def test_embeddings_go_through_backend_pool(monkeypatch):
+    import semantic_cache
+    from backend_pool import Backend, BackendPool
+
+    calls = []
+
+    class FakeBackend(Backend):
+        def embed(self, timeout=None, **kwargs):
+            calls.append((timeout, kwargs['model']))
+            return {'embeddings': [[1.0, 0.0]] * len(kwargs['input'])}
+
+    pool = BackendPool([FakeBackend('http://embed-host')], health_interval=0)
+    monkeypatch.setattr(semantic_cache, 'get_backend_pool', lambda: pool)
+    vectors = semantic_cache.embed_texts(['a', 'b'], model='nomic-embed-text')
+    assert vectors.shape == (2, 2)
+    assert calls == [(semantic_cache.stage_timeout('embed'), 'nomic-embed-text')]
+    assert pool.backends[0].requests == 1 and pool.backends[0].outstanding == 0
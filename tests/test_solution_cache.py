@@ -0,0 +1,19 @@
+import pytest
+
+from solution_cache import make_solution_key, normalize_problem_text
+
+
+@pytest.mark.parametrize('minus', ['−', '‐', '‑', '‒', '–', '—', '―',
+                                   '﹣', '－'])
+def test_minus_variants_normalize_to_hyphen(minus):
+    assert normalize_problem_text(f'2x {minus} 4 = 0') == '2x-4=0'
+
+
+def test_layout_variants_share_key():
+    variants = ['解方程 2x - 4 = 0', '解方程 $2x-4=0$。', '解方程２ｘ－４＝０', '解方程 2 x − 4 = 0']
+    keys = {make_solution_key(text, 'model', 'prompt') for text in variants}
+    assert len(keys) == 1
+
+
+def test_different_constants_do_not_collide():
+    assert normalize_problem_text('2x - 4 = 0') != normalize_problem_text('2x - 4 = 1')
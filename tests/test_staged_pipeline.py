@@ -0,0 +1,53 @@
+import queue
+import threading
+
+import pytest
+
+from cancellation import CancelToken, current_token, use_token
+from staged_pipeline import StagedPipeline
+
+
+def test_stages_run_in_submitter_context():
+    seen = {}
+
+    def vision(image):
+        seen['vision'] = current_token()
+        return {'text': image}
+
+    def math(text):
+        seen['math'] = current_token()
+        return text.upper()
+
+    pipeline = StagedPipeline(1, 1, 4, vision_fn=vision, math_fn=math)
+    token = CancelToken()
+    with use_token(token):
+        future = pipeline.submit('x+1')
+    assert future.result(timeout=5)['answer'] == 'X+1'
+    assert seen == {'vision': token, 'math': token}
+    pipeline.shutdown()
+
+
+def test_full_queue_finishes_trace(monkeypatch):
+    finished = []
+
+    class FakeTrace:
+        def add_span(self, *args, **attributes):
+            pass
+
+        def finish(self, error=None):
+            finished.append(error)
+
+    monkeypatch.setattr('staged_pipeline.start_trace', lambda name, **attributes: FakeTrace())
+    release = threading.Event()
+    pipeline = StagedPipeline(1, 1, 1, vision_fn=lambda image: release.wait() and {'text': ''},
+                              math_fn=lambda text: text)
+    pipeline.submit('a')
+    # 等工作线程取走第一个任务，队列里再放一个把它占满
+    while pipeline.stats()['vision']['busy_workers'] == 0:
+        pass
+    pipeline.submit('b')
+    with pytest.raises(queue.Full):
+        pipeline.submit('c', timeout=0.05)
+    assert len(finished) == 1 and isinstance(finished[0], queue.Full)
+    release.set()
+    pipeline.shutdown()
@@ -0,0 +1,60 @@
+from stream_handoff import END_MARKER, VISION_HANDOFF, handoff_prompt, problem_end
+
+
+def test_handoff_disabled_by_default():
+    assert VISION_HANDOFF is False
+
+
+def test_figure_sentence_is_not_cut():
+    text = '已知 AB = 5, BC = 3。\n\n图中∠ABC=90°，求AC的长。'
+    assert problem_end(text) is None
+    assert problem_end('这张图片显示了一道题：\n\n图片中有一个三角形ABC') is None
+
+
+def test_cuts_at_end_marker():
+    text = '已知 AB = 5, BC = 3。\n\n图中∠ABC=90°，求AC的长。\n[END]\n这张图片是一道几何题'
+    cut = problem_end(text)
+    assert text[:cut].rstrip() == '已知 AB = 5, BC = 3。\n\n图中∠ABC=90°，求AC的长。'
+
+
+def test_partial_marker_waits():
+    assert problem_end('解方程 2x - 4 = 0\n[EN') is None
+
+
+def test_prompt_asks_for_marker():
+    assert handoff_prompt('识别题目').startswith('识别题目')
+    assert END_MARKER in handoff_prompt('识别题目')
+
+
+class FakeStream:
+    """按给定片段产出的ChatStream替身，记录收到的提示词"""
+    prompts = []
+
+    def __init__(self, model, messages, options, stage):
+        FakeStream.prompts.append(messages[0]['content'])
+        self.text = ''
+        self.final_chunk = None
+        self.closed = False
+        self.stats = {'completed': False, 'ttft': None}
+
+    def __iter__(self):
+        for chunk in ('已知 AB = 5。\n\n图中∠ABC=90°，求AC。', '\n[END]\n', '这张图片是一道几何题'):
+            self.text += chunk
+            yield chunk
+        self.stats['completed'] = True
+
+    def close(self):
+        self.closed = True
+
+    def format_stats(self):
+        return ''
+
+
+def test_vision_call_sends_suffix_and_cuts_at_marker(monkeypatch):
+    import solver_core
+    monkeypatch.setattr(solver_core, 'ChatStream', FakeStream)
+    FakeStream.prompts.clear()
+    text, handoff = solver_core._call_vision(b'', '识别题目', 'vision-model', None, handoff=True)
+    assert FakeStream.prompts == [handoff_prompt('识别题目')]
+    assert text == '已知 AB = 5。\n\n图中∠ABC=90°，求AC。'
+    assert handoff is not None
@@ -0,0 +1,29 @@
+import pytest
+
+from symbolic_solver import solve_symbolic
+
+
+@pytest.mark.parametrize('text', [
+    '若 2x+3=7，求 4x+1 的值',
+    'x^2-5x+6=0 的两根之和',
+    '求函数 f(x)=x^2+1 在 x=2 处的导数',
+    '若 x=3, 求 x^2+2x 的值',
+    'x = 2 是方程 ax + 4 = 0 的解，求 a',
+])
+def test_questions_about_other_quantities_go_to_model(text):
+    assert solve_symbolic(text) is None
+
+
+@pytest.mark.parametrize('text, kind, answer', [
+    ('解方程 2x-4=0', 'equation', 'x = 2'),
+    ('2x - 4 = 0', 'equation', 'x = 2'),
+    ('求x: 2x − 4 = 0', 'equation', 'x = 2'),
+    ('解方程：$x^2-5x+6=0$', 'equation', 'x = 3'),
+    ('解方程组 x+y=3, x-y=1', 'system', 'y = 1'),
+    ('求 f(x)=x^2+1 的导数', 'derivative', "f'(x) = 2 x"),
+    ('d/dx (x^3+2x)', 'derivative', "f'(x) = 3 x^{2} + 2"),
+])
+def test_pure_directives_are_solved(text, kind, answer):
+    result = solve_symbolic(text)
+    assert result is not None and result['type'] == kind
+    assert answer in result['answer'].split('**最终答案：**')[1]
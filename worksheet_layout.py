@@ -0,0 +1,168 @@
+import os
+import asyncio
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Tuple
+
+import numpy as np
+from PIL import Image
+
+from solver_core import arecognize_image_detailed, load_pil_image, recognize_image_detailed
+
+# 是否启用整页习题切分
+WORKSHEET_SPLIT = os.environ.get('WORKSHEET_SPLIT', '1') != '0'
+# 并发识别的工作线程数
+WORKSHEET_WORKERS = int(os.environ.get('WORKSHEET_WORKERS', '4'))
+# 高度低于该值的图片视为单题，不做切分
+MIN_SPLIT_HEIGHT = 600
+# 题目之间的空白至少是文字行高中位数的倍数，更小的空白视为同一题内的换行
+GAP_FACTOR = 1.5
+MIN_GAP = 12
+# 至少切出这么多区域才按整页习题处理
+MIN_REGIONS = 3
+# 左右分栏时栏间空白占图片宽度的最小比例
+MIN_COLUMN_GAP_RATIO = 0.04
+REGION_PADDING = 8
+# 每行/列至少有该比例的笔迹像素才算有内容，过滤拍照噪点
+MIN_INK_RATIO = 0.002
+
+Box = Tuple[int, int, int, int]
+
+
+def binarize(pil_image: Image.Image) -> np.ndarray:
+    """Otsu阈值二值化，返回笔迹为True的布尔数组（笔迹取像素较少的一类，兼容深色背景）"""
+    gray = np.asarray(pil_image.convert('L'), dtype=np.uint8)
+    histogram = np.bincount(gray.ravel(), minlength=256).astype(np.float64)
+    total = gray.size
+    cumulative = np.cumsum(histogram)
+    cumulative_mean = np.cumsum(histogram * np.arange(256))
+    global_mean = cumulative_mean[-1]
+    background = cumulative
+    foreground = total - cumulative
+    with np.errstate(divide='ignore', invalid='ignore'):
+        between = (global_mean * background / total - cumulative_mean) ** 2 / (background * foreground)
+    threshold = int(np.nanargmax(between))
+    dark = gray <= threshold
+    return dark if dark.mean() < 0.5 else ~dark
+
+
+def _runs(mask: np.ndarray) -> List[Tuple[int, int]]:
+    """返回布尔序列中连续True段的 [start, end) 区间"""
+    padded = np.concatenate([[False], mask, [False]])
+    changes = np.flatnonzero(padded[1:] != padded[:-1])
+    return list(zip(changes[0::2], changes[1::2]))
+
+
+def _group_bands(bands: List[Tuple[int, int]], min_gap: int) -> List[Tuple[int, int]]:
+    """把间距较小的相邻文字行合并为同一道题"""
+    if not bands:
+        return []
+    gaps = [bands[i + 1][0] - bands[i][1] for i in range(len(bands) - 1)]
+    line_height = float(np.median([end - start for start, end in bands]))
+    threshold = max(min_gap, line_height * GAP_FACTOR)
+    groups = [list(bands[0])]
+    for gap, band in zip(gaps, bands[1:]):
+        if gap >= threshold:
+            groups.append(list(band))
+        else:
+            groups[-1][1] = band[1]
+    return [tuple(group) for group in groups]
+
+
+def _split_columns(ink: np.ndarray) -> List[Tuple[int, int]]:
+    """按列投影切分左右分栏，只在栏间空白足够宽时切分"""
+    cols = _runs(ink.sum(axis=0) > max(1, ink.shape[0] * MIN_INK_RATIO))
+    if not cols:
+        return []
+    min_gap = max(MIN_GAP, int(ink.shape[1] * MIN_COLUMN_GAP_RATIO))
+    merged = [list(cols[0])]
+    for start, end in cols[1:]:
+        if start - merged[-1][1] >= min_gap:
+            merged.append([start, end])
+        else:
+            merged[-1][1] = end
+    return [tuple(col) for col in merged]
+
+
+def find_problem_regions(pil_image: Image.Image) -> List[Box]:
+    """用行/列投影找出各题所在区域，按阅读顺序（先分栏从左到右，栏内从上到下）返回"""
+    ink = binarize(pil_image)
+    height, width = ink.shape
+    regions = []
+    for left, right in _split_columns(ink):
+        column = ink[:, left:right]
+        lines = _runs(column.sum(axis=1) > max(1, column.shape[1] * MIN_INK_RATIO))
+        for top, bottom in _group_bands(lines, MIN_GAP):
+            regions.append((
+                max(0, int(left) - REGION_PADDING),
+                max(0, int(top) - REGION_PADDING),
+                min(width, int(right) + REGION_PADDING),
+                min(height, int(bottom) + REGION_PADDING),
+            ))
+    return regions
+
+
+def _plan_regions(pil_image: Image.Image) -> List[Box]:
+    """需要切分时返回各题区域，否则返回空列表"""
+    if not WORKSHEET_SPLIT or pil_image.size[1] < MIN_SPLIT_HEIGHT:
+        return []
+    regions = find_problem_regions(pil_image)
+    return regions if len(regions) >= MIN_REGIONS else []
+
+
+def _single_result(result: Dict, pil_image: Image.Image) -> Dict:
+    box = (0, 0, pil_image.size[0], pil_image.size[1])
+    return {'text': result['text'], 'regions': [dict(result, index=1, box=box)]}
+
+
+def _assemble(regions: List[Box], results: List[Dict]) -> Dict:
+    """按阅读顺序拼接各题识别结果"""
+    parts = []
+    region_results = []
+    for index, (box, result) in enumerate(zip(regions, results), start=1):
+        region_results.append(dict(result, index=index, box=box))
+        parts.append(f"第{index}题 (区域 {box[0]},{box[1]},{box[2]},{box[3]}):\n{result['text'].strip()}")
+    return {'text': '\n\n'.join(parts), 'regions': region_results}
+
+
+def recognize_worksheet(image, max_workers: int = WORKSHEET_WORKERS) -> Dict:
+    """识别整页习题：切分题目区域后并发识别，按阅读顺序拼回
+
+    Returns:
+        dict: text为拼接后的识别文本，regions为各题的 {index, box, text, source, tier}
+    """
+    pil_image = load_pil_image(image)
+    regions = _plan_regions(pil_image)
+    if not regions:
+        # 单题图片走原来的单次识别
+        return _single_result(recognize_image_detailed(image), pil_image)
+
+    print(f"🧩 检测到 {len(regions)} 个题目区域，使用 {max_workers} 个线程并发识别")
+    crops = [pil_image.crop(box) for box in regions]
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        # 同一页的题目版式相近，感知哈希容易误判为近重复，切分后的区域只用精确缓存；
+        # 每个区域在提交线程的上下文副本中执行，请求时间线能记录到各区域的识别
+        futures = [
+            executor.submit(contextvars.copy_context().run, recognize_image_detailed, crop, near_duplicates=False)
+            for crop in crops
+        ]
+        results = [future.result() for future in futures]
+    return _assemble(regions, results)
+
+
+async def arecognize_worksheet(image, max_workers: int = WORKSHEET_WORKERS) -> Dict:
+    """recognize_worksheet的异步版本，各区域以协程并发识别，并发数同样受max_workers限制"""
+    pil_image = load_pil_image(image)
+    regions = _plan_regions(pil_image)
+    if not regions:
+        return _single_result(await arecognize_image_detailed(image), pil_image)
+
+    print(f"🧩 检测到 {len(regions)} 个题目区域，以 {max_workers} 路协程并发识别")
+    semaphore = asyncio.Semaphore(max_workers)
+
+    async def recognize_region(box):
+        async with semaphore:
+            return await arecognize_image_detailed(pil_image.crop(box), near_duplicates=False)
+
+    results = await asyncio.gather(*(recognize_region(box) for box in regions))
+    return _assemble(regions, list(results))